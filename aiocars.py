@@ -0,0 +1,98 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import cars
+
+# ---------------------------- Async data layer ----------------------------
+# The same functions as the 'cars' module, as coroutines. sqlite3 calls block, so every call runs in a bounded pool of
+# worker threads while the event loop keeps serving other requests. The number of threads matches the size of the
+# connection pool, so a worker never waits for a connection (see: pool.py).
+executor = ThreadPoolExecutor(max_workers=cars.pool.size, thread_name_prefix='aiocars')
+
+
+# ---------------------------- Defining a new function named 'configure' ----------------------------
+# Replacing the worker threads, e.g. after the connection pool size was changed
+def configure(max_workers=None):
+    global executor
+    executor.shutdown(wait=True)
+    executor = ThreadPoolExecutor(max_workers=max_workers or cars.pool.size, thread_name_prefix='aiocars')
+
+
+# ---------------------------- Defining a new function named 'run' ----------------------------
+# Running a blocking function in the worker threads and waiting for its result without blocking the event loop
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    executor.shutdown(wait=True)
+
+
+# ---------------------------- Mirrors of the 'cars' functions ----------------------------
+async def get_schema():
+    return await run(cars.get_schema)
+
+async def get_primary_key_columns():
+    return await run(cars.get_primary_key_columns)
+
+async def get_table_names():
+    return await run(cars.get_table_names)
+
+async def get_table_columns(table_name):
+    return await run(cars.get_table_columns, table_name)
+
+async def get_table_data(table_name):
+    return await run(cars.get_table_data, table_name)
+
+async def get_table_page(table_name, primary_key_column=None, page_size=100, after=None, after_rowid=None):
+    return await run(cars.get_table_page, table_name, primary_key_column, page_size, after, after_rowid)
+
+async def add_record(table_name, record):
+    return await run(cars.add_record, table_name, record)
+
+async def get_row_count(table_name):
+    return await run(cars.get_row_count, table_name)
+
+async def get_max_id(table_name):
+    return await run(cars.get_max_id, table_name)
+
+async def get_table_stats(table_name=None):
+    return await run(cars.get_table_stats, table_name)
+
+async def get_changes(since=0, limit=1000, tables=None):
+    return await run(cars.get_changes, since, limit, tables)
+
+async def delete_record(table_name, primary_key_column, record_id):
+    return await run(cars.delete_record, table_name, primary_key_column, record_id)
+
+async def get_record_by_id(table_name, record_id, primary_key_columns):
+    return await run(cars.get_record_by_id, table_name, record_id, primary_key_columns)
+
+async def update_record(table_name, primary_key_column, record_id, updated_record):
+    return await run(cars.update_record, table_name, primary_key_column, record_id, updated_record)
+
+async def get_records_by_ids(table_name, primary_key_column, record_ids):
+    return await run(cars.get_records_by_ids, table_name, primary_key_column, record_ids)
+
+async def update_records(table_name, primary_key_column, record_ids, updated_record):
+    return await run(cars.update_records, table_name, primary_key_column, record_ids, updated_record)
+
+async def delete_records(table_name, primary_key_column, record_ids):
+    return await run(cars.delete_records, table_name, primary_key_column, record_ids)
+
+async def filter_customers(customer_name=None, model_name=None, model_price=None, dealer_name=None, use_search_index=None):
+    return await run(cars.filter_customers, customer_name, model_name, model_price, dealer_name, use_search_index)
+
+async def search_names(text, kinds=None, limit=20):
+    return await run(cars.search_names, text, kinds, limit)
+
+async def get_customers(brand=None, dealer=None, purchase_price=None, model=None):
+    return await run(cars.get_customers, brand, dealer, purchase_price, model)
+
+async def get_models(car_color=None, brand=None, price=None):
+    return await run(cars.get_models, car_color, brand, price)
+
+async def get_report(name, **params):
+    return await run(cars.get_report, name, **params)
@@ -0,0 +1,486 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+from flask import Blueprint, Response, current_app, request
+
+import cars
+import reports
+from instrumentation import metrics
+
+# Optional faster JSON encoder and brotli compression: used when the packages are installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON REST API: /api/v1/...
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Responses smaller than this are sent uncompressed (compressing them costs more than it saves)
+MIN_COMPRESS_SIZE = 500
+
+# Tables behind the /customers and /models resources
+RESOURCES = {'customers': 'Customers', 'models': 'Models'}
+
+# Most ids accepted by one batch request (see: batch_endpoint)
+MAX_BATCH_IDS = 50000
+
+# Endpoints without ETags: a change feed consumer already asks only for what is new, and a long-polling or streaming
+# request has to wait for changes instead of being answered '304 Not Modified'
+NO_ETAG_ENDPOINTS = {'api.list_changes', 'api.change_stream'}
+
+# Seconds between two comments sent on an idle event stream, so proxies do not close it
+KEEPALIVE_INTERVAL = 15.0
+
+# Seconds a client turned away by the watcher limit is told to wait before trying again (see: Watchers)
+WATCHERS_RETRY_AFTER = 5
+
+
+# ---------------------------- Defining a new function named 'dumps' ----------------------------
+# Serializing to compact JSON bytes (orjson if available, the standard json module otherwise)
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def json_response(data, status=200):
+    if metrics.enabled:
+        with metrics.timer('cars_serialize_seconds', trace='json'):
+            return Response(dumps(data), status=status, mimetype='application/json')
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+def error(message, status):
+    return json_response({'error': message}, status)
+
+
+# ---------------------------- Conditional GET ----------------------------
+# Every GET response carries an ETag computed from the data version (see: cars.data_version) and the request URL.
+# A client sending it back in If-None-Match gets '304 Not Modified' without the query being run at all, as long as
+# nothing was written in between.
+def current_etag():
+    token = f"{cars.data_version()}|{request.full_path}"
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+
+@bp.before_request
+def check_etag():
+    if request.method != 'GET' or request.endpoint in NO_ETAG_ENDPOINTS:
+        return None
+    etag = current_etag()
+    request.environ['api.etag'] = etag # Reused by add_headers, so the version is read before the query runs
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True) # Weak: the same data is sent with different bytes depending on the compression
+        return response
+    return None
+
+
+@bp.after_request
+def add_headers(response):
+    etag = request.environ.get('api.etag')
+    if etag and response.status_code == 200:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache' # Clients may keep the response but have to revalidate it
+    return compress(response)
+
+
+# ---------------------------- Defining a new function named 'compress' ----------------------------
+# Compressing JSON responses with brotli or gzip, depending on what the client accepts
+def compress(response):
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(data, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# ---------------------------- Tables ----------------------------
+# GET /api/v1/tables -> every table with its columns and primary key
+@bp.route('/tables', methods=['GET'])
+def list_tables():
+    schema = cars.get_schema()
+    primary_keys = cars.get_primary_key_columns()
+    return json_response({'items': [{'name': name, 'columns': table['columns'], 'primary_key': primary_keys[name]}
+                                    for name, table in schema.items()]})
+
+
+# GET /api/v1/tables/<table_name>?page_size=100&after=...&after_rowid=... -> one page of rows (keyset pagination)
+# With ?format=rows: {'columns': [...], 'rows': [[values in column order], ...], 'next': ...}, without repeating the
+# column names in every row (used by the scroll view of /table/<table_name>)
+@bp.route('/tables/<table_name>', methods=['GET'])
+def list_rows(table_name):
+    if table_name not in cars.get_schema():
+        return error(f"Unknown table: {table_name}", 404)
+    page_size = max(1, min(request.args.get('page_size', 100, type=int), 5000))
+    page = cars.get_table_page(table_name, cars.get_primary_key_columns()[table_name], page_size,
+                               request.args.get('after'), request.args.get('after_rowid', type=int))
+    next_page = None
+    if page['next_after'] is not None:
+        next_page = {'after': page['next_after'], 'after_rowid': page['next_after_rowid']}
+    if request.args.get('format') == 'rows':
+        return json_response({'columns': page['columns'], 'rows': [list(row.values()) for row in page['rows']], 'next': next_page})
+    return json_response({'items': page['rows'], 'next': next_page})
+
+
+# POST /api/v1/tables/<table_name> with a JSON object -> the created row (201)
+@bp.route('/tables/<table_name>', methods=['POST'])
+def create_row(table_name):
+    return create(table_name)
+
+
+# GET / PUT / DELETE /api/v1/tables/<table_name>/<record_id>
+@bp.route('/tables/<table_name>/<record_id>', methods=['GET', 'PUT', 'DELETE'])
+def row(table_name, record_id):
+    return record_endpoint(table_name, record_id)
+
+
+# POST   /api/v1/tables/<table_name>/batch with {"ids": [...]} -> {'items': [the rows with these ids]}
+# PATCH  /api/v1/tables/<table_name>/batch with {"ids": [...], "values": {...}} -> {'updated': n}, in one transaction
+# DELETE /api/v1/tables/<table_name>/batch with {"ids": [...]} -> {'deleted': n}, in one transaction
+@bp.route('/tables/<table_name>/batch', methods=['POST', 'PATCH', 'DELETE'])
+def rows_batch(table_name):
+    return batch_endpoint(table_name)
+
+
+# ---------------------------- Customers and models (with filtering) ----------------------------
+# GET /api/v1/customers?brand=&dealer=&purchase_price=&model= -> {'items': [...]} (empty list if nothing matches)
+@bp.route('/customers', methods=['GET'])
+def list_customers():
+    customers = cars.get_customers(request.args.get('brand'), request.args.get('dealer'),
+                                   request.args.get('purchase_price'), request.args.get('model'))
+    return json_response({'items': customers})
+
+
+# GET /api/v1/models?car_color=&brand=&price= -> {'items': [...]}, each model with its 'possible_colors'
+@bp.route('/models', methods=['GET'])
+def list_models():
+    models = cars.get_models(request.args.get('car_color'), request.args.get('brand'), request.args.get('price'))
+    return json_response({'items': models})
+
+
+# POST /api/v1/customers, POST /api/v1/models
+@bp.route('/<any(customers, models):resource>', methods=['POST'])
+def create_resource(resource):
+    return create(RESOURCES[resource])
+
+
+# GET / PUT / DELETE /api/v1/customers/<id>, /api/v1/models/<id>
+@bp.route('/<any(customers, models):resource>/<record_id>', methods=['GET', 'PUT', 'DELETE'])
+def resource_record(resource, record_id):
+    return record_endpoint(RESOURCES[resource], record_id)
+
+
+# POST / PATCH / DELETE /api/v1/customers/batch and /api/v1/models/batch (see: rows_batch)
+@bp.route('/<any(customers, models):resource>/batch', methods=['POST', 'PATCH', 'DELETE'])
+def resource_batch(resource):
+    return batch_endpoint(RESOURCES[resource])
+
+
+# ---------------------------- Reports ----------------------------
+# GET /api/v1/reports/revenue?by=brand|model|dealer&limit=20 -> sales, revenue and average price per group
+# GET /api/v1/reports/price_histogram?bucket_size=5000 -> sales per purchase price bucket
+# GET /api/v1/reports/top_customers?limit=10 -> the customers who spent the most
+# Every report can be filtered with date_from, date_to, min_price, max_price, brand and dealer (see: reports.py)
+@bp.route('/reports/<any(revenue, price_histogram, top_customers):report>', methods=['GET'])
+def report(report):
+    params = {name: request.args.get(name) for name in ('date_from', 'date_to', 'brand', 'dealer') if request.args.get(name)}
+    try:
+        for name in ('min_price', 'max_price'):
+            if request.args.get(name):
+                params[name] = float(request.args[name])
+        if report == 'revenue':
+            params['group_by'] = request.args.get('by', 'brand')
+            if params['group_by'] not in reports.GROUPS:
+                return error(f"by must be one of: {', '.join(reports.GROUPS)}", 400)
+            if request.args.get('limit'):
+                params['limit'] = max(1, min(int(request.args['limit']), 1000))
+        elif report == 'price_histogram':
+            bucket_size = float(request.args.get('bucket_size', 5000))
+            if bucket_size <= 0:
+                return error("bucket_size must be positive", 400)
+            params['bucket_size'] = int(bucket_size) if bucket_size.is_integer() else bucket_size
+        else:
+            params['limit'] = max(1, min(int(request.args.get('limit', 10)), 1000))
+    except ValueError:
+        return error("min_price, max_price and bucket_size must be numbers, limit an integer", 400)
+    return json_response({'items': cars.get_report(report, **params)})
+
+
+# ---------------------------- Change feed ----------------------------
+# GET /api/v1/changes?since=<seq>&limit=1000&tables=Customers,Models&wait=<seconds> -> the changes after 'since' (see:
+# change_feed.py): {'items': [...], 'next': <the 'since' of the next request>, 'last_seq': n, 'has_more': bool}.
+# With ?wait=, a request finding no change waits up to that many seconds for one (long polling), or gets '503 Service
+# Unavailable' if CHANGE_FEED_MAX_WATCHERS requests are already waiting (see: Watchers).
+# '410 Gone' if changes after 'since' were removed by the compaction: the consumer has to read the tables again
+@bp.route('/changes', methods=['GET'])
+def list_changes():
+    args = feed_args(request.args.get('since', '0'))
+    if isinstance(args, Response):
+        return args
+    since, limit, tables = args
+    wait = max(0.0, min(request.args.get('wait', 0.0, type=float), current_app.config['CHANGE_FEED_MAX_WAIT']))
+    feed = cars.get_changes(since, limit, tables)
+    if feed is not None and not feed['items'] and wait and since >= feed['horizon']:
+        if not watchers.acquire():
+            return too_many_watchers()
+        try:
+            changed = cars.wait_for_changes(since, wait, current_app.config['CHANGE_FEED_POLL_INTERVAL'])
+        finally:
+            watchers.release()
+        if changed:
+            feed = cars.get_changes(since, limit, tables)
+    if feed is None:
+        return error("No change feed (set DB_CREATE_CHANGE_FEED)", 404)
+    if since < feed['horizon']:
+        return json_response({'error': f"Changes after {since} were compacted, read the tables again", 'horizon': feed['horizon']}, 410)
+    return json_response({'items': feed['items'], 'next': next_since(feed, since, limit), 'last_seq': feed['last_seq'],
+                          'has_more': len(feed['items']) == limit})
+
+
+# GET /api/v1/changes/stream?since=<seq>&tables=... -> the same changes as Server-Sent Events ('change' events with the
+# sequence number as id, so a reconnecting browser continues after the last one through the Last-Event-ID header). A
+# 'resync' event is sent instead if changes were compacted. The stream is closed after CHANGE_FEED_STREAM_DURATION
+# seconds, and holds a worker thread (but no database connection) while it is open: above CHANGE_FEED_MAX_WATCHERS open
+# streams and waiting requests, a new one gets '503 Service Unavailable' (see: Watchers)
+@bp.route('/changes/stream', methods=['GET'])
+def change_stream():
+    args = feed_args(request.headers.get('Last-Event-ID') or request.args.get('since', '0'))
+    if isinstance(args, Response):
+        return args
+    since, limit, tables = args
+    poll_interval = current_app.config['CHANGE_FEED_POLL_INTERVAL']
+    deadline = time.monotonic() + current_app.config['CHANGE_FEED_STREAM_DURATION']
+
+    def events(since):
+        yield "retry: 2000\n\n" # Milliseconds the browser waits before reconnecting
+        while True:
+            feed = cars.get_changes(since, limit, tables)
+            if feed is None:
+                yield "event: error\ndata: {\"error\": \"Error reading changes\"}\n\n"
+                return
+            if since < feed['horizon']:
+                yield f"event: resync\ndata: {dumps({'horizon': feed['horizon']}).decode()}\n\n"
+                return
+            for change in feed['items']:
+                yield f"id: {change['seq']}\nevent: change\ndata: {dumps(change).decode()}\n\n"
+            since = next_since(feed, since, limit)
+            if len(feed['items']) == limit: # More changes waiting
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not cars.wait_for_changes(since, min(KEEPALIVE_INTERVAL, remaining), poll_interval):
+                yield ": keepalive\n\n"
+
+    if not watchers.acquire():
+        return too_many_watchers()
+    # Not wrapped in stream_with_context: the request (and its pooled connection) ends before the events are sent
+    response = Response(events(since), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(watchers.release) # (when the stream ends or the client goes away)
+    return response
+
+
+# POST /api/v1/changes/compact (optional JSON body: {"retention_seconds": n or null}) -> removing the superseded changes
+# and those older than the retention (default: CHANGE_FEED_RETENTION) -> {'superseded': n, 'expired': n, 'horizon': seq}
+@bp.route('/changes/compact', methods=['POST'])
+def compact_changes():
+    body = request.get_json(silent=True)
+    retention = body.get('retention_seconds') if isinstance(body, dict) and 'retention_seconds' in body else current_app.config['CHANGE_FEED_RETENTION']
+    if retention is not None and (not isinstance(retention, (int, float)) or retention < 0):
+        return error("retention_seconds must be a number of seconds or null", 400)
+    result = cars.compact_changes(retention)
+    if result is None:
+        return error("Error compacting changes", 500)
+    return json_response(result)
+
+
+# ---------------------------- Defining a new class named 'Watchers' ----------------------------
+# Counting the long-polling requests and event streams open in this process. Each one holds a worker thread for as long
+# as it waits, so without a limit a few dozen of them take every thread of a worker and its other requests wait.
+# acquire() returns False once CHANGE_FEED_MAX_WATCHERS are open
+class Watchers:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.count >= current_app.config['CHANGE_FEED_MAX_WATCHERS']:
+                metrics.inc('cars_change_feed_watchers_rejected_total')
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.count -= 1
+
+
+watchers = Watchers()
+
+
+def too_many_watchers():
+    response = error("Too many clients waiting for changes, try again later", 503)
+    response.headers['Retry-After'] = str(WATCHERS_RETRY_AFTER)
+    return response
+
+
+# Reading 'since', ?limit= and ?tables= (or returning the error response)
+def feed_args(since):
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        return error("since must be a sequence number", 400)
+    limit = max(1, min(request.args.get('limit', 1000, type=int), 5000))
+    tables = request.args.get('tables')
+    tables = [table_name for table_name in tables.split(',') if table_name] if tables else None
+    if tables:
+        unknown = [table_name for table_name in tables if table_name not in cars.get_schema()]
+        if unknown:
+            return error(f"Unknown table(s): {', '.join(unknown)}", 400)
+    return max(since, 0), limit, tables
+
+
+# The 'since' of the next request: after the last change returned or, if everything was returned, after the latest
+# change overall (there is nothing for these tables up to it)
+def next_since(feed, since, limit):
+    if len(feed['items']) == limit:
+        return feed['items'][-1]['seq']
+    return max([since, feed['last_seq']] + [change['seq'] for change in feed['items']])
+
+
+# ---------------------------- Table statistics ----------------------------
+# GET /api/v1/stats -> row count and largest key of every table (see: table_stats.py)
+# GET /api/v1/stats/<table_name> -> the same for one table, with the statistics of its columns
+@bp.route('/stats', methods=['GET'])
+@bp.route('/stats/<table_name>', methods=['GET'])
+def table_statistics(table_name=None):
+    if table_name is not None and table_name not in cars.get_schema():
+        return error(f"Unknown table: {table_name}", 404)
+    stats = cars.get_table_stats(table_name)
+    if stats is None:
+        return error("No table statistics", 404)
+    return json_response({'items': stats} if table_name is None else stats)
+
+
+# POST /api/v1/stats/analyze (optional JSON body: {"tables": [...]}) -> recomputing the column statistics and the exact
+# row counts. Reads every row of the tables, so it is a maintenance call
+@bp.route('/stats/analyze', methods=['POST'])
+def analyze_tables():
+    body = request.get_json(silent=True) or {}
+    tables = body.get('tables') if isinstance(body, dict) else None
+    if tables is not None:
+        unknown = [table_name for table_name in tables if table_name not in cars.get_schema()] if isinstance(tables, list) else [tables]
+        if unknown:
+            return error(f"Unknown table(s): {', '.join(map(str, unknown))}", 400)
+    analyzed = cars.analyze_tables(tables)
+    if analyzed is None:
+        return error("Error analyzing tables", 500)
+    return json_response({'analyzed': analyzed})
+
+
+# ---------------------------- Shared CRUD handlers ----------------------------
+def create(table_name):
+    table = cars.get_schema().get(table_name)
+    if table is None:
+        return error(f"Unknown table: {table_name}", 404)
+    record = request.get_json(silent=True)
+    if not isinstance(record, dict) or not record:
+        return error("Expected a JSON object with the new row", 400)
+    unknown = [column for column in record if column not in table['columns']]
+    if unknown:
+        return error(f"Unknown column(s): {', '.join(unknown)}", 400)
+    rowid = cars.add_record(table_name, record)
+    if rowid is None:
+        return error("Error adding record", 409)
+    created = cars.get_record_by_rowid(table_name, rowid) # (not by the first primary key column, which may match other rows)
+    return json_response(created or record, 201)
+
+
+def record_endpoint(table_name, record_id):
+    table = cars.get_schema().get(table_name)
+    if table is None:
+        return error(f"Unknown table: {table_name}", 404)
+    primary_key_columns = cars.get_primary_key_columns()
+    primary_key_column = primary_key_columns[table_name]
+    existing = cars.get_record_by_id(table_name, record_id, primary_key_columns)
+    if existing is None:
+        return error("Record not found", 404)
+
+    if request.method == 'GET':
+        return json_response(existing)
+
+    if request.method == 'PUT':
+        updated = request.get_json(silent=True)
+        if not isinstance(updated, dict) or not updated:
+            return error("Expected a JSON object with the columns to update", 400)
+        unknown = [column for column in updated if column not in table['columns']]
+        if unknown:
+            return error(f"Unknown column(s): {', '.join(unknown)}", 400)
+        updated.pop(primary_key_column, None) # The primary key stays unchanged (as in the edit form)
+        if updated and not cars.update_record(table_name, primary_key_column, record_id, updated):
+            return error("Error updating record", 409)
+        return json_response(cars.get_record_by_id(table_name, record_id, primary_key_columns))
+
+    # DELETE
+    if not cars.delete_record(table_name, primary_key_column, record_id):
+        return error("Error deleting record", 409)
+    return Response(status=204)
+
+
+def batch_endpoint(table_name):
+    table = cars.get_schema().get(table_name)
+    if table is None:
+        return error(f"Unknown table: {table_name}", 404)
+    body = request.get_json(silent=True)
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not ids or not all(isinstance(record_id, (str, int, float)) for record_id in ids):
+        return error("Expected a JSON object with a non-empty 'ids' list", 400)
+    if len(ids) > MAX_BATCH_IDS:
+        return error(f"At most {MAX_BATCH_IDS} ids per request", 400)
+    primary_key_column = cars.get_primary_key_columns()[table_name]
+
+    if request.method == 'POST':
+        records = cars.get_records_by_ids(table_name, primary_key_column, ids)
+        if records is None:
+            return error("Error fetching records", 500)
+        return json_response({'items': records})
+
+    if request.method == 'PATCH':
+        values = body.get('values')
+        if not isinstance(values, dict) or not values:
+            return error("Expected a 'values' object with the columns to update", 400)
+        unknown = [column for column in values if column not in table['columns']]
+        if unknown:
+            return error(f"Unknown column(s): {', '.join(unknown)}", 400)
+        values.pop(primary_key_column, None) # The primary key stays unchanged (as in PUT)
+        updated = cars.update_records(table_name, primary_key_column, ids, values)
+        if updated is None:
+            return error("Error updating records", 409)
+        return json_response({'updated': updated})
+
+    # DELETE
+    deleted = cars.delete_records(table_name, primary_key_column, ids)
+    if deleted is None:
+        return error("Error deleting records", 409)
+    return json_response({'deleted': deleted})
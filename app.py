@@ -1,20 +1,175 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+import os
+import sqlite3
+
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, stream_template, stream_with_context, Response
 import cars
+import indexes
+import search
+import bulk
+import model_colors
+import reports
+import table_stats
+import change_feed
+import query_builder
+import table_render
+import api
+from instrumentation import metrics
 
 app = Flask(__name__)
 
-primary_key_columns = {
-    'Customers': 'customer_id',
-    'Models': 'model_id',
-    'Customer_Ownership': 'customer_id',
-    'Dealer_Brand': 'dealer_id',
-    'Car_Parts': 'part_id',
-    'Manufacture_Plant': 'manufacture_plant_id',
-    'Brands': 'brand_id',
-    'Dealers': 'dealer_id',
-    'Car_Options': 'option_set_id',
-    'Car_Vins': 'vin'
-}
+# Connection pool settings (see: pool.py). PRAGMAs given here are merged over pool.DEFAULT_PRAGMAS
+app.config.setdefault('DB_POOL_SIZE', 8)
+app.config.setdefault('DB_POOL_TIMEOUT', 30.0)
+app.config.setdefault('DB_PRAGMAS', {})
+# Compiled statements kept per connection (see: query_builder.py)
+app.config.setdefault('DB_STATEMENT_CACHE_SIZE', 256)
+# Number of rows shown per page on /table/<table_name> (can be changed per request with ?page_size=, up to the maximum)
+app.config.setdefault('TABLE_PAGE_SIZE', 100)
+app.config.setdefault('TABLE_MAX_PAGE_SIZE', 5000)
+# Rows per transaction for /import and rows per chunk for /export
+app.config.setdefault('BULK_BATCH_SIZE', 500)
+cars.pool.init_app(app)
+
+# Group commit (see: writer.py): add/update/delete are queued and committed together by one writer thread. A batch
+# is committed once WRITE_BATCH_SIZE writes are waiting or WRITE_FLUSH_DELAY seconds after its first write
+app.config.setdefault('WRITE_QUEUE_ENABLED', True)
+app.config.setdefault('WRITE_BATCH_SIZE', 100)
+app.config.setdefault('WRITE_FLUSH_DELAY', 0.0)
+app.config.setdefault('WRITE_TIMEOUT', 30.0)
+cars.writer.init_app(app)
+
+# Result cache for /customers and /models (see: cache.py). Set RESULT_CACHE_BACKEND to the path of a SQLite file to
+# share the cache between worker processes
+app.config.setdefault('RESULT_CACHE_SIZE', 256)
+app.config.setdefault('RESULT_CACHE_TTL', 60.0)
+app.config.setdefault('RESULT_CACHE_BACKEND', None)
+cars.result_cache.init_app(app)
+
+# Where the reads (tables, /customers, /models, /filter_data, reports, search) go (see: replica.py): 'primary' (the
+# database file, like the writes), 'readonly' (the file opened read-only and memory-mapped), 'immutable' (the same, for
+# a file nothing writes to) or 'snapshot' (an in-memory copy, refreshed in the background at most every
+# SNAPSHOT_REFRESH_INTERVAL seconds after a write). Can also be set with CARS_READ_MODE=...
+app.config.setdefault('READ_MODE', os.environ.get('CARS_READ_MODE', 'primary'))
+app.config.setdefault('READ_POOL_SIZE', None) # None -> DB_POOL_SIZE
+app.config.setdefault('READ_MMAP_SIZE', 1073741824)
+app.config.setdefault('SNAPSHOT_REFRESH_INTERVAL', 5.0)
+cars.replica.init_app(app)
+
+# Rendered rows of /table/<table_name>?stream=1 kept in memory until the data changes (see: table_render.py), in
+# characters. Tables rendering to more than TABLE_FRAGMENT_MAX_ENTRY_SIZE are streamed without being kept
+app.config.setdefault('TABLE_FRAGMENT_CACHE_SIZE', 64 * 1024 * 1024)
+app.config.setdefault('TABLE_FRAGMENT_MAX_ENTRY_SIZE', 16 * 1024 * 1024)
+fragment_cache = table_render.FragmentCache()
+fragment_cache.init_app(app)
+
+# Profiling (see: instrumentation.py): request, SQL, pool, template and JSON timings exported on /metrics in the Prometheus
+# format, an optional 'Server-Timing' header on every response and an optional slow query log. Off by default: nothing
+# is hooked in unless one of the three is turned on (METRICS_ENABLED can also be set with CARS_METRICS=1)
+app.config.setdefault('METRICS_ENABLED', os.environ.get('CARS_METRICS') == '1')
+app.config.setdefault('METRICS_TRACE_HEADER', False)
+app.config.setdefault('SLOW_QUERY_MS', float(os.environ['CARS_SLOW_QUERY_MS']) if os.environ.get('CARS_SLOW_QUERY_MS') else None)
+app.config.setdefault('SLOW_QUERY_LOG', None) # Path of a file for the slow queries (default: the 'cars.slow_queries' logger)
+metrics.init_app(app, pool=cars.pool, modules=[cars])
+metrics.add_stats('cars_result_cache', cars.result_cache.stats)
+metrics.add_stats('cars_write_queue', cars.writer.stats)
+metrics.add_stats('cars_sql_templates', query_builder.stats)
+metrics.add_stats('cars_read_replica', cars.replica.stats)
+metrics.add_stats('cars_table_fragments', fragment_cache.stats)
+
+# Startup of the production entry point (see: wsgi.py, warmup.py and gunicorn.conf.py): loading the schema, the SQL,
+# the templates and the model index, preparing WARMUP_CONNECTIONS connections (None -> DB_POOL_SIZE) and requesting
+# WARMUP_URLS once before the first request. Can be turned off with CARS_WARMUP=0
+app.config.setdefault('WARMUP_ENABLED', os.environ.get('CARS_WARMUP', '1') == '1')
+app.config.setdefault('WARMUP_CONNECTIONS', None)
+app.config.setdefault('WARMUP_URLS', ['/', '/models', '/api/v1/models', '/api/v1/tables'])
+
+# JSON REST API under /api/v1 (see: api.py)
+app.register_blueprint(api.bp)
+
+# Creating the indexes used by the filter queries (see: indexes.py) when the app starts. This is a no-op once they exist
+app.config.setdefault('DB_CREATE_INDEXES', True)
+if app.config['DB_CREATE_INDEXES'] and os.path.exists(cars.DATABASE):
+    try:
+        with cars.pool.connection() as conn:
+            indexes.ensure_indexes(conn)
+    except sqlite3.Error as e:
+        app.logger.error("Error creating indexes: %s", e)
+
+# Creating the full-text search indexes used by /filter_data and /search (see: search.py)
+app.config.setdefault('DB_CREATE_SEARCH_INDEX', True)
+if app.config['DB_CREATE_SEARCH_INDEX'] and os.path.exists(cars.DATABASE):
+    try:
+        with cars.pool.connection() as conn:
+            search.ensure_search_index(conn)
+    except sqlite3.Error as e: # e.g. SQLite compiled without FTS5 -> /filter_data keeps using LIKE
+        app.logger.error("Error creating search index: %s", e)
+
+# Precomputing the monthly sales per model and per dealer for the revenue reports (see: reports.py)
+app.config.setdefault('DB_CREATE_ROLLUPS', True)
+if app.config['DB_CREATE_ROLLUPS'] and os.path.exists(cars.DATABASE):
+    try:
+        with cars.pool.connection() as conn:
+            reports.ensure_rollups(conn)
+    except sqlite3.Error as e:
+        app.logger.error("Error creating report rollups: %s", e)
+
+# Materializing the colors of every model, so /models filters an in-memory index (see: model_colors.py)
+app.config.setdefault('DB_CREATE_MODEL_COLORS', True)
+if app.config['DB_CREATE_MODEL_COLORS'] and os.path.exists(cars.DATABASE):
+    try:
+        with cars.pool.connection() as conn:
+            model_colors.ensure_model_colors(conn)
+    except sqlite3.Error as e:
+        app.logger.error("Error creating model colors: %s", e)
+
+# Row counters of every table, kept up to date by triggers (see: table_stats.py). The tables that get counters for the
+# first time are also analyzed (column statistics and ANALYZE), which reads each of them once
+app.config.setdefault('DB_CREATE_TABLE_STATS', True)
+if app.config['DB_CREATE_TABLE_STATS'] and os.path.exists(cars.DATABASE):
+    try:
+        with cars.pool.connection() as conn:
+            schema = cars.schema_cache.get(conn)
+            added = table_stats.ensure_table_stats(conn, schema)
+            if added:
+                table_stats.analyze(conn, schema, added)
+    except sqlite3.Error as e:
+        app.logger.error("Error creating table statistics: %s", e)
+
+# Change feed (see: change_feed.py): every insert, update and delete of the user tables logged by triggers with a
+# sequence number, read incrementally from /api/v1/changes?since=... or streamed from /api/v1/changes/stream.
+# CHANGE_FEED_POLL_INTERVAL: how often a waiting request checks for new changes; CHANGE_FEED_MAX_WAIT: longest wait
+# of a long-polling request (?wait=); CHANGE_FEED_STREAM_DURATION: an event stream is closed after that many seconds
+# (the browser reconnects and continues from the last event); CHANGE_FEED_RETENTION: seconds the changes are kept by
+# POST /api/v1/changes/compact (None: only the superseded changes are removed); CHANGE_FEED_MAX_WATCHERS: most waiting
+# long-polling requests and open event streams per worker process - each one holds a worker thread while it is open,
+# so this has to stay below the number of threads (see: gunicorn.conf.py). Above it they get '503 Service Unavailable'
+app.config.setdefault('DB_CREATE_CHANGE_FEED', True)
+app.config.setdefault('CHANGE_FEED_MAX_WATCHERS', int(os.environ.get('CARS_CHANGE_FEED_MAX_WATCHERS', 2)))
+app.config.setdefault('CHANGE_FEED_POLL_INTERVAL', 0.5)
+app.config.setdefault('CHANGE_FEED_MAX_WAIT', 30.0)
+app.config.setdefault('CHANGE_FEED_STREAM_DURATION', 300.0)
+app.config.setdefault('CHANGE_FEED_RETENTION', 7 * 24 * 3600)
+if app.config['DB_CREATE_CHANGE_FEED'] and os.path.exists(cars.DATABASE):
+    try:
+        with cars.pool.connection() as conn:
+            change_feed.ensure_change_feed(conn, cars.schema_cache.get(conn))
+    except sqlite3.Error as e:
+        app.logger.error("Error creating change feed: %s", e)
+
+# A trigger is dropped with its table: when the schema changes while the app runs (e.g. a table dropped and created
+# again by another process), the triggers that went missing are created again (see: schema.SchemaCache.listeners)
+def ensure_triggers(conn, schema):
+    try:
+        if app.config['DB_CREATE_TABLE_STATS']:
+            table_stats.ensure_table_stats(conn, schema)
+        if app.config['DB_CREATE_MODEL_COLORS']:
+            model_colors.ensure_model_colors(conn)
+        if app.config['DB_CREATE_CHANGE_FEED']:
+            change_feed.ensure_change_feed(conn, schema)
+    except sqlite3.Error as e:
+        app.logger.error("Error recreating triggers: %s", e)
+
+cars.schema_cache.listeners.append(ensure_triggers)
 
 @app.route('/')
 def index():
@@ -23,9 +178,32 @@ def index():
 
 @app.route('/table/<table_name>')
 def display_table_data(table_name):
-    data = cars.get_table_data(table_name)
     table_names = cars.get_table_names()
-    return render_template('table_data.html', table_names=table_names, table_name=table_name, data=data)
+
+    # ?stream=1 -> rendering the whole table, sending the HTML to the client chunk by chunk while the rows are read. The
+    # rendered rows are kept until the data changes, so the next request sends them without reading the table
+    if request.args.get('stream'):
+        columns = cars.get_table_columns(table_name)
+        render = lambda: table_render.render_rows(cars.iter_table_data(table_name))
+        # (only existing tables get a cache entry)
+        rows_html = fragment_cache.chunks((table_name, cars.data_version()), render) if table_name in table_names else render()
+        return stream_template('table_data.html', table_names=table_names, table_name=table_name, columns=columns, rows_html=rows_html, streamed=True)
+
+    # ?view=scroll -> an empty table filled by the browser from /api/v1/tables/<table_name>?format=rows, showing only
+    # the rows in view however many there are
+    if request.args.get('view') == 'scroll':
+        columns = cars.get_table_columns(table_name)
+        return render_template('table_data.html', table_names=table_names, table_name=table_name, columns=columns, scroll=True,
+                               row_count=cars.get_row_count(table_name))
+
+    # Otherwise -> one page of rows, continuing after the row given by ?after= (and ?after_rowid=)
+    page_size = request.args.get('page_size', app.config['TABLE_PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, app.config['TABLE_MAX_PAGE_SIZE']))
+    after = request.args.get('after')
+    after_rowid = request.args.get('after_rowid', type=int)
+    page = cars.get_table_page(table_name, cars.get_primary_key_columns().get(table_name), page_size, after, after_rowid)
+    return render_template('table_data.html', table_names=table_names, table_name=table_name, columns=page['columns'], rows_html=table_render.render_rows(page['rows']),
+                           page_size=page_size, is_first_page=after is None, next_after=page['next_after'], next_after_rowid=page['next_after_rowid'])
 
 # GET: Used to request data from a specified resource. GET requests should only retrieve data and have no other effect.
 # POST: Used to send data to a server to create or update a resource. The data sent to the server with POST is stored in the request body.
@@ -39,12 +217,13 @@ def add_data():
 
 @app.route('/add_data/<table_name>', methods=['GET', 'POST'])
 def add_table_record(table_name):
-    data = cars.get_table_data(table_name)
     if request.method == 'POST':
         record = request.form.to_dict()
         cars.add_record(table_name, record)
         return redirect(url_for('display_table_data', table_name=table_name))
-    return render_template('add_record.html', table_name=table_name, data=data)
+    columns = cars.get_table_columns(table_name) # Only the column names are needed for the form (from the schema cache, not from the table's rows)
+    table_names = cars.get_table_names()
+    return render_template('add_record.html', table_names=table_names, table_name=table_name, columns=columns)
 
 @app.route('/edit_data', methods=['GET', 'POST'])
 def select_edit_data():
@@ -58,6 +237,7 @@ def select_edit_data():
 # Ensuring that the PK IDs remain unchanged - read-only (see: edit_data.html)
 @app.route('/edit_data/<table_name>/<record_id>', methods=['GET', 'POST'])
 def edit_data(table_name, record_id):
+    primary_key_columns = cars.get_primary_key_columns() # Primary key of every table, read from the cached schema
     if request.method == 'GET':
         record = cars.get_record_by_id(table_name, record_id, primary_key_columns)
         if record:
@@ -73,6 +253,7 @@ def edit_data(table_name, record_id):
 
 @app.route('/update_record/<table_name>/<record_id>', methods=['POST'])
 def update_record_route(table_name, record_id):
+    primary_key_columns = cars.get_primary_key_columns()
     updated_record = request.form.to_dict()
     if cars.update_record(table_name, primary_key_columns[table_name], record_id, updated_record):
         return redirect(url_for('display_table_data', table_name=table_name))
@@ -85,9 +266,13 @@ def delete_data():
     if request.method == 'POST':
         selected_table = request.form.get('table_name')
         record_id = request.form.get('record_id')
-        primary_key_column = primary_key_columns.get(selected_table)
+        primary_key_column = cars.get_primary_key_columns().get(selected_table)
+        record_ids = record_id.replace(',', ' ').split() if record_id else []
 
-        if cars.delete_record(selected_table, primary_key_column, record_id):
+        if len(record_ids) > 1: # Several ids (separated by commas or spaces) -> deleted together, in one statement
+            deleted = cars.delete_records(selected_table, primary_key_column, record_ids)
+            delete_message = f"{deleted} rows have been deleted successfully!" if deleted is not None else "Error deleting rows!"
+        elif cars.delete_record(selected_table, primary_key_column, record_id):
             delete_message = f"Row with ID {record_id} has been deleted successfully!"
         else:
             delete_message = "Error deleting row!"
@@ -109,37 +294,74 @@ def filter_data():
         model_name = request.form.get('model_name')
         model_price = request.form.get('model_price')
         dealer_name = request.form.get('dealer_name')
+        # 'words' -> matching the beginning of words through the search index, 'anywhere' -> matching anywhere in the text (LIKE)
+        use_search_index = None if request.form.get('match', 'words') == 'words' else False
 
-        # Custom SQL query to filter data based on provided inputs
-        query = """
-            SELECT Customers.first_name, Customers.last_name
-            FROM Customers
-            JOIN Customer_Ownership ON Customers.customer_id = Customer_Ownership.customer_id
-            JOIN Car_Vins on Customer_Ownership.vin=Car_Vins.vin
-            JOIN Models ON Car_Vins.model_id = Models.model_id
-            JOIN Dealers ON Customer_Ownership.dealer_id = Dealers.dealer_id
-            WHERE 1=1
-        """
-        params = {}
-
-        if customer_name:
-            query += " AND Customers.first_name LIKE :customer_name"
-            params['customer_name'] = f'%{customer_name}%'
-        if model_name:
-            query += " AND Models.model_name LIKE :model_name"
-            params['model_name'] = f'%{model_name}%'
-        if model_price:
-            query += " AND Customer_Ownership.purchase_price > :model_price"
-            params['model_price'] = model_price
-        if dealer_name:
-            query += " AND Dealers.dealer_name LIKE :dealer_name"
-            params['dealer_name'] = f'%{dealer_name}%'
-
-        # Execute the query
-        results = cars.execute_custom_query(query, params)
+        results = cars.filter_customers(customer_name, model_name, model_price, dealer_name, use_search_index)
 
     return render_template('filter_data.html', table_names=table_names, results=results)
 
+# JSON search over customer, model and dealer names: /search?q=ferr&kind=models&limit=10 (best matches first)
+@app.route('/search')
+def search_names():
+    text = request.args.get('q', '')
+    kinds = [kind for kind in request.args.getlist('kind') if kind in search.SEARCH_TABLES] or None
+    limit = max(1, min(request.args.get('limit', 20, type=int), 200))
+    return jsonify(cars.search_names(text, kinds, limit))
+
+######################################################## BULK IMPORT / EXPORT ########################################################
+# POST /import/<table_name>?format=csv|ndjson&batch_size=1000 with the file in the 'file' form field, or as the raw body.
+# The upload is read row by row and inserted in batches; the response lists the rows that were rejected and why
+@app.route('/import/<table_name>', methods=['POST'])
+def import_data(table_name):
+    if table_name not in cars.get_table_names():
+        return jsonify({'error': f"Unknown table: {table_name}"}), 404
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    fmt = request.args.get('format')
+    if fmt is None: # Guessing the format from the file name or the content type
+        name = (upload.filename if upload else '') or ''
+        fmt = 'ndjson' if name.endswith(('.ndjson', '.jsonl')) or 'json' in (request.mimetype or '') else 'csv'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': f"Unsupported import format: {fmt}"}), 400
+    records = bulk.iter_csv(stream) if fmt == 'csv' else bulk.iter_ndjson(stream)
+    batch_size = max(1, request.args.get('batch_size', app.config['BULK_BATCH_SIZE'], type=int))
+    report = cars.import_records(table_name, records, batch_size)
+    return jsonify(report), 200 if not report['failed'] else 207 # 207: some rows were rejected
+
+# Streaming the exported rows as a file download
+def export_response(export, name):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk.EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported export format: {fmt}"}), 400
+    chunks = export(fmt, app.config['BULK_BATCH_SIZE']) # Generator: the rows are read while the response is being sent
+    extension = 'csv' if fmt == 'csv' else 'ndjson'
+    return Response(stream_with_context(chunks), mimetype=bulk.EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{name}.{extension}"'})
+
+# GET /export/table/<table_name>?format=csv|ndjson|columnar
+@app.route('/export/table/<table_name>')
+def export_table(table_name):
+    if table_name not in cars.get_table_names():
+        return jsonify({'error': f"Unknown table: {table_name}"}), 404
+    return export_response(lambda fmt, batch_size: cars.export_table(table_name, fmt, batch_size), table_name)
+
+# Filter results that can be exported: name -> (query builder, filter parameters)
+EXPORT_QUERIES = {
+    'customers': (cars.build_customers_query, ['brand', 'dealer', 'purchase_price', 'model']), # Same filters as /customers
+    'models': (cars.build_models_query, ['car_color', 'brand', 'price']), # Same filters as /models
+    'filter_data': (cars.build_filter_query, ['customer_name', 'model_name', 'model_price', 'dealer_name']), # Same fields as /filter_data
+}
+
+# GET /export/<query_name>?<filters>&format=csv|ndjson|columnar, e.g. /export/customers?brand=Ferrari&format=ndjson
+@app.route('/export/<query_name>')
+def export_filter_results(query_name):
+    if query_name not in EXPORT_QUERIES:
+        return jsonify({'error': f"Unknown export: {query_name}"}), 404
+    builder, filter_names = EXPORT_QUERIES[query_name]
+    query, params = builder(**{name: request.args.get(name) for name in filter_names})
+    return export_response(lambda fmt, batch_size: cars.export_query(query, params, fmt, batch_size), query_name)
+
 ######################################################## FILTERING ######################################################## 
 # CRUD for Customers
 
@@ -162,6 +384,38 @@ def models():
     models = cars.get_models(car_color, brand, price)
     return render_template('models.html', models=models)
 
+# Pool metrics: checkouts, waits for a free connection, wait times, open/idle/in-use connections
+@app.route('/pool_stats')
+def pool_stats():
+    return jsonify(cars.pool.stats())
+
+# Result cache metrics: hits, misses, evictions, expirations, invalidations (writes) and the current data version
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(cars.result_cache.stats())
+
+# Table statistics (see: table_stats.py): row count and largest key of every table, or with ?table=<table_name> the
+# statistics of one table and of its columns (distinct values, NULLs, smallest and largest value)
+@app.route('/stats')
+def table_statistics():
+    table_name = request.args.get('table')
+    stats = cars.get_table_stats(table_name)
+    if stats is None:
+        return jsonify({'error': f"Unknown table: {table_name}" if table_name else "No table statistics (set DB_CREATE_TABLE_STATS)"}), 404
+    return jsonify(stats)
+
+# Write queue metrics: committed and failed writes, number of batches (commits) and writes per batch
+@app.route('/write_stats')
+def write_stats():
+    return jsonify(cars.writer.stats())
+
+# Request, SQL, pool, template and JSON timings in the Prometheus text format (404 when the metrics are disabled)
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({'error': "Metrics are disabled (set METRICS_ENABLED)"}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,137 @@
+# ---------------------------- Async (ASGI) entry point ----------------------------
+# Serving the read endpoints of the JSON API (/api/v1/...) and /search from an event loop, with the database calls
+# running in the bounded worker threads of aiocars.py. Every other URL is passed on to the Flask app (see: app.py)
+# when asgiref is installed. Run it with any ASGI server, e.g.:
+#   uvicorn asgi:application --workers 4
+#   hypercorn asgi:application
+import hashlib
+import re
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_etags
+
+import aiocars
+import api
+import cars
+from app import app as flask_app
+
+# The worker threads follow the connection pool size configured by the Flask app
+aiocars.configure(cars.pool.size)
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    flask_fallback = WsgiToAsgi(flask_app)
+except ImportError:
+    flask_fallback = None
+
+
+# ---------------------------- Route handlers ----------------------------
+# Each handler gets the URL parameters and a dictionary of query parameters, and returns (status, data)
+async def list_customers(query):
+    return 200, {'items': await aiocars.get_customers(query.get('brand'), query.get('dealer'), query.get('purchase_price'), query.get('model'))}
+
+async def list_models(query):
+    return 200, {'items': await aiocars.get_models(query.get('car_color'), query.get('brand'), query.get('price'))}
+
+async def list_tables(query):
+    schema = await aiocars.get_schema()
+    primary_keys = await aiocars.get_primary_key_columns()
+    return 200, {'items': [{'name': name, 'columns': table['columns'], 'primary_key': primary_keys[name]} for name, table in schema.items()]}
+
+async def list_rows(query, table_name):
+    primary_keys = await aiocars.get_primary_key_columns()
+    if table_name not in primary_keys:
+        return 404, {'error': f"Unknown table: {table_name}"}
+    try:
+        page_size = max(1, min(int(query.get('page_size', 100)), 5000))
+        after_rowid = int(query['after_rowid']) if 'after_rowid' in query else None
+    except ValueError:
+        return 400, {'error': "page_size and after_rowid must be integers"}
+    page = await aiocars.get_table_page(table_name, primary_keys[table_name], page_size, query.get('after'), after_rowid)
+    next_page = None
+    if page['next_after'] is not None:
+        next_page = {'after': page['next_after'], 'after_rowid': page['next_after_rowid']}
+    if query.get('format') == 'rows': # As in api.py (used by the scroll view of /table/<table_name>)
+        return 200, {'columns': page['columns'], 'rows': [list(row.values()) for row in page['rows']], 'next': next_page}
+    return 200, {'items': page['rows'], 'next': next_page}
+
+async def get_row(query, table_name, record_id):
+    primary_keys = await aiocars.get_primary_key_columns()
+    if table_name not in primary_keys:
+        return 404, {'error': f"Unknown table: {table_name}"}
+    record = await aiocars.get_record_by_id(table_name, record_id, primary_keys)
+    if record is None:
+        return 404, {'error': "Record not found"}
+    return 200, record
+
+async def get_resource_row(query, resource, record_id):
+    return await get_row(query, api.RESOURCES[resource], record_id)
+
+async def search_names(query):
+    try:
+        limit = max(1, min(int(query.get('limit', 20)), 200))
+    except ValueError:
+        return 400, {'error': "limit must be an integer"}
+    return 200, await aiocars.search_names(query.get('q', ''), None, limit)
+
+# (regular expression of the path, handler) - only GET requests are served here
+ROUTES = [
+    (re.compile(r'^/api/v1/customers$'), list_customers),
+    (re.compile(r'^/api/v1/models$'), list_models),
+    (re.compile(r'^/api/v1/tables$'), list_tables),
+    (re.compile(r'^/api/v1/tables/([^/]+)$'), list_rows),
+    (re.compile(r'^/api/v1/tables/([^/]+)/([^/]+)$'), get_row),
+    (re.compile(r'^/api/v1/(customers|models)/([^/]+)$'), get_resource_row),
+    (re.compile(r'^/search$'), search_names),
+]
+
+
+# ---------------------------- Defining a new function named 'send_response' ----------------------------
+async def send_response(send, status, body=b'', headers=()):
+    headers = [(b'content-length', str(len(body)).encode())] + [(name.encode(), value.encode()) for name, value in headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# ---------------------------- Defining a new function named 'application' ----------------------------
+# The ASGI application
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan': # Server startup / shutdown
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                aiocars.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        for pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match is None:
+                continue
+            query = {name: values[-1] for name, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+            # Conditional GET, as in api.py: answering 304 without running the query if the data did not change. The
+            # data version reads the database files, so it runs in a worker thread like the queries
+            full_path = scope['path'] + '?' + scope.get('query_string', b'').decode('latin-1')
+            version = await aiocars.run(cars.data_version)
+            tag = hashlib.sha1(f"{version}|{full_path}".encode('utf-8')).hexdigest()
+            etag = 'W/"' + tag + '"'
+            request_headers = dict(scope.get('headers', []))
+            # (the header is a list of ETags, each compared as a whole, ignoring the weak prefix)
+            if parse_etags(request_headers.get(b'if-none-match', b'').decode('latin-1')).contains_weak(tag):
+                await send_response(send, 304, headers=[('etag', etag)])
+                return
+            status, data = await handler(query, *match.groups())
+            headers = [('content-type', 'application/json')]
+            if status == 200:
+                headers += [('etag', etag), ('cache-control', 'no-cache')]
+            await send_response(send, status, api.dumps(data), headers)
+            return
+
+    if flask_fallback is not None:
+        await flask_fallback(scope, receive, send)
+    else:
+        await send_response(send, 404, api.dumps({'error': "Not found (install asgiref to serve the HTML pages from the ASGI app)"}),
+                            [('content-type', 'application/json')])
@@ -0,0 +1,100 @@
+# Comparing the throughput of the synchronous Flask app (one thread per concurrent request) and the ASGI entry point
+# (one event loop, database calls in the bounded aiocars worker threads) for concurrent JSON API requests.
+# The result cache is switched off, so every request runs its query.
+#
+#   python benchmarks/bench_async.py --requests 2000 --concurrency 32 [--json results.json]
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Making the app modules importable
+
+import cars
+from asgi import application
+from app import app
+
+# URLs requested in turn
+URLS = [
+    '/api/v1/customers?brand={brand}',
+    '/api/v1/models?brand={brand}',
+    '/api/v1/tables/Customers?page_size=100',
+    '/api/v1/customers?dealer={dealer}&purchase_price=20000',
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summary(mode, latencies, elapsed):
+    return {'mode': mode, 'requests': len(latencies), 'seconds': elapsed, 'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000}
+
+
+# ---------------------------- Defining a new function named 'run_sync' ----------------------------
+# Sending the requests to the Flask app from 'concurrency' threads (like a threaded WSGI server)
+def run_sync(urls, concurrency):
+    def request(url):
+        started = time.perf_counter()
+        response = app.test_client().get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(request, urls))
+    return summary('sync', latencies, time.perf_counter() - started)
+
+
+# ---------------------------- Defining a new function named 'run_async' ----------------------------
+# Sending the requests to the ASGI app, at most 'concurrency' at a time, from a single event loop
+async def run_async(urls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(url):
+        parts = urlsplit(url)
+        scope = {'type': 'http', 'method': 'GET', 'path': parts.path, 'query_string': parts.query.encode(), 'headers': []}
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        async with semaphore:
+            started = time.perf_counter()
+            await application(scope, receive, send)
+            assert status == [200], (url, status)
+            return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(request(url) for url in urls))
+    return summary('async', list(latencies), time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+
+    cars.result_cache.enabled = False
+    brand = cars.execute_custom_query("SELECT brand_name FROM Brands LIMIT 1;", {})[0]['brand_name']
+    dealer = cars.execute_custom_query("SELECT dealer_name FROM Dealers LIMIT 1;", {})[0]['dealer_name']
+    urls = [URLS[i % len(URLS)].format(brand=brand, dealer=dealer) for i in range(args.requests)]
+
+    results = [run_sync(urls, args.concurrency), asyncio.run(run_async(urls, args.concurrency))]
+    for result in results:
+        print(f"{result['mode']:<6} {result['requests_per_second']:>8.1f} req/s   p50 {result['p50_ms']:>7.2f}ms   p99 {result['p99_ms']:>7.2f}ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'database': cars.DATABASE, 'concurrency': args.concurrency, 'results': results}, f, indent=2)
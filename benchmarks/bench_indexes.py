@@ -0,0 +1,115 @@
+# Measuring the filter queries (every filter combination of /customers, /models and /filter_data) on a scaled-up copy
+# of the database, first without and then with the indexes from indexes.py, and printing p50/p99 latencies.
+#
+#   python benchmarks/bench_indexes.py --scale 50 --repeat 20 [--json results.json]
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Making the app modules importable
+
+import cars
+import indexes
+from schema import load_schema
+
+# Tables that are multiplied when scaling up, with the key columns that have to be shifted to stay unique
+SCALED_TABLES = {
+    'Customers': ['customer_id'],
+    'Car_Vins': ['vin'],
+    'Customer_Ownership': ['customer_id', 'vin'],
+}
+
+
+# ---------------------------- Defining a new function named 'scale_database' ----------------------------
+# Copying the customers, VINs and ownerships 'factor' times, shifting their ids so they stay unique
+def scale_database(conn, factor):
+    schema = load_schema(conn)
+    max_customer = conn.execute("SELECT MAX(customer_id) FROM Customers;").fetchone()[0]
+    max_vin = conn.execute("SELECT MAX(vin) FROM Car_Vins;").fetchone()[0]
+    offsets = {'customer_id': max_customer, 'vin': max_vin}
+    for copy in range(1, factor):
+        for table_name, keys in SCALED_TABLES.items():
+            columns = schema[table_name]['columns']
+            select = ', '.join(f"{column} + {offsets[column] * copy}" if column in keys else column for column in columns)
+            conn.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) SELECT {select} FROM {table_name} WHERE {keys[0]} <= {offsets[keys[0]]};")
+    conn.commit()
+
+
+# ---------------------------- Defining a new function named 'sample_filters' ----------------------------
+# Picking real values from the database for every filter, so the timed queries return rows
+def sample_filters(conn):
+    def one(sql):
+        row = conn.execute(sql).fetchone()
+        return row[0] if row else None
+    price = one("SELECT purchase_price FROM Customer_Ownership ORDER BY purchase_price LIMIT 1 OFFSET (SELECT COUNT(*) * 9 / 10 FROM Customer_Ownership);")
+    brand = one("SELECT brand_name FROM Brands ORDER BY brand_id LIMIT 1;")
+    dealer = one("SELECT dealer_name FROM Dealers ORDER BY dealer_id LIMIT 1;")
+    model = one("SELECT model_name FROM Models ORDER BY model_id LIMIT 1;")
+    color = one("SELECT color FROM Car_Options ORDER BY option_set_id LIMIT 1;")
+    base_price = one("SELECT model_base_price FROM Models ORDER BY model_base_price LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM Models);")
+    first_name = one("SELECT first_name FROM Customers ORDER BY customer_id LIMIT 1;")
+    return {
+        'customers': {'brand': brand, 'dealer': dealer, 'purchase_price': price, 'model': model},
+        'models': {'car_color': color, 'brand': brand, 'price': base_price},
+        'filter_data': {'customer_name': first_name, 'model_name': model, 'model_price': price, 'dealer_name': dealer},
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# ---------------------------- Defining a new function named 'time_queries' ----------------------------
+# Running every filter combination 'repeat' times and returning {'<endpoint> <filters>': {'p50_ms', 'p99_ms'}}
+def time_queries(conn, repeat):
+    samples = sample_filters(conn)
+    results = {}
+    for endpoint, filters in indexes.filter_combinations():
+        builder = indexes.SAMPLE_FILTERS[endpoint][0]
+        query, params = builder(**{name: samples[endpoint][name] for name in filters})
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            conn.execute(query, params).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        results[f"{endpoint} {','.join(sorted(filters)) or '-'}"] = {'p50_ms': percentile(timings, 0.50), 'p99_ms': percentile(timings, 0.99)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=cars.DATABASE, help='database to copy (default: the app database)')
+    parser.add_argument('--scale', type=int, default=20, help='how many times the customers/ownerships are multiplied')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per query')
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'bench.db')
+        shutil.copy(args.database, path)
+        conn = sqlite3.connect(path)
+        indexes.drop_indexes(conn)
+        scale_database(conn, args.scale)
+        rows = conn.execute("SELECT COUNT(*) FROM Customer_Ownership;").fetchone()[0]
+        print(f"Customer_Ownership rows: {rows}")
+
+        before = time_queries(conn, args.repeat)
+        indexes.ensure_indexes(conn)
+        after = time_queries(conn, args.repeat)
+        conn.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    print(f"{'query':<60} {'p50 before':>11} {'p50 after':>10} {'p99 before':>11} {'p99 after':>10}")
+    for name in before:
+        print(f"{name:<60} {before[name]['p50_ms']:>9.2f}ms {after[name]['p50_ms']:>8.2f}ms {before[name]['p99_ms']:>9.2f}ms {after[name]['p99_ms']:>8.2f}ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'rows': rows, 'before': before, 'after': after}, f, indent=2)
@@ -0,0 +1,210 @@
+# Driving every page of the app through the Flask test client (listing tables, /customers, /models, /filter_data, add,
+# edit and delete) against a generated database, and recording throughput, latency percentiles and peak memory per
+# route to JSON. Runs from two commits can be compared with --compare.
+#
+#   python benchmarks/bench_routes.py --ownerships 1e5 --requests 200 --json before.json
+#   (apply a change)
+#   python benchmarks/bench_routes.py --ownerships 1e5 --requests 200 --json after.json --compare before.json
+#
+# --database runs against a copy of an existing database instead (the benchmark writes to it).
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT) # Making the app modules importable
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_db import generate_database
+
+# (name, method, URL, form data) - '{...}' is replaced by values read from the database (see: sample_values), '{n}' by
+# the number of the request. The writes come last, and 'delete' removes the customers created by 'add'.
+ROUTES = [
+    ('index', 'GET', '/', None),
+    ('table_customers', 'GET', '/table/Customers', None),
+    ('table_ownership', 'GET', '/table/Customer_Ownership', None),
+    ('table_ownership_page', 'GET', '/table/Customer_Ownership?after={ownership_after}&after_rowid={ownership_rowid}', None),
+    ('table_ownership_stream', 'GET', '/table/Customer_Ownership?stream=1', None),
+    ('api_ownership_rows', 'GET', '/api/v1/tables/Customer_Ownership?format=rows&page_size=1000', None),
+    ('customers_brand', 'GET', '/customers?brand={rare_brand}', None),
+    ('customers_dealer_price', 'GET', '/customers?dealer={dealer}&purchase_price={price}', None),
+    ('models', 'GET', '/models', None),
+    ('models_color_brand', 'GET', '/models?car_color={color}&brand={brand}', None),
+    ('filter_data', 'POST', '/filter_data', {'customer_name': '{first_name}', 'model_name': '{model}', 'model_price': '{price}', 'dealer_name': '', 'match': 'words'}),
+    ('filter_data_anywhere', 'POST', '/filter_data', {'customer_name': '', 'model_name': '', 'model_price': '', 'dealer_name': '{dealer}', 'match': 'anywhere'}),
+    ('edit_form', 'GET', '/edit_data/Customers/{customer_id}', None),
+    ('add', 'POST', '/add_data/Customers', {'first_name': 'Bench', 'last_name': 'Mark{n}', 'gender': 'F', 'household_income': '50000',
+                                            'birthdate': '1980-01-01', 'phone_number': '5550000000', 'email': 'bench{n}@example.com'}),
+    ('edit', 'POST', '/edit_data/Customers/{customer_id}', {'first_name': 'Edited{n}'}),
+    ('delete', 'POST', '/delete_data', {'table_name': 'Customers', 'record_id': '{added_id}'}),
+]
+
+
+# ---------------------------- Defining a new function named 'sample_values' ----------------------------
+# Picking real values for the URLs and forms, so the filters return rows
+def sample_values(path):
+    conn = sqlite3.connect(path)
+    def one(sql):
+        row = conn.execute(sql).fetchone()
+        return row[0] if row else ''
+    values = {
+        'brand': one("SELECT brand_name FROM Brands ORDER BY brand_id LIMIT 1;"),
+        'rare_brand': one("SELECT brand_name FROM Brands ORDER BY brand_id DESC LIMIT 1;"),
+        'dealer': one("SELECT dealer_name FROM Dealers ORDER BY dealer_id LIMIT 1;"),
+        'model': one("SELECT model_name FROM Models ORDER BY model_id LIMIT 1;").split(' ')[0],
+        'color': one("SELECT color FROM Car_Options ORDER BY option_set_id LIMIT 1;"),
+        'first_name': one("SELECT first_name FROM Customers ORDER BY customer_id LIMIT 1;"),
+        'price': one("SELECT purchase_price FROM Customer_Ownership ORDER BY rowid LIMIT 1;"),
+        'customer_id': one("SELECT customer_id FROM Customers ORDER BY customer_id LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM Customers);"),
+        'max_customer_id': one("SELECT MAX(customer_id) FROM Customers;"),
+    }
+    # A page from the middle of the biggest table (keyset pagination, see: cars.get_table_page)
+    middle = conn.execute("SELECT customer_id, rowid FROM Customer_Ownership ORDER BY customer_id, rowid LIMIT 1 "
+                          "OFFSET (SELECT COUNT(*) / 2 FROM Customer_Ownership);").fetchone()
+    values['ownership_after'], values['ownership_rowid'] = middle if middle else ('', '')
+    conn.close()
+    return values
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# ---------------------------- Defining a new function named 'run_route' ----------------------------
+# Sending 'requests' requests to one route (after 'warmup' untimed ones) and measuring them; then sending a few more
+# under tracemalloc for the peak memory (tracemalloc slows Python down, so they are not part of the timings)
+def run_route(client, route, values, requests, warmup, memory_requests=3):
+    name, method, url, form = route
+
+    def send(n):
+        params = dict(values, n=n, added_id=values['max_customer_id'] + 1 + n)
+        data = {key: value.format(**params) for key, value in form.items()} if form else None
+        response = client.open(url.format(**params), method=method, data=data)
+        response.get_data() # Reading the body, so streamed responses are rendered as well
+        if response.status_code >= 400:
+            raise RuntimeError(f"{name}: {method} {url} returned {response.status_code}")
+
+    # The writes number their requests across the warmup, timed and memory runs, so each one hits a different row
+    numbers = iter(range(warmup + requests + memory_requests))
+    for _ in range(warmup):
+        send(next(numbers))
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        send(next(numbers))
+        latencies.append(time.perf_counter() - request_started)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    for _ in range(memory_requests):
+        send(next(numbers))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'requests': requests,
+        'requests_per_second': requests / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ---------------------------- Defining a new function named 'compare' ----------------------------
+# Printing the p50 / p99 latencies of a previous run next to the current ones (routes more than 10% slower are marked)
+def compare(baseline, results):
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    print(f"{'route':<24} {'p50 before':>11} {'p50 now':>10} {'p99 before':>11} {'p99 now':>10} {'change':>8}")
+    for name, now in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        change = now['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+        flag = '  slower' if change > 0.10 else ''
+        print(f"{name:<24} {before['p50_ms']:>9.2f}ms {now['p50_ms']:>8.2f}ms {before['p99_ms']:>9.2f}ms {now['p99_ms']:>8.2f}ms {change:>+7.0%}{flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', help='existing database to copy (default: generate one)')
+    parser.add_argument('--ownerships', type=float, default=100000, help='size of the generated database (Customer_Ownership rows)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=100, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--routes', help='comma-separated route names (default: all)')
+    parser.add_argument('--cache', action='store_true', help='keep the result cache on (by default every request runs its queries)')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'bench.db')
+        if args.database:
+            shutil.copy(args.database, path)
+        else:
+            generate_database(path, int(args.ownerships), args.seed)
+        values = sample_values(path)
+
+        # The app reads the database path when it is imported
+        os.environ['CARS_DATABASE'] = path
+        import cars
+        from app import app
+        app.template_folder = ROOT
+        cars.result_cache.enabled = args.cache
+        client = app.test_client()
+
+        conn = sqlite3.connect(path)
+        tables = {table_name: conn.execute(f'SELECT COUNT(*) FROM "{table_name}";').fetchone()[0] for table_name in cars.get_table_names()}
+        conn.close()
+
+        selected = set(args.routes.split(',')) if args.routes else None
+        results = {
+            'commit': git_commit(),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'database': {'generated': not args.database, 'seed': args.seed, 'tables': tables},
+            'settings': {'requests': args.requests, 'warmup': args.warmup, 'cache': args.cache},
+            'routes': {},
+        }
+        print(f"{'route':<24} {'req/s':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'peak mem':>10}")
+        for route in ROUTES:
+            if selected and route[0] not in selected:
+                continue
+            result = run_route(client, route, values, args.requests, args.warmup)
+            results['routes'][route[0]] = result
+            print(f"{route[0]:<24} {result['requests_per_second']:>9.1f} {result['p50_ms']:>7.2f}ms {result['p90_ms']:>7.2f}ms "
+                  f"{result['p99_ms']:>7.2f}ms {result['peak_memory_kb']:>8.0f}KB")
+        results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Kilobytes on Linux
+        cars.pool.close_all()
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,181 @@
+# Measuring how fast a new worker process can take requests, and how much memory it does not share with the others:
+#   - 'cold':    a new Python process importing the app with the warm-up turned off (CARS_WARMUP=0), like one worker
+#                of 'python app.py' or of a server without preload_app
+#   - 'warm':    the same, with the warm-up (see: warmup.py) run when the app is imported
+#   - 'preload': workers forked from a master process that loaded and warmed up the app once (gunicorn's preload_app,
+#                see: gunicorn.conf.py), with the same before_fork / after_fork hooks
+# For each worker: the time until it is ready (from the start of the process, or from the fork), the latency of its
+# first request to each URL, and its memory (RSS, PSS and private memory, from /proc/self/smaps_rollup on Linux).
+#
+#   python benchmarks/bench_startup.py --ownerships 1e5 --workers 4 --json startup.json
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT) # Making the app modules importable
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_db import generate_database
+
+# First requests of a new worker
+URLS = ['/', '/models', '/api/v1/models', '/table/Customers', '/api/v1/tables/Customer_Ownership?page_size=100', '/search?q=a']
+MODES = ('cold', 'warm', 'preload')
+
+
+# Returning the memory of this process in KB ({} where /proc/self/smaps_rollup does not exist)
+def memory():
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = {line.split(':')[0]: int(line.split()[1]) for line in f if line.split()[-1] == 'kB'}
+    except OSError:
+        return {}
+    return {'rss_kb': fields['Rss'], 'pss_kb': fields['Pss'], 'private_kb': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+# Importing the app the way wsgi.py does (the templates are in the root of the repository)
+def load_app():
+    from app import app
+    app.template_folder = ROOT
+    import wsgi
+    return wsgi.application
+
+
+# ---------------------------- Defining a new function named 'first_requests' ----------------------------
+# Sending the first request to each URL and returning the worker's report
+def first_requests(application, ready_seconds):
+    latencies = {}
+    client = application.test_client()
+    for url in URLS:
+        started = time.perf_counter()
+        response = client.get(url)
+        response.get_data()
+        latencies[url] = (time.perf_counter() - started) * 1000
+        if response.status_code >= 400:
+            raise RuntimeError(f"{url} returned {response.status_code}")
+    return {'ready_ms': ready_seconds * 1000, 'first_request_ms': latencies, **memory()}
+
+
+# ---------------------------- Worker and master processes ----------------------------
+# A worker started as a new process ('cold' and 'warm'). CARS_BENCH_STARTED is the time the parent started it
+def run_worker():
+    application = load_app()
+    report = first_requests(application, time.time() - float(os.environ['CARS_BENCH_STARTED']))
+    print(json.dumps(report))
+
+
+# A master loading the app once, then forking the workers one after the other (as gunicorn does)
+def run_master(workers):
+    import warmup
+    started = time.time()
+    application = load_app()
+    reports = {'master_ready_ms': (time.time() - float(os.environ['CARS_BENCH_STARTED'])) * 1000,
+               'master_load_ms': (time.time() - started) * 1000, 'workers': []}
+    for _ in range(workers):
+        warmup.before_fork()
+        read_end, write_end = os.pipe()
+        forked = time.time()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            warmup.after_fork(application)
+            report = first_requests(application, time.time() - forked)
+            with os.fdopen(write_end, 'w') as f:
+                f.write(json.dumps(report))
+            os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            reports['workers'].append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+    print(json.dumps(reports))
+
+
+# Running this script as a new process with 'args' and returning what it printed last (the JSON report)
+def spawn(args, path, warm):
+    env = dict(os.environ, CARS_DATABASE=path, CARS_WARMUP='1' if warm else '0', CARS_BENCH_STARTED=repr(time.time()))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__)] + args, env=env, cwd=ROOT, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+# ---------------------------- Defining a new function named 'summarize' ----------------------------
+# Averaging the reports of the workers of one mode
+def summarize(reports):
+    def average(values):
+        values = list(values)
+        return sum(values) / len(values) if values else 0.0
+    summary = {name: average(report[name] for report in reports if name in report) for name in ('ready_ms', 'rss_kb', 'pss_kb', 'private_kb')}
+    summary['first_request_ms'] = {url: average(report['first_request_ms'][url] for report in reports) for url in URLS}
+    summary['first_requests_total_ms'] = sum(summary['first_request_ms'].values())
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', help='existing database to copy (default: generate one)')
+    parser.add_argument('--ownerships', type=float, default=100000, help='size of the generated database (Customer_Ownership rows)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=4, help='workers started per mode')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma-separated modes (default: all)')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS) # (internal: run as one worker)
+    parser.add_argument('--master', action='store_true', help=argparse.SUPPRESS) # (internal: run as the preloading master)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker()
+        sys.exit()
+    if args.master:
+        run_master(args.workers)
+        sys.exit()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'bench.db')
+        if args.database:
+            shutil.copy(args.database, path)
+        else:
+            generate_database(path, int(args.ownerships), args.seed)
+        spawn(['--worker'], path, warm=False) # Creating the indexes, search index, rollups... once, outside of the timings
+
+        results = {
+            'commit': git_commit(),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'settings': {'workers': args.workers, 'ownerships': args.ownerships if not args.database else None},
+            'modes': {},
+        }
+        print(f"{'mode':<10} {'ready':>10} {'first requests':>15} {'RSS':>10} {'PSS':>10} {'private':>10}")
+        for mode in args.modes.split(','):
+            if mode == 'preload':
+                master = spawn(['--master', '--workers', str(args.workers)], path, warm=True)
+                summary = summarize(master['workers'])
+                summary['master_ready_ms'] = master['master_ready_ms']
+            else:
+                summary = summarize([spawn(['--worker'], path, warm=mode == 'warm') for _ in range(args.workers)])
+            results['modes'][mode] = summary
+            print(f"{mode:<10} {summary['ready_ms']:>8.1f}ms {summary['first_requests_total_ms']:>13.1f}ms {summary['rss_kb']:>8.0f}KB "
+                  f"{summary['pss_kb']:>8.0f}KB {summary['private_kb']:>8.0f}KB")
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,87 @@
+# Comparing concurrent writes (add_record + update_record from many threads) committed one by one through the pool
+# with the same writes going through the group-commit write queue (see: writer.py). Prints writes per second, latency
+# percentiles, failed writes and, for the queue, the average number of writes per commit.
+#
+#   python benchmarks/bench_writes.py --threads 32 --writes 200 [--synchronous FULL] [--json results.json]
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Making the app modules importable
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_db import generate_database
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# ---------------------------- Defining a new function named 'run_writers' ----------------------------
+# 'threads' threads each adding 'writes' customers and updating each one right after adding it
+def run_writers(cars, threads, writes):
+    def writer(thread):
+        latencies, failed = [], 0
+        for n in range(writes):
+            started = time.perf_counter()
+            customer_id = cars.add_record('Customers', {'first_name': f"Writer{thread}", 'last_name': f"N{n}"})
+            if customer_id is None or not cars.update_record('Customers', 'customer_id', customer_id, {'email': f"w{thread}.{n}@example.com"}):
+                failed += 1
+            latencies.append(time.perf_counter() - started)
+        return latencies, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(writer, range(threads)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for thread_latencies, _ in results for latency in thread_latencies]
+    return {
+        'writes_per_second': 2 * len(latencies) / elapsed, # Each iteration is an INSERT and an UPDATE
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'failed': sum(failed for _, failed in results),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--writes', type=int, default=200, help='add + update pairs per thread')
+    parser.add_argument('--synchronous', default='NORMAL', help='PRAGMA synchronous for the run (FULL makes every commit wait for the disk)')
+    parser.add_argument('--flush-delay', type=float, default=0.0)
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'bench.db')
+        generate_database(path, 10000)
+        os.environ['CARS_DATABASE'] = path # Read by cars when it is imported
+        import cars
+        cars.pool.size = args.threads # One connection per thread: measuring the write lock, not the pool
+        cars.pool.pragmas['synchronous'] = args.synchronous
+        cars.result_cache.enabled = False
+
+        cars.writer.enabled = False
+        direct = run_writers(cars, args.threads, args.writes)
+        cars.writer.enabled = True
+        cars.writer.flush_delay = args.flush_delay
+        queued = run_writers(cars, args.threads, args.writes)
+        queued['writes_per_commit'] = cars.writer.stats()['writes_per_batch']
+        cars.writer.close()
+        cars.pool.close_all()
+    finally:
+        shutil.rmtree(workdir)
+
+    for mode, result in (('direct', direct), ('queue', queued)):
+        print(f"{mode:<7} {result['writes_per_second']:>9.1f} writes/s   p50 {result['p50_ms']:>7.2f}ms   p99 {result['p99_ms']:>8.2f}ms   "
+              f"failed {result['failed']}" + (f"   {result['writes_per_commit']:.1f} writes/commit" if 'writes_per_commit' in result else ''))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'threads': args.threads, 'writes': args.writes, 'synchronous': args.synchronous, 'direct': direct, 'queue': queued}, f, indent=2)
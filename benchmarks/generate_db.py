@@ -0,0 +1,204 @@
+# Building a synthetic database with the same tables and columns as the sample Car_Database.db, at any scale, so the
+# benchmarks do not depend on the small sample file. The size is given as the number of Customer_Ownership rows
+# (10^4 ... 10^8); every other table grows with it. Brands, models and dealers are skewed (a few popular ones get most of
+# the sales, like in real data), and the same seed always produces the same database.
+#
+#   python benchmarks/generate_db.py /tmp/cars_1m.db --ownerships 1000000 [--seed 1]
+#
+# It writes roughly 70,000 ownerships (plus their VINs and customers) per second, so 10^8 ownerships take about half an
+# hour and need roughly 15 GB of disk.
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+
+# Same tables and columns as the sample database (https://github.com/dtaivpp/car_company_database)
+SCHEMA = """
+CREATE TABLE Brands (brand_id INTEGER PRIMARY KEY, brand_name TEXT);
+CREATE TABLE Models (model_id INTEGER PRIMARY KEY, model_name TEXT, model_base_price INTEGER, brand_id INTEGER REFERENCES Brands(brand_id));
+CREATE TABLE Car_Options (option_set_id INTEGER PRIMARY KEY, model_id INTEGER REFERENCES Models(model_id), engine_id INTEGER, transmission_id INTEGER, chassis_id INTEGER, premium_sound_id INTEGER, color TEXT, option_set_price INTEGER);
+CREATE TABLE Manufacture_Plant (manufacture_plant_id INTEGER PRIMARY KEY, plant_name TEXT, plant_type TEXT, plant_location TEXT, company_owned INTEGER);
+CREATE TABLE Car_Parts (part_id INTEGER PRIMARY KEY, part_name TEXT, manufacture_plant_id INTEGER REFERENCES Manufacture_Plant(manufacture_plant_id), manufacture_start_date TEXT, manufacture_end_date TEXT, part_recall INTEGER);
+CREATE TABLE Dealers (dealer_id INTEGER PRIMARY KEY, dealer_name TEXT, dealer_address TEXT);
+CREATE TABLE Dealer_Brand (dealer_id INTEGER REFERENCES Dealers(dealer_id), brand_id INTEGER REFERENCES Brands(brand_id), PRIMARY KEY (dealer_id, brand_id));
+CREATE TABLE Car_Vins (vin INTEGER PRIMARY KEY, model_id INTEGER REFERENCES Models(model_id), option_set_id INTEGER REFERENCES Car_Options(option_set_id), manufactured_date TEXT, manufactured_plant_id INTEGER REFERENCES Manufacture_Plant(manufacture_plant_id));
+CREATE TABLE Customers (customer_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, gender TEXT, household_income INTEGER, birthdate TEXT, phone_number INTEGER, email TEXT);
+CREATE TABLE Customer_Ownership (customer_id INTEGER REFERENCES Customers(customer_id), vin INTEGER REFERENCES Car_Vins(vin), purchase_date TEXT, purchase_price INTEGER, warantee_expire_date TEXT, dealer_id INTEGER REFERENCES Dealers(dealer_id), PRIMARY KEY (customer_id, vin));
+"""
+
+BRANDS = ['Toyota', 'Ford', 'Chevrolet', 'Honda', 'Nissan', 'Volkswagen', 'Hyundai', 'Kia', 'BMW', 'Mercedes-Benz',
+          'Audi', 'Subaru', 'Mazda', 'Jeep', 'Tesla', 'Volvo', 'Lexus', 'Porsche', 'Fiat', 'Peugeot', 'Renault', 'Skoda',
+          'Jaguar', 'Land Rover', 'Mini', 'Alfa Romeo', 'Maserati', 'Ferrari', 'Lamborghini', 'Bentley']
+MODEL_NAMES = ['Sedan', 'Coupe', 'Hatchback', 'Wagon', 'SUV', 'Crossover', 'Roadster', 'Pickup', 'Van', 'Hybrid']
+COLORS = ['Black', 'White', 'Silver', 'Gray', 'Blue', 'Red', 'Green', 'Brown', 'Yellow', 'Orange', 'Beige', 'Purple']
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'William', 'Elizabeth',
+               'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+               'Daniel', 'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Betty', 'Mark', 'Sandra', 'Steven', 'Ashley']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+              'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', 'Ramirez', 'Lewis', 'Robinson']
+CITIES = ['Springfield', 'Riverside', 'Franklin', 'Greenville', 'Bristol', 'Clinton', 'Fairview', 'Salem', 'Madison', 'Georgetown']
+
+MODELS_PER_BRAND = 8
+PLANTS = 20
+PARTS = 1000
+SKEW = 1.1 # Exponent of the Zipf-like popularity of brands, models and dealers (0 = uniform)
+
+
+# ---------------------------- Defining a new function named 'cumulative_weights' ----------------------------
+# Popularity of the n items of a list: the item at rank r gets 1 / r^SKEW (for random.choices(cum_weights=...))
+def cumulative_weights(n, skew=SKEW):
+    return list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+def iso_dates(start, days):
+    return [(start + datetime.timedelta(days=day)).isoformat() for day in range(days)]
+
+
+# ---------------------------- Defining a new function named 'table_sizes' ----------------------------
+# Number of rows of every table for a given number of ownerships
+def table_sizes(ownerships):
+    return {
+        'Brands': len(BRANDS),
+        'Models': len(BRANDS) * MODELS_PER_BRAND,
+        'Manufacture_Plant': PLANTS,
+        'Car_Parts': PARTS,
+        'Dealers': min(20000, max(10, ownerships // 2000)),
+        'Customers': max(1, ownerships * 4 // 5), # Some customers own more than one car
+        'Car_Vins': ownerships,
+        'Customer_Ownership': ownerships,
+    }
+
+
+# ---------------------------- Defining a new function named 'insert_batches' ----------------------------
+# Inserting the rows of a generator in batches (one executemany per batch)
+def insert_batches(conn, table_name, rows, batch_size):
+    count = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return count
+        placeholders = ', '.join('?' * len(batch[0]))
+        conn.executemany(f"INSERT INTO {table_name} VALUES ({placeholders});", batch)
+        conn.commit()
+        count += len(batch)
+
+
+# ---------------------------- Defining a new function named 'generate_database' ----------------------------
+# Creating the database at 'path' (which must not exist yet) and returning the number of rows per table
+def generate_database(path, ownerships=100000, seed=1, batch_size=50000, progress=False):
+    rng = random.Random(seed)
+    sizes = table_sizes(ownerships)
+    conn = sqlite3.connect(path)
+    # Nothing to recover if the generator crashes, so no journal and no fsync while loading
+    conn.execute("PRAGMA journal_mode = OFF;")
+    conn.execute("PRAGMA synchronous = OFF;")
+    conn.executescript(SCHEMA)
+
+    # Brands and models: expensive brands at the end of the list, so the cheap ones are the popular ones
+    conn.executemany("INSERT INTO Brands VALUES (?, ?);", [(brand_id, name) for brand_id, name in enumerate(BRANDS, 1)])
+    models, options = [], []
+    for brand_id in range(1, len(BRANDS) + 1):
+        base = 15000 + (brand_id - 1) ** 2 * 250
+        for number in range(MODELS_PER_BRAND):
+            model_id = len(models) + 1
+            name = f"{BRANDS[brand_id - 1]} {MODEL_NAMES[number % len(MODEL_NAMES)]} {100 + number * 10}"
+            models.append((model_id, name, base + rng.randrange(0, base // 2, 100), brand_id))
+            for color in rng.sample(COLORS, rng.randint(3, 8)):
+                options.append((len(options) + 1, model_id, rng.randint(1, 12), rng.randint(1, 4), rng.randint(1, 6),
+                                rng.randint(0, 3), color, rng.randrange(0, 8000, 250)))
+    conn.executemany("INSERT INTO Models VALUES (?, ?, ?, ?);", models)
+    conn.executemany("INSERT INTO Car_Options VALUES (?, ?, ?, ?, ?, ?, ?, ?);", options)
+    options_by_model = {}
+    for option in options:
+        options_by_model.setdefault(option[1], []).append((option[0], option[7]))
+
+    conn.executemany("INSERT INTO Manufacture_Plant VALUES (?, ?, ?, ?, ?);",
+                     [(plant_id, f"Plant {plant_id}", rng.choice(['Assembly', 'Parts']), rng.choice(CITIES), rng.randint(0, 1))
+                      for plant_id in range(1, PLANTS + 1)])
+    part_dates = iso_dates(datetime.date(2000, 1, 1), 365 * 20)
+    parts = []
+    for part_id in range(1, PARTS + 1):
+        start = rng.randrange(len(part_dates))
+        end = rng.randrange(start, len(part_dates))
+        parts.append((part_id, f"Part {part_id}", rng.randint(1, PLANTS), part_dates[start], part_dates[end], int(rng.random() < 0.02)))
+    conn.executemany("INSERT INTO Car_Parts VALUES (?, ?, ?, ?, ?, ?);", parts)
+
+    dealers = sizes['Dealers']
+    conn.executemany("INSERT INTO Dealers VALUES (?, ?, ?);",
+                     [(dealer_id, f"{rng.choice(CITIES)} Motors {dealer_id}", f"{rng.randint(1, 9999)} Main Street, {rng.choice(CITIES)}")
+                      for dealer_id in range(1, dealers + 1)])
+    brand_weights = cumulative_weights(len(BRANDS))
+    dealer_brands = set()
+    for dealer_id in range(1, dealers + 1):
+        for brand_id in rng.choices(range(1, len(BRANDS) + 1), cum_weights=brand_weights, k=rng.randint(1, 4)):
+            dealer_brands.add((dealer_id, brand_id))
+    conn.executemany("INSERT INTO Dealer_Brand VALUES (?, ?);", sorted(dealer_brands))
+    conn.commit()
+
+    # Customers
+    birthdates = iso_dates(datetime.date(1940, 1, 1), 365 * 65)
+    def customers():
+        for customer_id in range(1, sizes['Customers'] + 1):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            yield (customer_id, first, last, rng.choice('MF'), rng.randrange(20000, 400000, 1000), rng.choice(birthdates),
+                   rng.randint(2000000000, 9999999999), f"{first.lower()}.{last.lower()}{customer_id}@example.com")
+
+    # VINs and ownerships are generated together, so the purchase price follows the model and its options
+    model_weights = list(itertools.accumulate(
+        (1 / (brand_id ** SKEW)) * (1 / ((model_id - 1) % MODELS_PER_BRAND + 1) ** SKEW) for model_id, _, _, brand_id in models))
+    dealer_weights = cumulative_weights(dealers)
+    purchase_dates = iso_dates(datetime.date(2005, 1, 1), 365 * 20)
+    def cars_sold():
+        for start in range(1, ownerships + 1, batch_size):
+            count = min(batch_size, ownerships - start + 1)
+            picked_models = rng.choices(models, cum_weights=model_weights, k=count)
+            picked_dealers = rng.choices(range(1, dealers + 1), cum_weights=dealer_weights, k=count)
+            for vin, model, dealer_id in zip(range(start, start + count), picked_models, picked_dealers):
+                option_set_id, option_price = rng.choice(options_by_model[model[0]])
+                day = rng.randrange(60, len(purchase_dates))
+                # The first Customers rows own one car each, the remaining cars go to random customers
+                customer_id = vin if vin <= sizes['Customers'] else rng.randint(1, sizes['Customers'])
+                price = int((model[2] + option_price) * rng.uniform(0.9, 1.15))
+                yield ((vin, model[0], option_set_id, purchase_dates[day - rng.randint(10, 60)], rng.randint(1, PLANTS)),
+                       (customer_id, vin, purchase_dates[day], price, purchase_dates[min(day + 365 * 3, len(purchase_dates) - 1)], dealer_id))
+
+    started = time.perf_counter()
+    insert_batches(conn, 'Customers', customers(), batch_size)
+    if progress:
+        print(f"Customers: {sizes['Customers']} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    sold = cars_sold()
+    while True:
+        batch = list(itertools.islice(sold, batch_size))
+        if not batch:
+            break
+        conn.executemany("INSERT INTO Car_Vins VALUES (?, ?, ?, ?, ?);", [vin for vin, _ in batch])
+        conn.executemany("INSERT INTO Customer_Ownership VALUES (?, ?, ?, ?, ?, ?);", [ownership for _, ownership in batch])
+        conn.commit()
+        if progress:
+            print(f"Ownerships: {batch[-1][0][0]} / {ownerships} ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+
+    conn.execute("PRAGMA journal_mode = DELETE;") # The app switches it to WAL (see: pool.DEFAULT_PRAGMAS)
+    counts = {table_name: conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
+              for (table_name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY rowid;").fetchall()}
+    conn.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', help='database file to create')
+    parser.add_argument('--ownerships', type=float, default=100000, help='number of Customer_Ownership rows (e.g. 1e6)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error(f"{args.path} already exists")
+    counts = generate_database(args.path, int(args.ownerships), args.seed, args.batch_size, progress=True)
+    for table_name, count in counts.items():
+        print(f"{table_name:<20} {count:>12}")
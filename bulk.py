@@ -0,0 +1,182 @@
+import csv
+import io
+import json
+import sqlite3
+
+import query_builder
+
+# ---------------------------- Bulk import and export ----------------------------
+# Reading uploaded CSV / JSON Lines files row by row, checking every row against the table's schema and inserting them
+# with executemany() in batches (one transaction per batch), and writing tables or query results back out as
+# CSV / JSON Lines / columnar chunks without ever holding the whole result in memory.
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/x-ndjson', # One JSON object per batch of rows: {"columns": [...], "row_count": n, "data": [[column values], ...]}
+}
+
+
+# ---------------------------- Defining a new function named 'iter_csv' ----------------------------
+# Yielding (line number, record or error) for every row of a CSV upload (binary stream). The first line holds the columns
+def iter_csv(stream, encoding='utf-8'):
+    text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    reader = csv.DictReader(text)
+    for record in reader:
+        if None in record: # More values than columns in the header
+            yield reader.line_num, ValueError("row has more values than the header has columns")
+        else:
+            yield reader.line_num, record
+
+
+# ---------------------------- Defining a new function named 'iter_ndjson' ----------------------------
+# Yielding (line number, record or error) for every line of a JSON Lines upload (one JSON object per line)
+def iter_ndjson(stream, encoding='utf-8'):
+    for line_number, line in enumerate(io.TextIOWrapper(stream, encoding=encoding), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, ValueError(f"invalid JSON: {e}")
+            continue
+        if isinstance(record, dict):
+            yield line_number, record
+        else:
+            yield line_number, ValueError("each line must be a JSON object")
+
+
+# ---------------------------- Defining a new function named 'validate_record' ----------------------------
+# Checking a record against the table's schema and converting numeric strings for INTEGER/REAL columns.
+# Returns the tuple of values in 'columns' order; raises ValueError if the record does not fit the table.
+def validate_record(record, table, columns):
+    unknown = [column for column in record if column not in table['column_types']]
+    if unknown:
+        raise ValueError(f"unknown column(s): {', '.join(unknown)}")
+    values = []
+    for column in columns:
+        value = record.get(column)
+        if value == '': # Empty CSV cell -> NULL
+            value = None
+        if value is None:
+            if column in table['not_null']:
+                raise ValueError(f"column {column} is required")
+            values.append(None)
+            continue
+        column_type = table['column_types'][column].upper()
+        try:
+            if isinstance(value, bool): # (JSON true/false would be taken as 1/0 by int() and float())
+                raise ValueError
+            if 'INT' in column_type: # SQLite's type affinity rules: any type containing 'INT' has INTEGER affinity
+                if isinstance(value, float) and not value.is_integer(): # (int() would drop the fraction: 4.7 -> 4)
+                    raise ValueError
+                value = int(value)
+            elif any(name in column_type for name in ('REAL', 'FLOA', 'DOUB')):
+                value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"column {column}: {value!r} is not a {table['column_types'][column]}")
+        values.append(value)
+    return tuple(values)
+
+
+# ---------------------------- Defining a new function named 'import_records' ----------------------------
+# Inserting records into a table 'batch_size' rows at a time. 'records' yields (line number, record or error), as
+# iter_csv / iter_ndjson do. A batch is inserted with a single executemany() and committed; if it fails (e.g. a
+# duplicate primary key), its rows are inserted one by one so only the failing rows are rejected.
+# Returns {'inserted': n, 'failed': n, 'batches': n, 'errors': [{'line', 'error'}, ...]}: the errors of the first
+# 'max_errors' rejected lines, in line order (the rows of a batch are only rejected when it is flushed, after the
+# invalid rows read since)
+def import_records(conn, table_name, table, records, batch_size=500, max_errors=100):
+    report = {'inserted': 0, 'failed': 0, 'batches': 0, 'errors': []}
+
+    def reject(line_number, error):
+        report['failed'] += 1
+        report['errors'].append({'line': line_number, 'error': str(error)})
+        if len(report['errors']) >= 2 * max_errors: # Keeping the first lines only, without sorting after every error
+            trim_errors()
+
+    def trim_errors():
+        report['errors'].sort(key=lambda error: error['line'])
+        del report['errors'][max_errors:]
+
+    columns = None
+    sql = None
+    batch = [] # List of (line number, values)
+
+    def flush():
+        if not batch:
+            return
+        report['batches'] += 1
+        try:
+            conn.executemany(sql, [values for _, values in batch])
+            conn.commit()
+            report['inserted'] += len(batch)
+        except sqlite3.Error:
+            conn.rollback()
+            for line_number, values in batch: # Finding the rows that caused the error
+                try:
+                    conn.execute(sql, values)
+                    report['inserted'] += 1
+                except sqlite3.Error as e:
+                    reject(line_number, e)
+            conn.commit()
+        batch.clear()
+
+    for line_number, record in records:
+        if isinstance(record, Exception):
+            reject(line_number, record)
+            continue
+        if columns is None: # The columns of the first valid record are used for the INSERT statement
+            columns = [column for column in table['columns'] if column in record]
+            sql = query_builder.insert_sql(table_name, tuple(columns))
+        try:
+            extra = set(record) - set(columns)
+            if extra and extra <= set(table['columns']): # (unknown columns are reported by validate_record)
+                raise ValueError(f"columns differ from the first row ({', '.join(columns)})")
+            batch.append((line_number, validate_record(record, table, columns)))
+        except ValueError as e:
+            reject(line_number, e)
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    trim_errors()
+    return report
+
+
+# ---------------------------- Defining a new function named 'iter_query_rows' ----------------------------
+# Yielding (column names, list of rows) for every 'batch_size' rows of a query (one empty batch if there are no rows)
+def iter_query_rows(conn, query, params=(), batch_size=1000):
+    cur = conn.execute(query, params)
+    columns = [column[0] for column in cur.description]
+    first = True
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows and not first:
+            break
+        first = False
+        yield columns, [tuple(row) for row in rows]
+        if not rows:
+            break
+
+
+# ---------------------------- Defining a new function named 'export_chunks' ----------------------------
+# Turning the batches from iter_query_rows into text chunks of the requested format (see: EXPORT_FORMATS)
+def export_chunks(batches, fmt):
+    header_written = False
+    for columns, rows in batches:
+        if fmt == 'csv':
+            out = io.StringIO()
+            writer = csv.writer(out)
+            if not header_written:
+                writer.writerow(columns)
+                header_written = True
+            writer.writerows(rows)
+            yield out.getvalue()
+        elif fmt == 'ndjson':
+            yield ''.join(json.dumps(dict(zip(columns, row)), default=str) + '\n' for row in rows)
+        elif fmt == 'columnar':
+            data = [list(values) for values in zip(*rows)] # Rows -> columns
+            yield json.dumps({'columns': columns, 'row_count': len(rows), 'data': data}, default=str) + '\n'
+        else:
+            raise ValueError(f"unknown export format: {fmt}")
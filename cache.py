@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# ---------------------------- Defining a new function named 'make_key' ----------------------------
+# Building a cache key from the parameters bound to a query. The values are kept exactly as they are bound: for SQLite,
+# ' Ferrari' and 'Ferrari', or '007' and '7', are different queries with different results. Parameters that are not set
+# (None) are left out. The key is the repr() of the sorted (parameter, value) pairs, so no two sets of values share one
+def make_key(name, **params):
+    return f"{name}?{tuple(sorted((param, value) for param, value in params.items() if value is not None))!r}"
+
+
+# ---------------------------- Defining a new class named 'SQLiteCacheBackend' ----------------------------
+# Optional shared storage, so several worker processes (e.g. gunicorn workers) use one cache. It is a small SQLite file
+# holding the cached results (as JSON) and the shared data version.
+class SQLiteCacheBackend:
+    def __init__(self, path, maxsize=1024):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local() # One connection to the cache file per thread
+        self._pid = os.getpid()
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL);")
+        conn.execute("INSERT OR IGNORE INTO cache_meta (id, version) VALUES (1, 0);")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, version INTEGER, expires REAL, last_used REAL, value TEXT);")
+        conn.commit()
+
+    def _connection(self):
+        if self._pid != os.getpid(): # A forked worker opens its own connections
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            self._local.conn = conn
+        return conn
+
+    def version(self):
+        return self._connection().execute("SELECT version FROM cache_meta WHERE id = 1;").fetchone()[0]
+
+    def bump_version(self):
+        conn = self._connection()
+        with conn: # Committing (or rolling back on error) at the end of the block
+            conn.execute("UPDATE cache_meta SET version = version + 1 WHERE id = 1;")
+            conn.execute("DELETE FROM cache_entries;") # Entries of older versions can never be returned again
+
+    # Returning (True, value) for a valid entry and (False, None) otherwise
+    def get(self, key, version):
+        conn = self._connection()
+        row = conn.execute("SELECT value FROM cache_entries WHERE key = ? AND version = ? AND expires > ?;", (key, version, time.time())).fetchone()
+        if row is None:
+            return False, None
+        with conn:
+            conn.execute("UPDATE cache_entries SET last_used = ? WHERE key = ?;", (time.time(), key))
+        return True, json.loads(row[0])
+
+    # Storing a value and returning the number of entries evicted to stay under 'maxsize'
+    def set(self, key, version, value, ttl):
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache_entries (key, version, expires, last_used, value) VALUES (?, ?, ?, ?, ?);",
+                         (key, version, now + ttl, now, json.dumps(value)))
+            # Removing the least recently used entries above the size limit
+            cur = conn.execute("DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries ORDER BY last_used DESC LIMIT -1 OFFSET ?);", (self.maxsize,))
+            return max(cur.rowcount, 0)
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM cache_entries;")
+
+
+# ---------------------------- Defining a new class named 'ResultCache' ----------------------------
+# A bounded LRU cache with a time-to-live for query results. Every entry remembers the data version it was computed
+# for; the 'cars' write functions bump the version, so results computed before a write are never returned after it.
+# With a shared backend (see: SQLiteCacheBackend) the version and the entries are shared between processes, and the
+# in-process LRU is used as a first level in front of it.
+# 'database_version' is a function returning a token that changes with every commit to the database, whoever makes it
+# (see: cars.database_version). It is part of the version, so the writes of the other worker processes - which only
+# bump their own counter when there is no shared backend - and of other programs also make the cached results invalid.
+class ResultCache:
+    def __init__(self, maxsize=256, ttl=60.0, backend=None, database_version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl # Seconds after which an entry expires even without a write (also a bound on a missed change)
+        self.enabled = True
+        self.backend = backend
+        self.database_version = database_version
+        self._entries = OrderedDict() # key -> (version, expires, value), ordered from least to most recently used
+        self._version = 0 # In-process data version, used when there is no shared backend
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    # Reading the cache settings from the Flask config
+    def init_app(self, app):
+        self.maxsize = app.config.get('RESULT_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('RESULT_CACHE_TTL', self.ttl)
+        self.enabled = app.config.get('RESULT_CACHE_ENABLED', self.enabled)
+        backend_path = app.config.get('RESULT_CACHE_BACKEND') # Path of a SQLite file shared by all worker processes (None -> in-process only)
+        if backend_path:
+            self.backend = SQLiteCacheBackend(backend_path, maxsize=app.config.get('RESULT_CACHE_BACKEND_SIZE', 1024))
+        app.extensions['result_cache'] = self
+
+    # Returning the current data version
+    def version(self):
+        version = self.backend.version() if self.backend is not None else self._version
+        if self.database_version is not None:
+            return f"{version}-{self.database_version()}"
+        return version
+
+    # Called after every committed write: all results computed before it become invalid
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._stats['invalidations'] += 1
+        if self.backend is not None:
+            self.backend.bump_version()
+
+    # Returning (True, value) on a hit and (False, None) on a miss
+    def get(self, key):
+        if not self.enabled:
+            return False, None
+        version = self.version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, expires, value = entry
+                if entry_version == version and expires > now:
+                    self._entries.move_to_end(key) # Marking the entry as most recently used
+                    self._stats['hits'] += 1
+                    return True, value
+                del self._entries[key]
+                if expires <= now:
+                    self._stats['expirations'] += 1
+        if self.backend is not None:
+            found, value = self.backend.get(key, version)
+            if found:
+                self._store(key, version, value)
+                with self._lock:
+                    self._stats['hits'] += 1
+                return True, value
+        with self._lock:
+            self._stats['misses'] += 1
+        return False, None
+
+    # Storing a result computed for the data version read before running the query
+    def set(self, key, value, version):
+        if not self.enabled:
+            return
+        self._store(key, version, value)
+        if self.backend is not None:
+            evicted = self.backend.set(key, version, value, self.ttl)
+            with self._lock:
+                self._stats['evictions'] += evicted
+
+    def _store(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False) # Dropping the least recently used entry
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    # Returning a snapshot of the cache metrics
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['maxsize'] = self.maxsize
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['version'] = self.version()
+        stats['shared_backend'] = self.backend is not None
+        return stats
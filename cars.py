@@ -1,135 +1,394 @@
+import functools
+import logging
 import sqlite3
 import os
-
-# Ensuring the correct path to the database
-DATABASE = os.path.join(os.path.dirname(__file__), 'car_company_database-master', 'Car_Database.db')
-
-# ---------------------------- Defining a new function named 'create_connection' ----------------------------
-def create_connection():
-    # Starting the 'try' block
+import time
+
+from pool import ConnectionPool
+from schema import SchemaCache, primary_key_column
+from cache import ResultCache, make_key
+import search
+import bulk
+import model_colors
+import reports
+import table_stats
+import change_feed
+import query_builder
+from query_builder import FilterQuery
+from writer import WriteQueue
+from replica import ReadReplica
+
+# Errors are logged (instead of printed) so they can be routed, filtered and counted (see: instrumentation.py)
+log = logging.getLogger(__name__)
+
+# Ensuring the correct path to the database (the CARS_DATABASE environment variable can point the app at another copy)
+DATABASE = os.environ.get('CARS_DATABASE', os.path.join(os.path.dirname(__file__), 'car_company_database-master', 'Car_Database.db'))
+
+# A single pool of connections shared by every function below (see: pool.py). It is configured and hooked into the
+# Flask request lifecycle by 'pool.init_app(app)' in app.py
+pool = ConnectionPool(DATABASE)
+
+# Cached table structure (columns, types, primary and foreign keys, indexes), reloaded only when the schema changes (see: schema.py)
+schema_cache = SchemaCache()
+
+# Cache of filter results (get_customers, get_models), invalidated by every write below and by every commit of another
+# process (see: cache.py). Configured by 'result_cache.init_app(app)' in app.py
+result_cache = ResultCache(database_version=lambda: database_version())
+
+# Single writer thread committing the writes below in groups (see: writer.py). Enabled by 'writer.init_app(app)' in
+# app.py; when it is off, every write commits on its own through the pool
+writer = WriteQueue(pool.connect)
+
+# Where the read-only functions below read from: the same pool (default), the file opened read-only, or an in-memory
+# snapshot of it (see: replica.py). Configured by 'replica.init_app(app)' in app.py. A new snapshot makes the cached
+# results computed from the old one stale
+replica = ReadReplica(pool, version=lambda: database_version(), on_refresh=result_cache.invalidate)
+
+# In-memory index of the models and their colors, reloaded when the materialized _model_colors table changes (see: model_colors.py)
+model_index = model_colors.ModelColorIndex()
+
+# ---------------------------- Defining a new function named 'get_schema' ----------------------------
+def get_schema():
     try:
-        conn = sqlite3.connect(DATABASE) # Establishing a connection to the SQLite db using the sqlite3.connect() function
-        conn.row_factory = sqlite3.Row  # This allows us to get results as dictionaries, where the column names are used as keys
-        return conn # Returning the connection object
-    # Starting the 'except' block
-    except sqlite3.Error as e: # Catching any exceptions of type sqlite3.Error that occur within the try block (and stroing in the 'e' variable)
-        print(f"Error connecting to database: {e}") # Printing an error message to the console
-        return None # Returning 'None' if db connection is not established
+        with pool.connection() as conn:
+            return schema_cache.get(conn)
+    except sqlite3.Error as e:
+        log.error("Error reading database schema: %s", e)
+        return {}
+
+# ---------------------------- Defining a new function named 'get_primary_key_columns' ----------------------------
+# Returning a dictionary where the keys are table names and the values are the corresponding primary key column names
+def get_primary_key_columns():
+    return {table_name: primary_key_column(table) for table_name, table in get_schema().items()}
+
+# ---------------------------- Defining a new function named 'data_version' ----------------------------
+# Returning a token that changes whenever the data may have changed: the version of the result cache, made of the write
+# counter of this app and of the modification time and size of the database file and its WAL file, which also change
+# when another process writes (see: cache.py). Used for HTTP ETags (see: api.py)
+def data_version():
+    return str(result_cache.version())
+
+# The file part of data_version: changes with every commit, from this process or another one (also used to find out
+# if the read snapshot is out of date, see: replica.py)
+def database_version():
+    signature = []
+    for path in (pool.database, pool.database + '-wal'):
+        try:
+            stat = os.stat(path)
+            signature += [stat.st_mtime_ns, stat.st_size]
+        except OSError: # e.g. no WAL file yet
+            signature += [0, 0]
+    return '-'.join(str(part) for part in signature)
 
 # ---------------------------- Defining a new function named 'get_table_names' ----------------------------
 def get_table_names():
-    conn = create_connection()
-    if conn: # Checking if the connection was successfully established -> If conn is not None, the block of code under this condition is executed
-        try:
-            cur = conn.cursor() # Calling the cursor() method on the connection object to execute SQL commands and fetch results from the database
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table';") # Executing an SQL query that retrieves the names of all tables in the db
-            tables = cur.fetchall() # Fetching all results of the query and assigning them to the 'tables' variable. Each result is a row represented as a dictionary.
-            return [table['name'] for table in tables if table['name'] != 'sqlite_sequence'] # Returning a list of table names by iterating over the tables list and extracting the value associated with the key 'name'. We are also filtering out the 'sqlite_sequence' table which is not relevant to end-users. 
-        except sqlite3.Error as e:
-            print(f"Error fetching table names: {e}")
-            return [] # Returning an empty list if an exception occurs
-        finally: # Starting a 'finally' block 
-            conn.close() # Ensuring that the connection is properly closed after the operation is complete, regardless of whether an exception occurs
-    else: # If 'conn' is 'None' ...
-        return [] # ... Returning an empty list if the connection is not established
+    return list(get_schema().keys()) # Table names come from the schema cache, so sqlite_master is not queried on every page render
 
 # ---------------------------- Defining a new function named 'get_table_data' ----------------------------
 def get_table_data(table_name):
-    conn = create_connection()
-    if conn:
-        try:
+    try:
+        with replica.connection() as conn:
+            query_builder.check_table(get_schema(), table_name) # Only existing tables (the name comes from the URL), checked against the schema of the primary
             cur = conn.cursor()
-            cur.execute(f"SELECT * FROM {table_name};") # Executing an SQL query that retrieves all the data from the specified table
+            cur.execute(query_builder.select_all_sql(table_name)) # Executing an SQL query that retrieves all the data from the specified table
             data = cur.fetchall()
             return [dict(row) for row in data] # Returning a list of dictionaries, where each dictionary represents a row from the table
-        except sqlite3.Error as e:
-            print(f"Error fetching data from table: {e}")
-            return []
-        finally:
-            conn.close()
-    else:
+    except sqlite3.Error as e:
+        log.error("Error fetching data from table: %s", e)
         return []
 
 
+# ---------------------------- Defining a new function named 'get_table_columns' ----------------------------
+# Returning the column names of a table (also for empty tables, where there is no first row to read the keys from)
+def get_table_columns(table_name):
+    table = get_schema().get(table_name)
+    return table['columns'] if table else []
+
+
+# ---------------------------- Defining a new function named 'iter_table_data' ----------------------------
+# Generator version of get_table_data: yielding one row (dictionary) at a time and fetching 'batch_size' rows per
+# round trip, so the memory used stays the same whatever the size of the table
+def iter_table_data(table_name, batch_size=500):
+    try:
+        with replica.connection() as conn:
+            query_builder.check_table(get_schema(), table_name)
+            cur = conn.execute(query_builder.select_all_sql(table_name))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+    except sqlite3.Error as e:
+        log.error("Error streaming data from table: %s", e)
+
+
+# ---------------------------- Defining a new function named 'get_table_page' ----------------------------
+# Keyset ("seek") pagination: instead of OFFSET (which has to read and throw away every skipped row), we continue
+# right after the last row of the previous page using the index on the primary key.
+# primary_key_column: the column to paginate on (None -> paginating on SQLite's internal rowid)
+# after / after_rowid: the primary key value and rowid of the last row of the previous page (None -> first page)
+# The rowid is used as a tie-breaker, because some tables (e.g. Customer_Ownership) repeat the 'primary key' value
+def get_table_page(table_name, primary_key_column=None, page_size=100, after=None, after_rowid=None):
+    params = {'limit': page_size + 1} # Fetching one extra row to find out if there is a next page
+    seek = None
+    if after is not None and after_rowid is not None:
+        seek = 'key_rowid'
+        params['after'] = after
+        params['after_rowid'] = after_rowid
+    elif after is not None:
+        seek = 'key'
+        params['after'] = after
+
+    page = {'columns': [], 'rows': [], 'next_after': None, 'next_after_rowid': None}
+    try:
+        with replica.connection() as conn:
+            if primary_key_column:
+                query_builder.check_columns(get_schema(), table_name, [primary_key_column])
+            else:
+                query_builder.check_table(get_schema(), table_name)
+            cur = conn.execute(query_builder.page_sql(table_name, primary_key_column, seek), params)
+            page['columns'] = [column[0] for column in cur.description][1:] # Skipping the '_rowid_' helper column
+            rows = cur.fetchall()
+    except sqlite3.Error as e:
+        log.error("Error fetching page from table: %s", e)
+        return page
+
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    for row in rows:
+        record = dict(row)
+        record.pop('_rowid_')
+        page['rows'].append(record)
+    if has_next: # The cursor for the next page is the position of the last row on this page
+        page['next_after'] = rows[-1][primary_key_column] if primary_key_column else rows[-1]['_rowid_']
+        page['next_after_rowid'] = rows[-1]['_rowid_']
+    return page
+
+
+# ---------------------------- Defining a new function named 'import_records' ----------------------------
+# Bulk version of add_record: 'records' yields (line number, record or error), e.g. from bulk.iter_csv(). Returns the
+# import report of bulk.import_records (None if the table does not exist). The rows are written on a connection of the
+# pool, not through the write queue: each batch is its own transaction (see: writer.py)
+def import_records(table_name, records, batch_size=500):
+    table = get_schema().get(table_name)
+    if table is None:
+        return None
+    try:
+        with pool.connection() as conn:
+            report = bulk.import_records(conn, table_name, table, records, batch_size)
+    except sqlite3.Error as e:
+        log.error("Error importing records: %s", e)
+        report = {'inserted': 0, 'failed': 0, 'batches': 0, 'errors': [{'line': None, 'error': str(e)}]}
+    if report['inserted']:
+        result_cache.invalidate()
+    return report
+
+
+# ---------------------------- Defining a new function named 'export_query' ----------------------------
+# Generator: yielding the result of a query as text chunks in the given format (see: bulk.EXPORT_FORMATS), 'batch_size'
+# rows at a time
+def export_query(query, params=(), fmt='csv', batch_size=1000):
+    try:
+        with replica.connection() as conn:
+            yield from bulk.export_chunks(bulk.iter_query_rows(conn, query, params, batch_size), fmt)
+    except sqlite3.Error as e:
+        log.error("Error exporting data: %s", e)
+
+
+# ---------------------------- Defining a new function named 'export_table' ----------------------------
+def export_table(table_name, fmt='csv', batch_size=1000):
+    return export_query(query_builder.select_all_sql(table_name), (), fmt, batch_size) # The route checks the table name
+
+
+# ---------------------------- Defining a new function named 'execute_write' ----------------------------
+# Running one INSERT/UPDATE/DELETE and committing it; returns (lastrowid, rowcount). With the write queue enabled the
+# statement is committed by the writer thread together with the other pending writes, otherwise right here
+def execute_write(sql, params=()):
+    if writer.enabled:
+        return writer.execute(sql, params)
+    with pool.connection() as conn:
+        cur = conn.execute(sql, params)
+        conn.commit()
+        return cur.lastrowid, cur.rowcount
+
+
 # ---------------------------- Defining a new function named 'add_record' ----------------------------
 # record - a dictionary representing the data to be inserted (column_name:value)
+# Returning the rowid of the new row (None if the record could not be added)
 def add_record(table_name, record):
-    conn = create_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            columns = ', '.join(record.keys()) # Creating a string of column names by joining the keys of the record dictionary with commas
-            placeholders = ', '.join(['?'] * len(record)) # Creating a string of placeholders (?) for the values to be inserted. The number of placeholders matches the number of items in the record dictionary. These placeholders are replaced by the actual values during the execution of the SQL statement
-            sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})" # Inserting the specified values into the specified columns of the specified table
-            cur.execute(sql, tuple(record.values())) # Executing the SQL INSERT statement. The tuple(record.values()) converts the values of the record dictionary to a tuple, which is used to replace the placeholders in the SQL statement with the actual values
-            conn.commit() # Saving the changes to the databas
-        except sqlite3.Error as e:
-            print(f"Error adding record: {e}")
-        finally:
-            conn.close()
+    try:
+        columns = query_builder.check_columns(get_schema(), table_name, record.keys()) # The keys of the record must be columns of the table (they come from the form)
+        sql = query_builder.insert_sql(table_name, columns) # INSERT INTO "table" ("column", ...) VALUES (?, ...) - built once per table and set of columns
+        lastrowid, _ = execute_write(sql, tuple(record.values())) # The tuple(record.values()) converts the values of the record dictionary to a tuple, which is used to replace the placeholders in the SQL statement with the actual values
+        result_cache.invalidate() # Cached filter results may include the changed table
+        return lastrowid
+    except sqlite3.Error as e:
+        log.error("Error adding record: %s", e)
+        return None
+
+# ---------------------------- Defining a new function named 'get_row_count' ----------------------------
+# Returning the number of rows of a table, read from the counters kept by triggers (see: table_stats.py) - one lookup
+# whatever the size of the table. Counting the rows (a full scan) only if the table has no counters
+def get_row_count(table_name):
+    try:
+        with replica.connection() as conn:
+            query_builder.check_table(get_schema(), table_name)
+            counts = table_stats.read_table_counts(conn, table_name)
+            if counts is not None:
+                return counts[0]
+            return conn.execute(query_builder.count_sql(table_name)).fetchone()[0] # Executing an SQL query that counts the number of rows in the specified table
+    except sqlite3.Error as e:
+        log.error("Error counting rows of table: %s", e)
+        return None
 
 # ---------------------------- Defining a new function named 'get_max_id' ----------------------------
+# Returning the largest primary key value of a table (from the same counters as get_row_count; an index lookup otherwise).
+# Before the counters existed, this function returned the number of rows: use get_row_count for that
 def get_max_id(table_name):
-    conn = create_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(f"SELECT COUNT(*) FROM {table_name};") # Executing an SQL query that counts the number of rows in the specified table
-            max_id = cur.fetchone()[0] # Fetching the result of the query using the fetchone() method, which returns a single row. Since the query returns a single value (the count of rows), it is accessed with [0] and assigned to the variable max_id
-            return max_id # Returning the count of rows in the table
-        except sqlite3.Error as e:
-            print(f"Error fetching max ID from table: {e}")
-            return None
-        finally:
-            conn.close()
-    else:
+    try:
+        with replica.connection() as conn:
+            primary_key_column = get_primary_key_columns().get(table_name)
+            query_builder.check_columns(get_schema(), table_name, [primary_key_column])
+            counts = table_stats.read_table_counts(conn, table_name)
+            if counts is not None:
+                return counts[1]
+            return conn.execute(query_builder.max_sql(table_name, primary_key_column)).fetchone()[0]
+    except sqlite3.Error as e:
+        log.error("Error fetching max ID from table: %s", e)
+        return None
+
+# ---------------------------- Defining a new function named 'get_table_stats' ----------------------------
+# Returning the statistics of every table ({table name: {'key_column', 'row_count', 'max_key', 'analyzed_at'}}), or of
+# one table with its column statistics added ('columns': {column name: {'distinct_count', 'null_count', 'min_value',
+# 'max_value'}}). None if the table does not exist or the statistics were never created
+def get_table_stats(table_name=None):
+    try:
+        with replica.connection() as conn:
+            tables = table_stats.read_table_stats(conn)
+            if tables is None or table_name is None:
+                return tables
+            if table_name not in tables:
+                return None
+            return dict(tables[table_name], columns=table_stats.read_column_stats(conn, table_name))
+    except sqlite3.Error as e:
+        log.error("Error reading table statistics: %s", e)
+        return None
+
+# ---------------------------- Defining a new function named 'analyze_tables' ----------------------------
+# Recomputing the column statistics, the exact row counts and SQLite's planner statistics (ANALYZE) of the given tables
+# (all by default). Reads every row: runs on its own connection to the primary, outside of the write queue, so the
+# queued writes only wait for the table being scanned. Returns the number of tables analyzed (None on error)
+def analyze_tables(tables=None):
+    try:
+        with pool.connection() as conn:
+            schema = schema_cache.get(conn)
+            table_stats.ensure_table_stats(conn, schema) # Adding the tables created since the app started
+            analyzed = table_stats.analyze(conn, schema, tables)
+        result_cache.invalidate() # ANALYZE can change the query plans, and the counts may have been corrected
+        return analyzed
+    except sqlite3.Error as e:
+        log.error("Error analyzing tables: %s", e)
+        return None
+
+# ---------------------------- Defining a new function named 'get_changes' ----------------------------
+# Returning the changes after sequence number 'since' (see: change_feed.py): {'items': [...], 'last_seq': n,
+# 'horizon': n}, where 'last_seq' is the number of the latest change overall. Reading from the primary, so a consumer
+# never misses a change that a snapshot replica does not have yet. None on error (e.g. no change feed in this database)
+def get_changes(since=0, limit=1000, tables=None):
+    try:
+        with pool.connection() as conn:
+            last_seq, horizon = change_feed.feed_position(conn)
+            return {'items': change_feed.read_changes(conn, since, limit, tables), 'last_seq': last_seq, 'horizon': horizon}
+    except sqlite3.Error as e:
+        log.error("Error reading changes: %s", e)
+        return None
+
+# ---------------------------- Defining a new function named 'wait_for_changes' ----------------------------
+# Waiting up to 'timeout' seconds for a change after sequence number 'since' (long polling). Returns True as soon as
+# there is one, False otherwise. The database is only queried when its files changed (see: database_version), and no
+# connection is held while waiting: the request's connection is given back to the pool first
+def wait_for_changes(since, timeout, poll_interval=0.5):
+    pool.release_thread()
+    deadline = time.monotonic() + timeout
+    version = None
+    while True:
+        current = database_version()
+        if current != version:
+            version = current
+            try:
+                with pool.connection() as conn:
+                    if change_feed.feed_position(conn)[0] > since:
+                        return True
+            except sqlite3.Error as e:
+                log.error("Error reading changes: %s", e)
+                return False
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(poll_interval, remaining))
+
+# ---------------------------- Defining a new function named 'compact_changes' ----------------------------
+# Removing the superseded changes, and those older than 'retention_seconds' if given (see: change_feed.compact). Runs on
+# its own connection to the primary, outside of the write queue, like analyze_tables. None on error
+def compact_changes(retention_seconds=None):
+    try:
+        with pool.connection() as conn:
+            return change_feed.compact(conn, retention_seconds)
+    except sqlite3.Error as e:
+        log.error("Error compacting changes: %s", e)
         return None
 
 # ---------------------------- Defining a new function named 'delete_record' ----------------------------
 def delete_record(table_name, primary_key_column, record_id):
-    conn = create_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(f"DELETE FROM {table_name} WHERE {primary_key_column} = ?;", (record_id,)) # (record_id,): a tuple containing the value to be used in place of the ? placeholder in the SQL statement.
-            conn.commit()
-            return True # Returning True, if the record is successfully deleted.
-        except sqlite3.Error as e:
-            print(f"Error deleting record: {e}")
-            return False
-        finally:
-            conn.close()
-    else:
+    try:
+        query_builder.check_columns(get_schema(), table_name, [primary_key_column])
+        execute_write(query_builder.delete_sql(table_name, primary_key_column), (record_id,)) # (record_id,): a tuple containing the value to be used in place of the ? placeholder in the SQL statement.
+        result_cache.invalidate()
+        return True # Returning True, if the record is successfully deleted.
+    except sqlite3.Error as e:
+        log.error("Error deleting record: %s", e)
         return False
 
 
 # ---------------------------- Defining a new function named 'get_record_by_id' ----------------------------
+# Reading from the primary, not the replica: the record fills the edit form, whose values are written back
 def get_record_by_id(table_name, record_id, primary_key_columns): # primary_key_columns: a dictionary where the keys are table names and the values are the corresponding primary key column names
-    conn = create_connection()
-    if conn:
-        try:
+    try:
+        with pool.connection() as conn:
             cur = conn.cursor()
             if not isinstance(primary_key_columns, dict): # Checking if the primary_key_columns parameter is a dictionary. If it is not, an error message is printed and the function returns None.
-                print("Error: primary_key_columns must be a dictionary.")
+                log.error("primary_key_columns must be a dictionary")
                 return None
             
             primary_key_column = primary_key_columns.get(table_name) # Retrieving the primary key column name for the specified table from the primary_key_columns dictionary
             if not primary_key_column:
-                print(f"No primary key column found for table: {table_name}")
+                log.error("No primary key column found for table: %s", table_name)
                 return None
             
-            cur.execute(f"SELECT * FROM {table_name} WHERE {primary_key_column} = ?;", (record_id,))
+            query_builder.check_columns(get_schema(), table_name, [primary_key_column])
+            cur.execute(query_builder.select_by_key_sql(table_name, primary_key_column), (record_id,))
             record = cur.fetchone() # Fetching the result of the query using the fetchone() method, which returns a single row. If no matching record is found - returning 'None'
             if record:
                 return dict(record) # Converting the row to a dictionary and returning it 
             else:
                 return None
-        except sqlite3.Error as e:
-            print(f"Error fetching record by ID: {e}")
-            return None
-        finally:
-            conn.close()
-    else:
+    except sqlite3.Error as e:
+        log.error("Error fetching record by ID: %s", e)
+        return None
+
+# ---------------------------- Defining a new function named 'get_record_by_rowid' ----------------------------
+# Returning the row with SQLite's internal rowid 'rowid' (e.g. the one returned by add_record) as a dictionary, from the
+# primary like get_record_by_id. Unlike the value of primary_key_column, the rowid identifies exactly one row, also in
+# tables whose primary key has several columns (e.g. Customer_Ownership). None if there is no such row or on error
+def get_record_by_rowid(table_name, rowid):
+    try:
+        with pool.connection() as conn:
+            query_builder.check_table(get_schema(), table_name)
+            record = conn.execute(query_builder.select_by_rowid_sql(table_name), (rowid,)).fetchone()
+            return dict(record) if record else None
+    except sqlite3.Error as e:
+        log.error("Error fetching record by rowid: %s", e)
         return None
 
 
@@ -137,28 +396,77 @@ def get_record_by_id(table_name, record_id, primary_key_columns): # primary_key_
 
 # updated_record: a dictionary containing the columns to be updated and their new values.
 def update_record(table_name, primary_key_column, record_id, updated_record):
-    conn = create_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            set_clause = ', '.join([f"{key} = ?" for key in updated_record.keys()]) # Creating a string that lists each column to be updated, with placeholders (?) for the new values. The join method is used to concatenate the key-value pairs with commas.
-            sql = f"UPDATE {table_name} SET {set_clause} WHERE {primary_key_column} = ?"
-            values = list(updated_record.values()) # Extracting the values from the updated_record dictionary and converting them to a list
-            values.append(record_id) # Appending the record_id to the 'values' list (to further replace "?" in 'WHERE {primary_key_column} = ?')
-            print(f"Executing SQL: {sql}")  # Debug: print the SQL statement
-            print(f"With values: {values}")  # Debug: print the values
-            cur.execute(sql, values)
-            conn.commit()
-            return True
-        except sqlite3.Error as e:
-            print(f"Error updating record: {e}")
-            return False
-        finally:
-            conn.close()
-    else:
+    try:
+        columns = query_builder.check_columns(get_schema(), table_name, list(updated_record.keys()) + [primary_key_column]) # Only existing columns, as in add_record
+        sql = query_builder.update_sql(table_name, columns[:-1], primary_key_column) # UPDATE "table" SET "column" = ?, ... WHERE "key" = ?
+        values = list(updated_record.values()) # Extracting the values from the updated_record dictionary and converting them to a list
+        values.append(record_id) # Appending the record_id to the 'values' list (to further replace "?" in 'WHERE {primary_key_column} = ?')
+        log.debug("Executing SQL: %s with values: %s", sql, values)
+        execute_write(sql, values)
+        result_cache.invalidate()
+        return True
+    except sqlite3.Error as e:
+        log.error("Error updating record: %s", e)
         return False
 
 
+# ---------------------------- Batch operations ----------------------------
+# The same as get_record_by_id / update_record / delete_record for a list of primary key values, with one statement for
+# the whole list (see: query_builder.select_by_keys_sql) instead of one statement - and one request - per record
+
+# ---------------------------- Defining a new function named 'get_records_by_ids' ----------------------------
+# Returning the rows whose primary key is in 'record_ids' (in the order of the table; ids without a row are left out).
+# Reading from the primary, like get_record_by_id. None on error
+def get_records_by_ids(table_name, primary_key_column, record_ids):
+    record_ids = list(record_ids)
+    if not record_ids:
+        return []
+    try:
+        query_builder.check_columns(get_schema(), table_name, [primary_key_column])
+        sql = query_builder.select_by_keys_sql(table_name, primary_key_column, query_builder.keys_bucket(len(record_ids)))
+        with pool.connection() as conn:
+            return [dict(row) for row in conn.execute(sql, query_builder.keys_params(record_ids))]
+    except sqlite3.Error as e:
+        log.error("Error fetching records by IDs: %s", e)
+        return None
+
+
+# ---------------------------- Defining a new function named 'update_records' ----------------------------
+# Setting the same values (updated_record: column -> value) on every row whose primary key is in 'record_ids', in one
+# transaction. Returns the number of rows updated (None on error)
+def update_records(table_name, primary_key_column, record_ids, updated_record):
+    record_ids = list(record_ids)
+    if not record_ids or not updated_record:
+        return 0
+    try:
+        columns = query_builder.check_columns(get_schema(), table_name, list(updated_record.keys()) + [primary_key_column])
+        sql = query_builder.update_by_keys_sql(table_name, columns[:-1], primary_key_column, query_builder.keys_bucket(len(record_ids)))
+        _, rowcount = execute_write(sql, query_builder.keys_params(record_ids, updated_record.values()))
+        result_cache.invalidate()
+        return rowcount
+    except sqlite3.Error as e:
+        log.error("Error updating records: %s", e)
+        return None
+
+
+# ---------------------------- Defining a new function named 'delete_records' ----------------------------
+# Deleting every row whose primary key is in 'record_ids', in one transaction. Returns the number of rows deleted
+# (None on error)
+def delete_records(table_name, primary_key_column, record_ids):
+    record_ids = list(record_ids)
+    if not record_ids:
+        return 0
+    try:
+        query_builder.check_columns(get_schema(), table_name, [primary_key_column])
+        sql = query_builder.delete_by_keys_sql(table_name, primary_key_column, query_builder.keys_bucket(len(record_ids)))
+        _, rowcount = execute_write(sql, query_builder.keys_params(record_ids))
+        result_cache.invalidate()
+        return rowcount
+    except sqlite3.Error as e:
+        log.error("Error deleting records: %s", e)
+        return None
+
+
 # ---------------------------- Defining a new function named 'get_custom_query_results' ----------------------------
 def get_custom_query_results(query):
     conn = sqlite3.connect('your_database.db')
@@ -173,20 +481,103 @@ def get_custom_query_results(query):
 
 # 'params' should be a tuple containing the values to be used in the query
 def execute_custom_query(query, params):
-    conn = create_connection()
-    try:
+    with replica.connection() as conn:
         cursor = conn.execute(query, params)
         results = cursor.fetchall()
         return [dict(row) for row in results] # converting each row from the result set into a dictionary using a list comprehension
-    finally:
-        conn.close()
         
 
+# (table, key column, searched column) of each name filter
+FILTER_COLUMNS = {
+    'customer_name': ('Customers', 'customer_id', 'first_name'),
+    'model_name': ('Models', 'model_id', 'model_name'),
+    'dealer_name': ('Dealers', 'dealer_id', 'dealer_name'),
+}
+
+# ---------------------------- Defining a new function named 'build_filter_query' ----------------------------
+# Building the query behind the /filter_data form (customers by first name, model, minimum price paid and dealer).
+# use_search_index=True -> the names are matched word by word (prefix match) through the full-text search indexes
+# (see: search.py) instead of LIKE '%...%', which can never use an index and has to read every row of the join
+def build_filter_query(customer_name=None, model_name=None, model_price=None, dealer_name=None, use_search_index=False):
+    shape = [] # (parameter, 'match' or 'like') for each name that is filtered on, then ('model_price', None) if it is set
+    params = {}
+    values = {'customer_name': customer_name, 'model_name': model_name, 'dealer_name': dealer_name}
+    for param, (_, _, column) in FILTER_COLUMNS.items():
+        value = values[param]
+        if not value:
+            continue
+        match = search.to_match_query(value, column) if use_search_index else None
+        if match: # Only the ids found in the search index are kept
+            shape.append((param, 'match'))
+            params[param] = match
+        else:
+            shape.append((param, 'like'))
+            params[param] = f'%{value}%'
+    if model_price:
+        shape.append(('model_price', None))
+        params['model_price'] = model_price
+    return filter_query_sql(tuple(shape)), params
+
+# The SQL of one combination of filters, built once (at most 3^3 * 2 combinations)
+@functools.lru_cache(maxsize=None)
+def filter_query_sql(shape):
+    # Custom SQL query to filter data based on provided inputs
+    query = """
+        SELECT Customers.first_name, Customers.last_name
+        FROM Customers
+        JOIN Customer_Ownership ON Customers.customer_id = Customer_Ownership.customer_id
+        JOIN Car_Vins on Customer_Ownership.vin=Car_Vins.vin
+        JOIN Models ON Car_Vins.model_id = Models.model_id
+        JOIN Dealers ON Customer_Ownership.dealer_id = Dealers.dealer_id
+        WHERE 1=1
+    """
+    for param, mode in shape:
+        if param == 'model_price':
+            query += " AND Customer_Ownership.purchase_price > :model_price"
+            continue
+        table, key, column = FILTER_COLUMNS[param]
+        if mode == 'match':
+            fts = search.search_table_name(table)
+            query += f" AND {table}.{key} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH :{param})"
+        else:
+            query += f" AND {table}.{column} LIKE :{param}"
+    return query
+
+# ---------------------------- Defining a new function named 'has_search_index' ----------------------------
+# Checking if the full-text search indexes used by filter_customers exist in the database
+def has_search_index():
+    try:
+        with pool.connection() as conn:
+            virtual_tables = schema_cache.virtual_tables(conn)
+    except sqlite3.Error as e:
+        log.error("Error reading database schema: %s", e)
+        return False
+    return all(search.search_table_name(table) in virtual_tables for table in ('Customers', 'Models', 'Dealers'))
+
+# ---------------------------- Defining a new function named 'filter_customers' ----------------------------
+# use_search_index: None -> using the search indexes whenever they exist
+def filter_customers(customer_name=None, model_name=None, model_price=None, dealer_name=None, use_search_index=None):
+    if use_search_index is None:
+        use_search_index = has_search_index()
+    query, params = build_filter_query(customer_name, model_name, model_price, dealer_name, use_search_index)
+    return execute_custom_query(query, params)
+
+# ---------------------------- Defining a new function named 'search_names' ----------------------------
+# Ranked prefix search over customer, model and dealer names (see: search.search)
+def search_names(text, kinds=None, limit=20):
+    try:
+        with replica.connection() as conn:
+            return search.search(conn, text, kinds, limit)
+    except sqlite3.Error as e:
+        log.error("Error searching: %s", e)
+        return {kind: [] for kind in kinds or search.SEARCH_TABLES}
+
+
 #---------------------------- Functions for customers specifically ---------------------------- 
 
-def get_customers(brand=None, dealer=None, purchase_price=None, model=None):
-    conn = create_connection()
-    query = """
+# Building the SQL query (and its parameters) used by get_customers - also used by the index checker (see: indexes.py).
+# The SQL of each combination of filters is built once (see: query_builder.FilterQuery)
+CUSTOMERS_QUERY = FilterQuery("""
         SELECT Customers.* FROM Customers
         JOIN Customer_Ownership ON Customers.customer_id = Customer_Ownership.customer_id
         JOIN Car_Vins ON Customer_Ownership.vin = Car_Vins.vin
@@ -194,32 +585,65 @@ def get_customers(brand=None, dealer=None, purchase_price=None, model=None):
         JOIN Brands ON Models.brand_id = Brands.brand_id
         JOIN Dealers ON Customer_Ownership.dealer_id = Dealers.dealer_id
         WHERE 1=1
-    """
-    params = {}
-    if brand:
-        query += " AND Brands.brand_name = :brand"
-        params['brand'] = brand
-    if dealer:
-        query += " AND Dealers.dealer_name = :dealer"
-        params['dealer'] = dealer
-    if purchase_price:
-        query += " AND Customer_Ownership.purchase_price >= :purchase_price"
-        params['purchase_price'] = purchase_price
-    if model:
-        query += " AND Models.model_name = :model"
-        params['model'] = model
+    """, [
+    ('brand', "Brands.brand_name = :brand"),
+    ('dealer', "Dealers.dealer_name = :dealer"),
+    ('purchase_price', "Customer_Ownership.purchase_price >= :purchase_price"),
+    ('model', "Models.model_name = :model"),
+])
+
+def build_customers_query(brand=None, dealer=None, purchase_price=None, model=None):
+    return CUSTOMERS_QUERY.build(brand=brand, dealer=dealer, purchase_price=purchase_price, model=model)
+
+def get_customers(brand=None, dealer=None, purchase_price=None, model=None):
+    # Returning the cached result if the same filters were used since the last write. The key is built from the
+    # parameters that are bound to the query, so only identical queries share an entry
+    query, params = build_customers_query(brand, dealer, purchase_price, model)
+    key = make_key('customers', **params)
+    found, customers = result_cache.get(key)
+    if found:
+        return customers
+    version = result_cache.version() # Read before the query, so a write that happens meanwhile makes this result stale
 
     try:
-        cur = conn.cursor()
-        cur.execute(query, params)
-        customers = cur.fetchall()
-        return [dict(row) for row in customers]
+        with replica.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            customers = [dict(row) for row in cur.fetchall()]
+        result_cache.set(key, customers, version)
+        return customers
     except sqlite3.Error as e:
-        print(f"Error fetching customers: {e}")
+        log.error("Error fetching customers: %s", e)
         return []
-    finally:
-        conn.close()
         
+# ---------------------------- Defining a new function named 'get_report' ----------------------------
+# Running one of the sales reports (see: reports.py) with the given filters, e.g.
+#   get_report('revenue', group_by='dealer', date_from='2020-01-01', limit=10)
+# The revenue report reads the precomputed rollup tables when they exist. Results are cached like get_customers
+REPORT_QUERIES = {
+    'revenue': reports.build_revenue_query,
+    'price_histogram': reports.build_price_histogram_query,
+    'top_customers': reports.build_top_customers_query,
+}
+
+def get_report(name, **params):
+    key = make_key('report_' + name, **params)
+    found, rows = result_cache.get(key)
+    if found:
+        return rows
+    version = result_cache.version()
+    try:
+        with replica.connection() as conn:
+            if name == 'revenue':
+                params['use_rollup'] = reports.has_rollups(conn)
+            query, query_params = REPORT_QUERIES[name](**params)
+            rows = [dict(row) for row in conn.execute(query, query_params).fetchall()]
+        result_cache.set(key, rows, version)
+        return rows
+    except sqlite3.Error as e:
+        log.error("Error running report: %s", e)
+        return []
+
 #def get_customer_by_id(customer_id):
 #    conn = create_connection()
 #    try:
@@ -278,44 +702,55 @@ def get_customers(brand=None, dealer=None, purchase_price=None, model=None):
             
 #---------------------------- Functions for car models specifically #----------------------------
 
-def get_models(car_color=None, brand=None, price=None):
-    conn = create_connection()
-    query = """
-    SELECT Models.*, GROUP_CONCAT(Car_Options.color) as possible_colors, Brands.brand_name 
+# Building the SQL query (and its parameters) used by get_models
+MODELS_QUERY = FilterQuery("""
+    SELECT Models.*, GROUP_CONCAT(DISTINCT Car_Options.color) as possible_colors, Brands.brand_name 
     FROM Models
     JOIN Car_Options ON Models.model_id = Car_Options.model_id
     JOIN Brands ON Brands.brand_id = Models.brand_id
     WHERE 1=1
-    """
-    params = {}
-    if car_color:
-        query += " AND Car_Options.color = :car_color"
-        params['car_color'] = car_color
-    if brand:
-        query += " AND Brands.brand_name = :brand"
-        params['brand'] = brand
-    if price:
-        query += " AND Models.model_base_price <= :price"
-        params['price'] = price
-
-    query += " GROUP BY Models.model_id"  # Grouping by model_id to aggregate colors
+    """, [
+    # Filtering models by color without filtering the joined colors, so possible_colors keeps all colors of the model
+    ('car_color', "Models.model_id IN (SELECT model_id FROM Car_Options WHERE color = :car_color)"),
+    ('brand', "Brands.brand_name = :brand"),
+    ('price', "Models.model_base_price <= :price"),
+], suffix=" GROUP BY Models.model_id") # Grouping by model_id to aggregate colors
+
+def build_models_query(car_color=None, brand=None, price=None):
+    return MODELS_QUERY.build(car_color=car_color, brand=brand, price=price)
+
+def get_models(car_color=None, brand=None, price=None):
+    # Using the in-memory index over the materialized model colors when it exists (see: model_colors.py)
+    try:
+        with replica.connection() as conn:
+            if model_index.refresh(conn):
+                return model_index.filter(car_color, brand, price)
+    except sqlite3.Error as e:
+        log.error("Error loading model colors: %s", e)
+
+    query, params = build_models_query(car_color, brand, price)
+    key = make_key('models', **params) # (from the bound parameters, as in get_customers)
+    found, model_dicts = result_cache.get(key)
+    if found:
+        return model_dicts
+    version = result_cache.version()
 
     try:
-        cur = conn.cursor()
-        cur.execute(query, params)
-        models = cur.fetchall()
+        with replica.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            models = cur.fetchall()
         # Ensuring the possible_colors key is present
         model_dicts = []
         for model in models:
             model_dict = dict(model)
             model_dict['possible_colors'] = model_dict.get('possible_colors', '').split(',') if model_dict.get('possible_colors') else [] # model_dict.get('possible_colors', ''): if the key is not found, returning an empty string ''. .split(','): splitting the string by commas, to create a list of colors. Lastly, if the possible_colors key is missing or empty, an empty list [] is assigned
             model_dicts.append(model_dict)
+        result_cache.set(key, model_dicts, version)
         return model_dicts
     except sqlite3.Error as e:
-        print(f"Error fetching models: {e}")
+        log.error("Error fetching models: %s", e)
         return []
-    finally:
-        conn.close()
 
 
 #def get_model_colors_by_id(model_id):
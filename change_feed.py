@@ -0,0 +1,178 @@
+import json
+import sqlite3
+import time
+
+from query_builder import quote
+from schema import primary_key_column
+from table_stats import existing_triggers, literal
+
+# ---------------------------- Change feed ----------------------------
+# _changes logs every INSERT, UPDATE and DELETE of the user tables, written by triggers whoever writes (the app, an
+# import, a batch request, another process), with a sequence number that only ever grows (AUTOINCREMENT: numbers are
+# never reused, even after old entries are removed). Each entry holds the table, the operation, the row's rowid, its
+# key - the values of every column of the primary key, as a JSON array (see: key_columns) - and, for inserts and
+# updates, the new row as a JSON object. The key identifies the row: the rowid may change (e.g. VACUUM renumbers the rows
+# of a table without an INTEGER PRIMARY KEY).
+# A consumer keeps the last sequence number it has seen and asks for the entries after it (read_changes), instead of
+# reading whole tables again. It applies an insert or an update as 'store this row under its key' (the entry that
+# inserted a row may have been compacted away) and a delete as 'remove the row with this key if present'.
+# compact() removes the entries that a later entry with the same key supersedes (the latest entry always has the current
+# state of the row, so the result of a sync does not change) and, optionally, the entries older than a retention
+# period. The highest sequence number removed that way is kept as the 'horizon': a consumer whose last sequence number is
+# below it missed changes and has to read the tables again.
+# (Rows replaced by INSERT OR REPLACE are deleted without firing the DELETE trigger; their replacement is logged)
+# (Tables starting with '_' belong to the app and are not listed with the user tables, see: schema.py)
+
+OPERATIONS = ('insert', 'update', 'delete')
+
+# The time of a change, in seconds since the epoch (with fractions)
+NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+# Logging the changes of one table ('{table}' and '{trigger}' are quoted names, '{name}' the table name as an SQL
+# string, '{new_key}' and '{old_key}' a json_array() of the key of the new and old row, '{new_row}' a json_object() of
+# the new row). An UPDATE changing the key is logged as a delete of the old key and an insert of the new one
+INSERT_TRIGGER = """
+    CREATE TRIGGER {trigger} AFTER INSERT ON {table} BEGIN
+        INSERT INTO _changes (table_name, operation, row_id, row_key, row_data, changed_at)
+        VALUES ({name}, 'insert', new.rowid, {new_key}, {new_row}, {now});
+    END;
+"""
+UPDATE_TRIGGER = """
+    CREATE TRIGGER {trigger} AFTER UPDATE ON {table} BEGIN
+        INSERT INTO _changes (table_name, operation, row_id, row_key, row_data, changed_at)
+        SELECT {name}, 'delete', old.rowid, {old_key}, NULL, {now} WHERE {old_key} <> {new_key};
+        INSERT INTO _changes (table_name, operation, row_id, row_key, row_data, changed_at)
+        VALUES ({name}, CASE WHEN {old_key} <> {new_key} THEN 'insert' ELSE 'update' END, new.rowid, {new_key}, {new_row}, {now});
+    END;
+"""
+DELETE_TRIGGER = """
+    CREATE TRIGGER {trigger} AFTER DELETE ON {table} BEGIN
+        INSERT INTO _changes (table_name, operation, row_id, row_key, row_data, changed_at)
+        VALUES ({name}, 'delete', old.rowid, {old_key}, NULL, {now});
+    END;
+"""
+
+
+# Name of the trigger logging one operation on a table
+def trigger_name(table_name, operation):
+    return f"_changes_{table_name}_{operation}"
+
+
+# The columns identifying a row of the table: its primary key (all of its columns), or the column the app identifies
+# its rows with if it declares none (see: schema.primary_key_column)
+def key_columns(table):
+    return list(table['primary_key']) or [primary_key_column(table)]
+
+
+# The value of a column of the 'new' or 'old' row, BLOBs (which JSON cannot hold) as hexadecimal text
+def json_value(row, column):
+    return f"CASE WHEN typeof({row}.{quote(column)}) = 'blob' THEN hex({row}.{quote(column)}) ELSE {row}.{quote(column)} END"
+
+
+# json_object('column', new."column", ...)
+def row_json(columns):
+    values = ', '.join(f"{literal(column)}, {json_value('new', column)}" for column in columns)
+    return f"json_object({values})"
+
+
+# json_array(old."key 1", old."key 2", ...)
+def key_json(row, columns):
+    return f"json_array({', '.join(json_value(row, column) for column in columns)})"
+
+
+# What the triggers of a table are made from, kept in _change_feed_tables: they are created again when it changes
+def definition(table):
+    return {'columns': table['columns'], 'key': key_columns(table)}
+
+
+# ---------------------------- Defining a new function named 'ensure_change_feed' ----------------------------
+# Creating the change log and the triggers of every table of 'schema' (see: schema.load_schema) that does not have
+# them yet, lost one of them (e.g. the table was dropped and created again) or whose columns or primary key changed since
+# they were created (the JSON of the rows lists the columns). Tables that no longer exist are forgotten. Returns the names of the
+# tables whose triggers were (re)created.
+def ensure_change_feed(conn, schema):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS _changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, operation TEXT NOT NULL,
+                                             row_id INTEGER, row_key, row_data TEXT, changed_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS _change_feed_tables (table_name TEXT PRIMARY KEY, columns TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS _change_feed_state (id INTEGER PRIMARY KEY CHECK (id = 1), horizon INTEGER NOT NULL);
+        INSERT OR IGNORE INTO _change_feed_state (id, horizon) VALUES (1, 0);
+    """)
+    known = {row[0]: json.loads(row[1]) for row in conn.execute("SELECT table_name, columns FROM _change_feed_tables;")}
+    triggers = existing_triggers(conn)
+    changed = [table_name for table_name in schema if schema[table_name]['columns'] and
+               (known.get(table_name) != definition(schema[table_name]) or any(trigger_name(table_name, operation) not in triggers for operation in OPERATIONS))]
+    gone = [table_name for table_name in known if table_name not in schema]
+    if not changed and not gone:
+        return []
+
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        for table_name in gone: # (their triggers were dropped with them)
+            conn.execute("DELETE FROM _change_feed_tables WHERE table_name = ?;", (table_name,))
+        for table_name in changed:
+            table = schema[table_name]
+            names = {'table': quote(table_name), 'name': literal(table_name), 'new_key': key_json('new', key_columns(table)),
+                     'old_key': key_json('old', key_columns(table)), 'new_row': row_json(table['columns']), 'now': NOW}
+            for operation, template in zip(OPERATIONS, (INSERT_TRIGGER, UPDATE_TRIGGER, DELETE_TRIGGER)):
+                trigger = quote(trigger_name(table_name, operation))
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+                conn.execute(template.format(trigger=trigger, **names))
+            conn.execute("INSERT OR REPLACE INTO _change_feed_tables (table_name, columns) VALUES (?, ?);", (table_name, json.dumps(definition(table))))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return changed
+
+
+# ---------------------------- Reading the changes ----------------------------
+# Returning up to 'limit' changes with a sequence number above 'since', oldest first (only those of 'tables' if given):
+# [{'seq', 'table', 'operation', 'rowid', 'key', 'row', 'changed_at'}, ...] ('key' is the list of the values of the
+# primary key, 'row' is None for a delete).
+# Raises sqlite3.OperationalError if ensure_change_feed() was not run on this database
+def read_changes(conn, since=0, limit=1000, tables=None):
+    query = "SELECT seq, table_name, operation, row_id, row_key, row_data, changed_at FROM _changes WHERE seq > ?"
+    params = [since]
+    if tables:
+        query += " AND table_name IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(tables)))
+    rows = conn.execute(query + " ORDER BY seq LIMIT ?;", params + [limit]).fetchall()
+    return [{'seq': row[0], 'table': row[1], 'operation': row[2], 'rowid': row[3], 'key': parse_key(row[4]),
+             'row': json.loads(row[5]) if row[5] is not None else None, 'changed_at': row[6]} for row in rows]
+
+
+# Entries logged before the key was a JSON array hold the value of the first key column
+def parse_key(value):
+    if isinstance(value, str) and value.startswith('['):
+        return json.loads(value)
+    return None if value is None else [value]
+
+
+# Returning (last sequence number, horizon): the number of the latest change (0 if there was none) and the highest
+# number removed by compact(retention_seconds=...)
+def feed_position(conn):
+    last = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = '_changes';").fetchone()
+    horizon = conn.execute("SELECT horizon FROM _change_feed_state WHERE id = 1;").fetchone()
+    return (last[0] if last else 0), (horizon[0] if horizon else 0)
+
+
+# ---------------------------- Defining a new function named 'compact' ----------------------------
+# Removing the superseded entries and, with 'retention_seconds', every entry older than that. Returns
+# {'superseded': n, 'expired': n, 'horizon': seq}
+def compact(conn, retention_seconds=None):
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        superseded = conn.execute("DELETE FROM _changes WHERE seq NOT IN (SELECT MAX(seq) FROM _changes GROUP BY table_name, row_key);").rowcount
+        expired = 0
+        if retention_seconds is not None:
+            last_expired = conn.execute("SELECT MAX(seq) FROM _changes WHERE changed_at < ?;", (time.time() - retention_seconds,)).fetchone()[0]
+            if last_expired is not None:
+                expired = conn.execute("DELETE FROM _changes WHERE seq <= ?;", (last_expired,)).rowcount
+                conn.execute("UPDATE _change_feed_state SET horizon = MAX(horizon, ?) WHERE id = 1;", (last_expired,))
+        horizon = conn.execute("SELECT horizon FROM _change_feed_state WHERE id = 1;").fetchone()[0]
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return {'superseded': superseded, 'expired': expired, 'horizon': horizon}
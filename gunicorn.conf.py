@@ -0,0 +1,47 @@
+# ---------------------------- gunicorn settings ----------------------------
+# Read by gunicorn when it is started from this directory ('gunicorn wsgi:application', see: wsgi.py). Every setting
+# can be changed with an environment variable, e.g. CARS_WORKERS=8 gunicorn wsgi:application
+import multiprocessing
+import os
+import sys
+
+wsgi_app = 'wsgi:application'
+bind = os.environ.get('CARS_BIND', '127.0.0.1:8000')
+
+# Worker processes: each one has its own connection pool (DB_POOL_SIZE) and write queue. SQLite lets any number of
+# processes read at the same time (WAL mode) but only one write at a time, so more workers add read capacity
+workers = int(os.environ.get('CARS_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Threads per worker ('gthread' worker): the requests of one worker share its pool, its caches and its model index
+worker_class = os.environ.get('CARS_WORKER_CLASS', 'gthread')
+# A long-polling request (/api/v1/changes?wait=) or an event stream (/api/v1/changes/stream) holds one of these threads
+# for as long as it is open: at most CARS_CHANGE_FEED_MAX_WATCHERS of them per worker (default 2, see: app.py), the
+# next ones get '503 Service Unavailable'. Keep it below the number of threads, or the other requests of the worker wait
+# behind them. Serving many change feed clients takes more threads (or more workers), with the limit raised to match
+threads = int(os.environ.get('CARS_THREADS', 4))
+
+# Loading (and warming up, see: warmup.py) the app once in the master process, and forking the workers from it: a
+# new worker starts in a few milliseconds, already warm, and shares the loaded data with the others
+preload_app = os.environ.get('CARS_PRELOAD', '1') == '1'
+
+timeout = int(os.environ.get('CARS_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('CARS_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('CARS_KEEPALIVE', 5))
+# Restarting a worker after this many requests (0: never), with some jitter so they do not all restart at once
+max_requests = int(os.environ.get('CARS_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('CARS_MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.environ.get('CARS_ACCESS_LOG') # e.g. '-' for stdout
+loglevel = os.environ.get('CARS_LOG_LEVEL', 'info')
+
+
+# ---------------------------- Server hooks ----------------------------
+# The app is only imported by the master with preload_app, so the hooks do nothing when it was not loaded
+def pre_fork(server, worker):
+    if 'warmup' in sys.modules:
+        sys.modules['warmup'].before_fork()
+
+
+def post_fork(server, worker):
+    if 'wsgi' in sys.modules:
+        seconds = sys.modules['warmup'].after_fork(sys.modules['wsgi'].application)
+        server.log.info("Worker %s ready in %.3fs", worker.pid, seconds)
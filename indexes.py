@@ -0,0 +1,122 @@
+import itertools
+import sqlite3
+import sys
+
+import cars
+
+# ---------------------------- Indexes managed by the app ----------------------------
+# (index name, table, columns). They cover the joins and filters of get_customers, get_models and filter_customers:
+# - every join goes from a primary key to a foreign key column (or back), so each foreign key column gets an index
+# - the filter columns (brand_name, dealer_name, model_name, color, purchase_price, model_base_price) get an index that
+#   also contains the join key, so SQLite can find the matching rows and continue the join without reading the table
+MANAGED_INDEXES = [
+    ('idx_brands_brand_name', 'Brands', ['brand_name', 'brand_id']),
+    ('idx_dealers_dealer_name', 'Dealers', ['dealer_name', 'dealer_id']),
+    ('idx_models_brand_id', 'Models', ['brand_id', 'model_base_price']),
+    ('idx_models_model_name', 'Models', ['model_name', 'brand_id']),
+    ('idx_models_model_base_price', 'Models', ['model_base_price', 'brand_id']),
+    ('idx_car_options_model_id_color', 'Car_Options', ['model_id', 'color']),
+    ('idx_car_options_color_model_id', 'Car_Options', ['color', 'model_id']),
+    ('idx_car_vins_model_id', 'Car_Vins', ['model_id', 'vin']),
+    ('idx_customer_ownership_vin', 'Customer_Ownership', ['vin', 'customer_id', 'dealer_id', 'purchase_price']),
+    ('idx_customer_ownership_dealer_id', 'Customer_Ownership', ['dealer_id', 'purchase_price', 'vin', 'customer_id']),
+    ('idx_customer_ownership_purchase_price', 'Customer_Ownership', ['purchase_price', 'vin', 'customer_id', 'dealer_id']),
+]
+
+# Sample values used when building the queries for EXPLAIN QUERY PLAN (only the shape of the query matters)
+SAMPLE_FILTERS = {
+    'customers': (cars.build_customers_query, {'brand': 'x', 'dealer': 'x', 'purchase_price': 1, 'model': 'x'}),
+    'models': (cars.build_models_query, {'car_color': 'x', 'brand': 'x', 'price': 1}),
+    'filter_data': (cars.build_filter_query, {'customer_name': 'x', 'model_name': 'x', 'model_price': 1, 'dealer_name': 'x'}),
+}
+
+
+# ---------------------------- Defining a new function named 'ensure_indexes' ----------------------------
+# Creating the managed indexes that are missing (skipping tables/columns that do not exist in this database) and
+# refreshing the planner statistics with ANALYZE. Returns the names of the indexes that were created.
+def ensure_indexes(conn, analyze=True):
+    schema = cars.schema_cache.get(conn)
+    existing = {index['name'] for table in schema.values() for index in table['indexes']}
+    created = []
+    for name, table_name, columns in MANAGED_INDEXES:
+        table = schema.get(table_name)
+        if name in existing or table is None or not set(columns) <= set(table['columns']):
+            continue
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON "{table_name}" ({", ".join(columns)});')
+        created.append(name)
+    if created and analyze:
+        conn.execute("ANALYZE;") # Letting the query planner know how selective each new index is
+    conn.commit()
+    return created
+
+
+# ---------------------------- Defining a new function named 'drop_indexes' ----------------------------
+# Removing the managed indexes again (used by the benchmark to measure the 'before' numbers)
+def drop_indexes(conn):
+    for name, _, _ in MANAGED_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name};")
+    conn.commit()
+
+
+# ---------------------------- Defining a new function named 'filter_combinations' ----------------------------
+# Yielding (endpoint name, filters) for every combination of set/unset filters of every endpoint (2^n per endpoint)
+def filter_combinations():
+    for endpoint, (builder, sample) in SAMPLE_FILTERS.items():
+        names = list(sample)
+        for mask in itertools.product([False, True], repeat=len(names)):
+            yield endpoint, {name: sample[name] for name, used in zip(names, mask) if used}
+
+
+# ---------------------------- Defining a new function named 'table_row_counts' ----------------------------
+# Returning the (estimated) number of rows of every table: from the ANALYZE statistics in sqlite_stat1 when available
+# (the first number of the 'stat' column is the row count), otherwise with COUNT(*)
+def table_row_counts(conn):
+    counts = {}
+    try:
+        for table_name, stat in conn.execute("SELECT tbl, stat FROM sqlite_stat1;").fetchall():
+            counts[table_name] = max(counts.get(table_name, 0), int(stat.split()[0]))
+    except sqlite3.OperationalError: # No sqlite_stat1 table: ANALYZE was never run
+        pass
+    for table_name in cars.schema_cache.get(conn):
+        if table_name not in counts:
+            counts[table_name] = conn.execute(f'SELECT COUNT(*) FROM "{table_name}";').fetchone()[0]
+    return counts
+
+
+# ---------------------------- Defining a new function named 'check_query_plans' ----------------------------
+# Running EXPLAIN QUERY PLAN for every filter combination and flagging full scans of tables with more than 'min_rows'
+# rows (scanning a small lookup table such as Brands or Dealers is often the best plan). A query without any filter has
+# to read one table completely, so for those the first scan is expected and not reported.
+# Returns a list of dictionaries: {'endpoint', 'filters', 'plan', 'full_scans'}
+def check_query_plans(conn, min_rows=1000):
+    row_counts = table_row_counts(conn)
+    report = []
+    for endpoint, filters in filter_combinations():
+        builder = SAMPLE_FILTERS[endpoint][0]
+        query, params = builder(**filters)
+        # EXPLAIN QUERY PLAN rows: (id, parent, notused, detail), e.g. 'SEARCH Models USING INDEX ...' or 'SCAN Customers'
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+        scans = [step for step in plan if step.startswith('SCAN ')] # 'SCAN' reads a whole table (or a whole index), 'SEARCH' uses an index lookup
+        if not filters:
+            scans = scans[1:]
+        scans = [step for step in scans if row_counts.get(step.split()[1], 0) > min_rows] # 'SCAN <table> [USING ...]'
+        report.append({'endpoint': endpoint, 'filters': sorted(filters), 'plan': plan, 'full_scans': scans})
+    return report
+
+
+# Running the checker (and optionally creating the indexes) from the command line:
+#   python indexes.py           -> printing the plan report for the current database
+#   python indexes.py --create  -> creating the missing indexes first
+if __name__ == '__main__':
+    conn = sqlite3.connect(cars.DATABASE)
+    if '--create' in sys.argv:
+        print(f"Created indexes: {ensure_indexes(conn) or 'none'}")
+    problems = 0
+    for entry in check_query_plans(conn):
+        status = 'FULL SCAN' if entry['full_scans'] else 'ok'
+        print(f"{entry['endpoint']:<12} {','.join(entry['filters']) or '(no filters)':<45} {status}")
+        for step in entry['full_scans']:
+            print(f"    {step}")
+        problems += bool(entry['full_scans'])
+    conn.close()
+    sys.exit(1 if problems else 0)
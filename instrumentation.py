@@ -0,0 +1,365 @@
+import bisect
+import functools
+import inspect
+import logging
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import before_render_template, request, template_rendered
+
+# Logger of the slow query log (see: Metrics.record_query). Without any logging configuration, the messages go to stderr;
+# app.config['SLOW_QUERY_LOG'] sends them to a file instead
+slow_query_log = logging.getLogger('cars.slow_queries')
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Type and description of every metric, for the '# TYPE' and '# HELP' lines of the Prometheus output
+METRICS = {
+    'cars_request_seconds': ('histogram', "Time spent handling HTTP requests"),
+    'cars_query_seconds': ('histogram', "Time spent running SQL statements and fetching their rows, per statement fingerprint"),
+    'cars_query_rows_total': ('counter', "Rows fetched, per statement fingerprint"),
+    'cars_slow_queries_total': ('counter', "Statements slower than SLOW_QUERY_MS, per statement fingerprint"),
+    'cars_function_seconds': ('histogram', "Time spent in the data layer functions"),
+    'cars_pool_acquire_seconds': ('histogram', "Time spent checking out a pooled connection"),
+    'cars_template_seconds': ('histogram', "Time spent rendering templates"),
+    'cars_serialize_seconds': ('histogram', "Time spent serializing JSON responses"),
+    'cars_errors_total': ('counter', "Errors logged, per logger"),
+}
+
+
+# ---------------------------- Defining a new function named 'fingerprint' ----------------------------
+# Normalizing a SQL statement so every run of the same query ends up under one label: literals and parameters become
+# '?', lists of parameters '(...)', and comments and whitespace are dropped, e.g.
+#   "SELECT * FROM Models WHERE model_id IN (?, ?, ?) AND price <= 20000" -> "SELECT * FROM Models WHERE model_id IN (...) AND price <= ?"
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_PARAMETERS = re.compile(r"[:@$][A-Za-z_]\w*|\?\d*")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+_PRAGMA_ARGUMENTS = re.compile(r"^(PRAGMA\s+\w+)\s*\(.*\)", re.I) # PRAGMA index_info("idx_...") -> one label for every index
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    sql = _COMMENTS.sub(' ', sql)
+    sql = _STRINGS.sub('?', sql)
+    sql = _PARAMETERS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _LISTS.sub('(...)', sql)
+    sql = _PRAGMA_ARGUMENTS.sub(r'\1(?)', sql.strip())
+    return _SPACES.sub(' ', sql).strip().rstrip(';').rstrip()[:300]
+
+
+# ---------------------------- Defining a new class named 'Metrics' ----------------------------
+# Collecting timings (histograms) and counters, and rendering them in the Prometheus text format (see: /metrics in app.py).
+# Nothing is hooked into the app, the pool or the data layer unless app.config['METRICS_ENABLED'] (or SLOW_QUERY_MS, or
+# METRICS_TRACE_HEADER) is set, so a disabled instance costs nothing.
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.enabled = False
+        self.buckets = buckets
+        self.slow_query_seconds = None # Statements slower than this are logged (None: no slow query log)
+        self.trace_header = False # Adding a 'Server-Timing' header with the time spent per request in the database, templates, ...
+        self._lock = threading.Lock()
+        self._histograms = {} # (name, labels) -> [count per bucket ..., count above the last bucket, sum]
+        self._counters = {} # (name, labels) -> value
+        self._collectors = [] # (prefix, function returning a dictionary of numbers), read when rendering (e.g. pool.stats)
+        self._local = threading.local() # The timings of the request handled by the current thread
+
+    # Reading the settings from the Flask config and instrumenting the app, the connection pool and the given modules
+    def init_app(self, app, pool=None, modules=()):
+        slow_query_ms = app.config.get('SLOW_QUERY_MS')
+        self.slow_query_seconds = slow_query_ms / 1000 if slow_query_ms is not None else None
+        self.trace_header = app.config.get('METRICS_TRACE_HEADER', self.trace_header)
+        # The slow query log and the trace header need the same hooks as the metrics, so either one turns them on
+        self.enabled = bool(app.config.get('METRICS_ENABLED', self.enabled) or self.slow_query_seconds is not None or self.trace_header)
+        app.extensions['metrics'] = self
+        if not self.enabled:
+            return
+        if app.config.get('SLOW_QUERY_LOG'):
+            slow_query_log.addHandler(logging.FileHandler(app.config['SLOW_QUERY_LOG']))
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        if pool is not None:
+            self.instrument_pool(pool)
+        for module in modules:
+            self.instrument_module(module)
+            logging.getLogger(module.__name__).addFilter(self._count_error)
+
+    # ---------------------------- Recording ----------------------------
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # Timing a block of code: 'with metrics.timer('cars_serialize_seconds', trace='json'): ...'
+    @contextmanager
+    def timer(self, name, trace=None, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(name, elapsed, **labels)
+            if trace:
+                self._trace(trace, elapsed)
+
+    # Called by the instrumented cursors below once a statement is done (rows fetched, or nothing to fetch)
+    def record_query(self, sql, seconds, rows):
+        statement = fingerprint(sql)
+        self.observe('cars_query_seconds', seconds, fingerprint=statement)
+        if rows:
+            self.inc('cars_query_rows_total', rows, fingerprint=statement)
+        self._trace('db', seconds)
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            self.inc('cars_slow_queries_total', fingerprint=statement)
+            slow_query_log.warning("Slow query (%.1f ms, %d rows): %s", seconds * 1000, rows, ' '.join(sql.split()))
+
+    # Reading the number values of e.g. pool.stats() as gauges named '<prefix>_<key>' whenever the metrics are rendered
+    def add_stats(self, prefix, stats):
+        self._collectors.append((prefix, stats))
+
+    # Logging filter counting the errors logged by an instrumented module (it never filters anything out)
+    def _count_error(self, record):
+        if record.levelno >= logging.ERROR:
+            self.inc('cars_errors_total', logger=record.name)
+        return True
+
+    # ---------------------------- Instrumenting ----------------------------
+    # Replacing every public function of a module (e.g. cars) with a timed version. Generators are left alone, their
+    # time is spent while the caller iterates (their queries are still timed by the instrumented cursors)
+    def instrument_module(self, module):
+        for name, func in list(vars(module).items()):
+            if name.startswith('_') or not inspect.isfunction(func) or func.__module__ != module.__name__:
+                continue
+            if inspect.isgeneratorfunction(func) or hasattr(func, '__wrapped__'):
+                continue
+            setattr(module, name, self._timed(func, f"{module.__name__}.{name}"))
+
+    def _timed(self, func, label):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe('cars_function_seconds', time.perf_counter() - started, function=label)
+        return wrapper
+
+    # Timing the connection checkouts and opening instrumented connections from now on
+    def instrument_pool(self, pool):
+        acquire = pool.acquire
+
+        def timed_acquire():
+            with self.timer('cars_pool_acquire_seconds', trace='pool'):
+                return acquire()
+
+        pool.acquire = timed_acquire
+        pool.factory = InstrumentedConnection
+        pool.close_all() # Idle connections opened so far are plain ones
+        self.add_stats('cars_pool', pool.stats)
+
+    # ---------------------------- Per-request timings ----------------------------
+    def _start_request(self):
+        self._local.trace = {'started': time.perf_counter(), 'db': 0.0, 'pool': 0.0, 'render': 0.0, 'json': 0.0, 'queries': 0}
+        self._local.renders = []
+
+    def _trace(self, kind, seconds):
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace[kind] += seconds
+            if kind == 'db':
+                trace['queries'] += 1
+
+    def _finish_request(self, response):
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return response
+        self._local.trace = None
+        total = time.perf_counter() - trace['started']
+        self.observe('cars_request_seconds', total, endpoint=request.endpoint or 'none', method=request.method,
+                     status=str(response.status_code))
+        if self.trace_header:
+            # e.g. 'Server-Timing: db;dur=3.20;desc="5 queries", pool;dur=0.01, render;dur=8.41, json;dur=0.00, total;dur=12.95'
+            response.headers['Server-Timing'] = ', '.join([
+                f'db;dur={trace["db"] * 1000:.2f};desc="{trace["queries"]} queries"',
+                f'pool;dur={trace["pool"] * 1000:.2f}',
+                f'render;dur={trace["render"] * 1000:.2f}',
+                f'json;dur={trace["json"] * 1000:.2f}',
+                f'total;dur={total * 1000:.2f}',
+            ])
+        return response
+
+    def _start_render(self, sender, template, context, **extra):
+        renders = getattr(self._local, 'renders', None)
+        if renders is None:
+            renders = self._local.renders = []
+        renders.append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        renders = getattr(self._local, 'renders', None)
+        if not renders:
+            return
+        elapsed = time.perf_counter() - renders.pop()
+        self.observe('cars_template_seconds', elapsed, template=template.name or 'none')
+        self._trace('render', elapsed)
+
+    # ---------------------------- Defining a new function named 'render' ----------------------------
+    # Returning every metric in the Prometheus text format
+    def render(self):
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            counters = dict(self._counters)
+        samples = {} # name -> list of lines
+        for (name, labels), values in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {values[-1]!r}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+        for prefix, stats in self._collectors:
+            for key, value in stats().items():
+                if isinstance(value, (int, float)): # Booleans included, as 0 / 1
+                    samples.setdefault(f"{prefix}_{key}", []).append(f"{prefix}_{key} {float(value)!r}")
+
+        output = []
+        for name, lines in samples.items():
+            kind, description = METRICS.get(name, ('gauge', name.replace('_', ' ')))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+# ---------------------------- Instrumented connections ----------------------------
+# Connection and cursor classes timing every statement, from execute() until its last row is fetched (SQLite computes
+# the rows while they are fetched, so timing execute() alone would miss most of a SELECT). The pool opens its
+# connections with these classes once the metrics are enabled (see: Metrics.instrument_pool)
+class InstrumentedCursor(sqlite3.Cursor):
+    _statement = None # The statement being timed, until all of its rows are fetched
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._begin(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._begin(sql, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self._begin(sql_script, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, time.perf_counter() - started, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(len(rows), time.perf_counter() - started, len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), time.perf_counter() - started, True)
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self): # Statements whose rows were iterated over ('for row in cursor') end up here
+        self._finish()
+
+    def _begin(self, sql, seconds):
+        self._statement, self._seconds, self._rows = sql, seconds, 0
+        if self.description is None: # INSERT, UPDATE, ...: nothing to fetch
+            self._finish()
+
+    def _fetched(self, rows, seconds, done):
+        if self._statement is None:
+            return
+        self._seconds += seconds
+        self._rows += rows
+        if done:
+            self._finish()
+
+    def _finish(self):
+        if self._statement is None:
+            return
+        sql, self._statement = self._statement, None
+        metrics.record_query(sql, self._seconds, self._rows)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() and friends create their cursor internally (without calling cursor()), so they are
+    # redirected to an instrumented cursor
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self): # Timed as well: with synchronous=FULL/NORMAL the commit is where a write waits for the disk
+        if not self.in_transaction:
+            return super().commit()
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.record_query('COMMIT', time.perf_counter() - started, 0)
+
+
+# The instance used by the app (see: app.py), the pool and the data layer
+metrics = Metrics()
@@ -0,0 +1,142 @@
+import bisect
+import sqlite3
+import threading
+
+from table_stats import existing_triggers
+
+# ---------------------------- Materialized model colors ----------------------------
+# _model_colors keeps, for every model, the distinct colors it is offered in (a comma-separated list), so get_models no
+# longer runs GROUP_CONCAT over all of Car_Options on every request. Triggers update the row of a model whenever one of
+# its Car_Options rows changes, and bump the counter in _model_colors_version on every change of Car_Options, Models
+# or Brands. The in-memory index below is reloaded only when that counter has changed.
+# (Tables starting with '_' belong to the app and are not listed with the user tables, see: schema.py)
+
+# Recomputing the colors of one model ('{model_id}' is replaced by new.model_id / old.model_id in the triggers)
+REFRESH_MODEL = """
+    DELETE FROM _model_colors WHERE model_id = {model_id};
+    INSERT INTO _model_colors (model_id, colors)
+        SELECT {model_id}, group_concat(DISTINCT color) FROM Car_Options WHERE model_id = {model_id} HAVING COUNT(*) > 0;
+"""
+BUMP_VERSION = "UPDATE _model_colors_version SET version = version + 1 WHERE id = 1;"
+
+
+# Keeping _model_colors up to date: trigger name -> (table, event, statements)
+TRIGGERS = {
+    '_model_colors_options_insert': ('Car_Options', 'INSERT', REFRESH_MODEL.format(model_id='new.model_id') + BUMP_VERSION),
+    '_model_colors_options_delete': ('Car_Options', 'DELETE', REFRESH_MODEL.format(model_id='old.model_id') + BUMP_VERSION),
+    '_model_colors_options_update': ('Car_Options', 'UPDATE', REFRESH_MODEL.format(model_id='old.model_id') + REFRESH_MODEL.format(model_id='new.model_id') + BUMP_VERSION),
+    '_model_colors_models_insert': ('Models', 'INSERT', BUMP_VERSION),
+    '_model_colors_models_update': ('Models', 'UPDATE', BUMP_VERSION),
+    '_model_colors_models_delete': ('Models', 'DELETE', BUMP_VERSION),
+    '_model_colors_brands_insert': ('Brands', 'INSERT', BUMP_VERSION),
+    '_model_colors_brands_update': ('Brands', 'UPDATE', BUMP_VERSION),
+    '_model_colors_brands_delete': ('Brands', 'DELETE', BUMP_VERSION),
+}
+
+
+# ---------------------------- Defining a new function named 'ensure_model_colors' ----------------------------
+# Creating and filling the materialized table and its triggers if they do not exist yet. A trigger is dropped with its
+# table without any error (e.g. Car_Options dropped and created again), so the triggers are checked one by one in
+# sqlite_master: the missing ones are created again and the table is filled again, as the changes made without them
+# were not applied. Returns True if anything was (re)created.
+def ensure_model_colors(conn):
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    if not {'Car_Options', 'Models', 'Brands'} <= existing:
+        return False
+    triggers = existing_triggers(conn)
+    missing = [name for name in TRIGGERS if name not in triggers]
+    if '_model_colors' in existing and not missing:
+        return False
+
+    conn.execute("BEGIN IMMEDIATE;") # Filling the table and creating the triggers with the write lock held, so no change is missed
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS _model_colors (model_id INTEGER PRIMARY KEY, colors TEXT NOT NULL);")
+        conn.execute("CREATE TABLE IF NOT EXISTS _model_colors_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL);")
+        conn.execute("INSERT OR IGNORE INTO _model_colors_version (id, version) VALUES (1, 0);")
+        conn.execute("DELETE FROM _model_colors;")
+        conn.execute("""
+            INSERT INTO _model_colors (model_id, colors)
+                SELECT model_id, group_concat(DISTINCT color) FROM Car_Options WHERE model_id IS NOT NULL GROUP BY model_id;
+        """)
+        for name in missing:
+            table, event, statements = TRIGGERS[name]
+            conn.execute(f"CREATE TRIGGER {name} AFTER {event} ON {table} BEGIN {statements} END;")
+        conn.execute(BUMP_VERSION) # The in-memory indexes reload the refilled table
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return True
+
+
+# ---------------------------- Defining a new class named 'ModelColorIndex' ----------------------------
+# In-memory, column-oriented copy of the models: every filter is a set of model ids (ids per color, ids per brand,
+# ids up to a price), so get_models(car_color, brand, price) is just an intersection of sets.
+class ModelColorIndex:
+    def __init__(self):
+        self._version = None
+        self._lock = threading.Lock()
+        # (models, ids_by_color, ids_by_brand, prices), replaced as a whole on reload so readers never see a mix:
+        # - models: model_id -> Models row + 'brand_name' + 'possible_colors' (all colors of the model)
+        # - ids_by_color: color -> set of model ids
+        # - ids_by_brand: brand name -> set of model ids
+        # - prices: sorted list of (model_base_price, model_id), for 'price <=' lookups with bisect
+        self._data = ({}, {}, {}, [])
+
+    # Reloading the index if the models, colors or brands changed. Returns False if the materialized table is missing.
+    def refresh(self, conn):
+        try:
+            version = conn.execute("SELECT version FROM _model_colors_version WHERE id = 1;").fetchone()[0]
+        except sqlite3.OperationalError: # No such table: ensure_model_colors() was not run on this database
+            return False
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._load(conn)
+                    self._version = version
+        return True
+
+    def _load(self, conn):
+        # Same rows as the original query: only models that have a brand and at least one color
+        rows = conn.execute("""
+            SELECT Models.*, _model_colors.colors AS possible_colors, Brands.brand_name
+            FROM Models
+            JOIN _model_colors ON _model_colors.model_id = Models.model_id
+            JOIN Brands ON Brands.brand_id = Models.brand_id
+            ORDER BY Models.model_id;
+        """).fetchall()
+        models, ids_by_color, ids_by_brand, prices = {}, {}, {}, []
+        for row in rows:
+            model = dict(row)
+            model['possible_colors'] = model['possible_colors'].split(',')
+            model_id = model['model_id']
+            models[model_id] = model
+            for color in model['possible_colors']:
+                ids_by_color.setdefault(color, set()).add(model_id)
+            ids_by_brand.setdefault(model['brand_name'], set()).add(model_id)
+            if model['model_base_price'] is not None:
+                prices.append((model['model_base_price'], model_id))
+        prices.sort(key=lambda item: (item[0], item[1]))
+        self._data = (models, ids_by_color, ids_by_brand, prices)
+
+    # Returning the models matching all given filters, ordered by model_id, each with its full list of colors
+    def filter(self, car_color=None, brand=None, price=None):
+        models, ids_by_color, ids_by_brand, prices = self._data
+        ids = None
+        if car_color:
+            ids = set(ids_by_color.get(car_color, ()))
+        if brand:
+            brand_ids = ids_by_brand.get(brand, set())
+            ids = brand_ids.copy() if ids is None else ids & brand_ids
+        if price:
+            try:
+                limit = float(price)
+            except ValueError:
+                limit = None # Like SQLite, where a number compared with a non-numeric text is always smaller
+            if limit is not None:
+                end = bisect.bisect_right(prices, (limit, float('inf')))
+                price_ids = {model_id for _, model_id in prices[:end]}
+                ids = price_ids if ids is None else ids & price_ids
+        if ids is None:
+            ids = models.keys()
+        return [dict(models[model_id], possible_colors=list(models[model_id]['possible_colors'])) for model_id in sorted(ids)]
@@ -0,0 +1,222 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Default PRAGMA values applied to every pooled connection. They can be overridden per-app through
+# app.config['DB_PRAGMAS'] (see: ConnectionPool.init_app)
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',   # Write-Ahead Logging: readers do not block the writer and the writer does not block readers
+    'synchronous': 'NORMAL', # NORMAL is safe in WAL mode and avoids an fsync on every commit
+    'cache_size': -20000,    # Negative value = size in KiB -> ~20 MB of page cache per connection
+    'mmap_size': 268435456,  # Memory-mapping up to 256 MB of the database file for reads
+    'temp_store': 'MEMORY',  # Keeping temporary tables/indices (ORDER BY, GROUP BY) in memory
+    'busy_timeout': 5000,    # Waiting up to 5s for a lock instead of failing immediately with 'database is locked'
+}
+
+
+# ---------------------------- Defining a new class named 'ConnectionPool' ----------------------------
+# A fixed-size pool of SQLite connections. A thread checks out one connection and keeps it until the
+# outermost 'with pool.connection()' block (or the Flask request) ends, so nested calls from the same
+# request reuse the same connection instead of opening a new one.
+class ConnectionPool:
+    def __init__(self, database, size=5, timeout=30.0, pragmas=None, health_check_interval=30.0, factory=sqlite3.Connection,
+                 statement_cache_size=256):
+        self.database = database
+        self.factory = factory # Connection class, e.g. the instrumented one from instrumentation.py
+        self.size = size # Maximum number of connections the pool will ever open
+        self.timeout = timeout # Maximum number of seconds a thread waits for a free connection
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        # Number of compiled statements each connection keeps (sqlite3's cache keyed by SQL text). It has to hold every
+        # distinct statement the app runs, or statements are compiled again on each use (see: query_builder.py)
+        self.statement_cache_size = statement_cache_size
+        self.health_check_interval = health_check_interval # Idle connections older than this are checked with 'SELECT 1' before reuse
+        self._idle = [] # List of (connection, last_used_timestamp) tuples that are ready to be checked out
+        self._opened = 0 # Number of connections currently open (idle + in use)
+        self._lock = threading.Condition()
+        self._local = threading.local() # Per-thread state: the checked out connection and the nesting depth
+        self.closed = False # Set by close(): connections are closed when they are released instead of being kept
+        self._pid = os.getpid() # Process that opened the connections (a forked worker has to open its own)
+        self._inherited = [] # Connections opened before a fork: never used or closed again in this process
+        self._stats = {
+            'checkouts': 0,       # Number of connections handed out to threads
+            'connections_opened': 0,
+            'connections_discarded': 0, # Connections closed because they failed the health check
+            'waits': 0,           # Number of checkouts that had to wait for another thread to release a connection
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,        # Number of checkouts that gave up after 'timeout' seconds
+        }
+
+    # Reading pool settings from the Flask config and hooking the pool into the app lifecycle
+    def init_app(self, app):
+        self.database = app.config.get('DATABASE', self.database)
+        self.size = app.config.get('DB_POOL_SIZE', self.size)
+        self.timeout = app.config.get('DB_POOL_TIMEOUT', self.timeout)
+        self.health_check_interval = app.config.get('DB_HEALTH_CHECK_INTERVAL', self.health_check_interval)
+        self.pragmas.update(app.config.get('DB_PRAGMAS', {}))
+        self.statement_cache_size = app.config.get('DB_STATEMENT_CACHE_SIZE', self.statement_cache_size)
+        # Keeping the first connection a request checks out for the rest of that request ...
+        app.before_request(self.hold)
+        # ... and returning it to the pool once the request (application context) ends
+        app.teardown_appcontext(self._teardown)
+        app.extensions['db_pool'] = self
+
+    def _teardown(self, exception=None):
+        self.release_thread()
+
+    # Opening a new connection and applying the configured PRAGMAs. Also used for connections that live outside of the
+    # pool (e.g. the one of the write queue, see: writer.py)
+    def connect(self):
+        # check_same_thread=False: a pooled connection is used by one thread at a time, but not always the same thread
+        # A 'file:' database is opened as a URI (e.g. 'file:...?mode=ro', see: replica.py)
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False, factory=self.factory,
+                               cached_statements=self.statement_cache_size, uri=self.database.startswith('file:'))
+        conn.row_factory = sqlite3.Row # Getting results as dictionary-like rows, where the column names are used as keys
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    # Checking that an idle connection still works; returns False if it has to be replaced
+    def _is_healthy(self, conn, last_used):
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            conn.execute("SELECT 1;").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    # Taking a connection out of the pool, opening a new one if the pool is not full yet and waiting otherwise
+    def acquire(self):
+        started = time.monotonic()
+        waited = False
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._lock:
+            while True:
+                while self._idle:
+                    conn, last_used = self._idle.pop()
+                    if self._is_healthy(conn, last_used):
+                        self._record_checkout(started, waited)
+                        return conn
+                    conn.close()
+                    self._opened -= 1
+                    self._stats['connections_discarded'] += 1
+                if self._opened < self.size:
+                    self._opened += 1
+                    break # Opening the connection outside of the lock (see below)
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise sqlite3.OperationalError(f"Connection pool exhausted: no connection available after {self.timeout}s")
+                waited = True
+                self._lock.wait(remaining)
+        try:
+            conn = self.connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._opened -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._stats['connections_opened'] += 1
+            self._record_checkout(started, waited)
+        return conn
+
+    # Forgetting the connections of the parent process. They are kept (not closed), as closing them here could change
+    # the database files the parent is still using; the server should close them before forking (see: warmup.py)
+    def _after_fork(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._inherited += [conn for conn, _ in self._idle]
+            self._idle = []
+            self._opened = 0
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+    def _record_checkout(self, started, waited):
+        self._stats['checkouts'] += 1
+        if waited:
+            elapsed = time.monotonic() - started
+            self._stats['waits'] += 1
+            self._stats['wait_time_total'] += elapsed
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], elapsed)
+
+    # Putting a connection back into the pool (rolling back anything the caller left uncommitted)
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            discard = self.closed
+        except sqlite3.Error:
+            discard = True
+        if discard:
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+                self._stats['connections_discarded'] += 1
+                self._lock.notify()
+            return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    # Context manager used by the 'cars' functions. Re-entrant: nested blocks in the same thread share one connection
+    @contextmanager
+    def connection(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        local = self._local
+        if getattr(local, 'conn', None) is None:
+            local.conn = self.acquire()
+            local.depth = 0
+        local.depth += 1
+        try:
+            yield local.conn
+        finally:
+            local.depth -= 1
+            if local.depth == 0 and not getattr(local, 'held', False):
+                self.release_thread()
+
+    # Keeping the current thread's connection checked out until release_thread() is called (e.g. for a whole request)
+    def hold(self):
+        self._local.held = True
+
+    # Returning the current thread's connection to the pool (if it has one)
+    def release_thread(self):
+        local = self._local
+        local.held = False
+        conn = getattr(local, 'conn', None)
+        if conn is not None and getattr(local, 'depth', 0) == 0:
+            local.conn = None
+            self.release(conn)
+
+    # Closing every idle connection (e.g. on shutdown or after the database file was replaced)
+    def close_all(self):
+        with self._lock:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._opened -= 1
+            self._lock.notify_all()
+
+    # Closing the pool for good (e.g. a read pool over a replaced snapshot, see: replica.py): the idle connections now,
+    # the ones in use when they are released
+    def close(self):
+        with self._lock:
+            self.closed = True
+        self.close_all()
+
+    # Returning a snapshot of the pool metrics
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._opened
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._opened - len(self._idle)
+            stats['wait_time_avg'] = stats['wait_time_total'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
@@ -0,0 +1,181 @@
+import functools
+import json
+import sqlite3
+
+# ---------------------------- Query builder ----------------------------
+# Building the SQL of the 'cars' functions from canonical templates:
+#  - table and column names are checked against the schema (see: schema.py) and quoted, so a name coming from a URL or
+#    a form field can never change the statement ('/table/Customers;DROP TABLE Models' is rejected)
+#  - the same table / columns / filters always produce the same SQL string, built once and then read from a cache. As
+#    sqlite3 keeps the compiled statements of every connection in a cache keyed by the SQL text (its size is set by
+#    'cached_statements', see: pool.py), a request only binds new values to an already prepared statement
+
+# Maximum number of SQL strings kept per template (one per table / column combination seen)
+TEMPLATE_CACHE_SIZE = 512
+
+
+# Raised for a table or column that does not exist. It is an sqlite3.Error, so the 'cars' functions handle it like
+# any other database error (logged, then None / False / [] returned)
+class InvalidIdentifier(sqlite3.ProgrammingError):
+    pass
+
+
+# Quoting an identifier for SQLite ("name", with embedded quotes doubled)
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# ---------------------------- Defining a new function named 'check_table' ----------------------------
+# Returning the schema of a table (see: schema.load_schema), raising InvalidIdentifier if it is not a user table
+def check_table(schema, table_name):
+    table = schema.get(table_name) if isinstance(table_name, str) else None
+    if table is None:
+        raise InvalidIdentifier(f"Unknown table: {table_name!r}")
+    return table
+
+
+# Checking that every name is a column of the table; returns the names as a tuple (the key of the template caches)
+def check_columns(schema, table_name, columns):
+    table = check_table(schema, table_name)
+    known = set(table['columns'])
+    for column in columns:
+        if column not in known:
+            raise InvalidIdentifier(f"Unknown column of {table_name}: {column!r}")
+    return tuple(columns)
+
+
+# ---------------------------- Templates ----------------------------
+# Called with names that were already checked. 'key' is the column identifying a row (None -> rowid)
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def select_all_sql(table_name):
+    return f"SELECT * FROM {quote(table_name)};"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def count_sql(table_name):
+    return f"SELECT COUNT(*) FROM {quote(table_name)};"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def max_sql(table_name, key):
+    return f"SELECT MAX({quote(key)}) FROM {quote(table_name)};"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def select_by_key_sql(table_name, key):
+    return f"SELECT * FROM {quote(table_name)} WHERE {quote(key)} = ?;"
+
+
+# (Tables declared WITHOUT ROWID have no rowid: no row is found)
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def select_by_rowid_sql(table_name):
+    return f"SELECT * FROM {quote(table_name)} WHERE rowid = ?;"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def insert_sql(table_name, columns):
+    return f"INSERT INTO {quote(table_name)} ({', '.join(quote(column) for column in columns)}) VALUES ({', '.join(['?'] * len(columns))});"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def update_sql(table_name, columns, key):
+    return f"UPDATE {quote(table_name)} SET {', '.join(f'{quote(column)} = ?' for column in columns)} WHERE {quote(key)} = ?;"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def delete_sql(table_name, key):
+    return f"DELETE FROM {quote(table_name)} WHERE {quote(key)} = ?;"
+
+
+# ---------------------------- Batch templates ----------------------------
+# Statements on a list of keys (see: cars.get_records_by_ids, update_records and delete_records), one statement for
+# the whole list:
+#  - up to MAX_IN_KEYS keys: 'key IN (?, ?, ...)', with the list padded to the next power of two by repeating its last
+#    key (which changes nothing), so there are at most 10 statements per table to build and keep compiled
+#  - more keys: the list is sent as one JSON array parameter and read with json_each(), so it needs neither thousands
+#    of parameters (SQLite allows 32766 at most) nor a temporary table, which could not be written on the read-only
+#    connections (see: replica.py)
+MAX_IN_KEYS = 512
+
+
+# Returning the number of '?' of the statement for 'count' keys (None -> JSON array)
+def keys_bucket(count):
+    if count > MAX_IN_KEYS:
+        return None
+    return 1 << max(count - 1, 0).bit_length()
+
+
+# Returning the parameters of a keys_condition() for a list of keys (with the values of an UPDATE first)
+def keys_params(keys, values=()):
+    bucket = keys_bucket(len(keys))
+    if bucket is None:
+        return list(values) + [json.dumps(list(keys))]
+    return list(values) + list(keys) + [keys[-1]] * (bucket - len(keys))
+
+
+def keys_condition(key, bucket):
+    if bucket is None:
+        return f"{quote(key)} IN (SELECT value FROM json_each(?))"
+    return f"{quote(key)} IN ({', '.join(['?'] * bucket)})"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def select_by_keys_sql(table_name, key, bucket):
+    return f"SELECT * FROM {quote(table_name)} WHERE {keys_condition(key, bucket)};"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def update_by_keys_sql(table_name, columns, key, bucket):
+    return f"UPDATE {quote(table_name)} SET {', '.join(f'{quote(column)} = ?' for column in columns)} WHERE {keys_condition(key, bucket)};"
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def delete_by_keys_sql(table_name, key, bucket):
+    return f"DELETE FROM {quote(table_name)} WHERE {keys_condition(key, bucket)};"
+
+
+# Keyset pagination (see: cars.get_table_page). 'seek': None (first page), 'key' (after a key value) or 'key_rowid'
+# (after a key value and a rowid)
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def page_sql(table_name, key, seek):
+    order_column = quote(key) if key else 'rowid'
+    query = f"SELECT rowid AS _rowid_, * FROM {quote(table_name)}"
+    if seek == 'key_rowid':
+        query += f" WHERE ({order_column}, rowid) > (:after, :after_rowid)" # Row-value comparison (pk first, rowid second)
+    elif seek == 'key':
+        query += f" WHERE {order_column} > :after"
+    return query + f" ORDER BY {order_column}, rowid LIMIT :limit;"
+
+
+# ---------------------------- Defining a new class named 'FilterQuery' ----------------------------
+# A query with optional filters (e.g. get_customers: brand, dealer, purchase_price, model). Every combination of the
+# filters that are set is one 'shape' (at most 2^n of them), whose SQL is built once:
+#   query = FilterQuery(base, [('brand', "Brands.brand_name = :brand"), ...], suffix=" GROUP BY ...")
+#   sql, params = query.build(brand='Ferrari', dealer=None)   # -> base + " AND Brands.brand_name = :brand", {'brand': ...}
+# A filter is set when its value is truthy, as in the original builders. 'base' ends with a WHERE clause ('WHERE 1=1')
+class FilterQuery:
+    def __init__(self, base, filters, suffix=''):
+        self.base = base
+        self.filters = filters # List of (parameter name, condition using :parameter name)
+        self.suffix = suffix
+        self.sql = functools.lru_cache(maxsize=None)(self._sql) # SQL per shape (the tuple of the filters that are set)
+
+    def _sql(self, shape):
+        conditions = dict(self.filters)
+        return self.base + ''.join(f" AND {conditions[name]}" for name in shape) + self.suffix
+
+    def build(self, **values):
+        shape = tuple(name for name, _ in self.filters if values.get(name))
+        return self.sql(shape), {name: values[name] for name in shape}
+
+
+# Returning how often the templates were reused, e.g. for the /metrics page
+def stats():
+    stats = {'hits': 0, 'misses': 0, 'size': 0}
+    for template in (select_all_sql, count_sql, max_sql, select_by_key_sql, insert_sql, update_sql, delete_sql, page_sql,
+                     select_by_keys_sql, update_by_keys_sql, delete_by_keys_sql):
+        info = template.cache_info()
+        stats['hits'] += info.hits
+        stats['misses'] += info.misses
+        stats['size'] += info.currsize
+    return stats
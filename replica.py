@@ -0,0 +1,206 @@
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from pool import ConnectionPool
+
+log = logging.getLogger(__name__)
+
+# Where the read-only functions of 'cars' (tables, /customers, /models, /filter_data, reports, search) read from:
+#   'primary'   - the database file, through the main pool (default)
+#   'readonly'  - the database file opened read-only (mode=ro) with a large mmap_size: reads come straight from the
+#                 operating system's page cache, shared by every worker process. Sees every committed write
+#   'immutable' - like 'readonly', but SQLite is told the file never changes (immutable=1) and skips all locking, and
+#                 the write-ahead log with it. The log is checkpointed into the file before the readers are opened, so
+#                 they see what was written until then (e.g. the tables created when the app starts). Only for a
+#                 database nothing writes to afterwards (e.g. a published copy): later writes would not be seen, or worse
+#   'snapshot'  - an in-memory copy of the database made with the backup API, refreshed in the background when the
+#                 data has changed (at most every SNAPSHOT_REFRESH_INTERVAL seconds). No disk I/O at all, but reads
+#                 may be that many seconds old, and every worker process holds its own copy
+READ_MODES = ('primary', 'readonly', 'immutable', 'snapshot')
+
+# In-memory database shared by the connections of one process (it lives as long as one of them is open)
+SNAPSHOT_URI = "file:cars-snapshot-{pid}-{number}?mode=memory&cache=shared"
+
+
+# ---------------------------- Defining a new class named 'ReadReplica' ----------------------------
+# A second pool for the reads. Writes keep going to the primary pool and the write queue (see: writer.py).
+#   with replica.connection() as conn: ...   # same as pool.connection() in 'primary' mode
+class ReadReplica:
+    def __init__(self, primary, version=None, on_refresh=None):
+        self.primary = primary # The main pool: its database, settings and connection class are reused
+        self.version = version # Function returning a token that changes with the data (see: cars.database_version)
+        self.on_refresh = on_refresh # Called after a new snapshot is in place (e.g. to drop results cached from the old one)
+        self.mode = 'primary'
+        self.size = None # Connections in the read pool (None -> the size of the primary pool)
+        self.mmap_size = 1073741824 # 1 GB: the whole file is mapped for most databases
+        self.refresh_interval = 5.0 # Minimum seconds between two snapshots
+        self._pool = None
+        self._keeper = None # Connection keeping the current in-memory snapshot alive (it is freed with its last connection)
+        self._snapshot_version = None
+        self._checked = 0.0
+        self._refreshing = False
+        self._pid = None # Process that opened the read pool (a forked worker has to open its own)
+        self._numbers = itertools.count(1)
+        self._lock = threading.RLock() # Re-entrant: the first snapshot is taken while _current() holds it
+        self._stats = {
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'refresh_time_last': 0.0,
+            'refresh_time_total': 0.0,
+        }
+        self._refreshed_at = None
+
+    # Reading the settings from the Flask config
+    def init_app(self, app):
+        mode = app.config.get('READ_MODE', self.mode)
+        if mode not in READ_MODES:
+            raise ValueError(f"READ_MODE must be one of: {', '.join(READ_MODES)}")
+        self.mode = mode
+        self.size = app.config.get('READ_POOL_SIZE', self.size)
+        self.mmap_size = app.config.get('READ_MMAP_SIZE', self.mmap_size)
+        self.refresh_interval = app.config.get('SNAPSHOT_REFRESH_INTERVAL', self.refresh_interval)
+        app.extensions['read_replica'] = self
+
+    # ---------------------------- Defining a new function named 'connection' ----------------------------
+    # Context manager handing out a read-only connection (re-entrant, like pool.connection)
+    @contextmanager
+    def connection(self):
+        pool = self.primary if self.mode == 'primary' else self._current()
+        with pool.connection() as conn:
+            yield conn
+
+    def _current(self):
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._open()
+        elif self.mode == 'snapshot':
+            self._check()
+        return self._pool
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._pool = None
+        self._refreshing = False
+        if self.mode == 'snapshot':
+            self._refresh()
+            return
+        uri = f"file:{quote(os.path.abspath(self.primary.database))}?mode=ro"
+        if self.mode == 'immutable':
+            if self._checkpoint():
+                uri += '&immutable=1'
+            else: # Readers that skip the log would miss the writes still in it
+                log.error("Could not checkpoint the write-ahead log of %s, opening it read-only instead of immutable", self.primary.database)
+        self._pool = self._make_pool(uri)
+
+    # Copying every page of the write-ahead log into the database file and emptying the log. Returns False if some pages
+    # could not be copied (e.g. another connection is reading or writing them)
+    def _checkpoint(self):
+        conn = self.primary.connect()
+        try:
+            busy, log_pages, copied_pages = conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+        except sqlite3.Error as e:
+            log.error("Error checkpointing %s: %s", self.primary.database, e)
+            return False
+        finally:
+            conn.close()
+        return not busy and log_pages == copied_pages # (-1, -1 when the database is not in WAL mode)
+
+    # A pool over 'database' with the primary's settings, for reading only
+    def _make_pool(self, database):
+        pool = ConnectionPool(database, size=self.size or self.primary.size, timeout=self.primary.timeout, pragmas=self.primary.pragmas,
+                              health_check_interval=self.primary.health_check_interval, factory=self.primary.factory,
+                              statement_cache_size=self.primary.statement_cache_size)
+        for name in ('journal_mode', 'synchronous'): # Settings of the writer, which cannot be changed on a read-only file
+            pool.pragmas.pop(name, None)
+        pool.pragmas.update(query_only=1, mmap_size=self.mmap_size)
+        return pool
+
+    # ---------------------------- Snapshots ----------------------------
+    # Starting a refresh in the background if the data changed since the snapshot was taken. Readers keep using the
+    # current snapshot until the new one is complete
+    def _check(self):
+        now = time.monotonic()
+        if self._refreshing or now - self._checked < self.refresh_interval:
+            return
+        self._checked = now
+        if self.version is not None and self.version() == self._snapshot_version:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name='cars-snapshot', daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh()
+        except sqlite3.Error as e:
+            log.error("Error refreshing the database snapshot: %s", e)
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+        finally:
+            self._refreshing = False
+
+    # Copying the primary database into a new in-memory database and switching the reads over to it
+    def refresh(self):
+        with self._lock:
+            self._pid = os.getpid()
+        self._refresh()
+
+    def _refresh(self):
+        started = time.perf_counter()
+        version = self.version() if self.version is not None else None # Read first: a write during the copy makes the next check refresh again
+        name = SNAPSHOT_URI.format(pid=os.getpid(), number=next(self._numbers))
+        keeper = sqlite3.connect(name, uri=True, check_same_thread=False)
+        try:
+            source = self.primary.connect()
+            try:
+                source.backup(keeper) # Copying every page (a consistent view of the primary, writers are not blocked in WAL mode)
+            finally:
+                source.close()
+        except sqlite3.Error:
+            keeper.close()
+            raise
+        pool = self._make_pool(name)
+        pool.pragmas.pop('mmap_size') # Nothing to map, the pages are already in memory
+
+        with self._lock:
+            old_pool, old_keeper = self._pool, self._keeper
+            self._pool, self._keeper, self._snapshot_version = pool, keeper, version
+            self._refreshed_at = time.monotonic()
+            elapsed = time.perf_counter() - started
+            self._stats['refreshes'] += 1
+            self._stats['refresh_time_last'] = elapsed
+            self._stats['refresh_time_total'] += elapsed
+        if old_pool is not None:
+            old_pool.close() # Connections still reading the old snapshot are closed when they are released
+        if old_keeper is not None:
+            old_keeper.close()
+        if self.on_refresh is not None:
+            self.on_refresh()
+
+    # Closing the read pool and dropping the snapshot (e.g. before forking workers, see: warmup.py). The next read opens
+    # them again
+    def close(self):
+        with self._lock:
+            pool, keeper = self._pool, self._keeper
+            self._pool, self._keeper, self._snapshot_version, self._pid = None, None, None, None
+        if pool is not None:
+            pool.close()
+        if keeper is not None:
+            keeper.close()
+
+    # Returning a snapshot of the replica metrics
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mode'] = self.mode
+        stats['snapshot_age'] = time.monotonic() - self._refreshed_at if self._refreshed_at is not None else 0.0
+        return stats
@@ -0,0 +1,284 @@
+import calendar
+import re
+import sqlite3
+
+# ---------------------------- Sales reports ----------------------------
+# Aggregations over Customer_Ownership computed by SQLite (one GROUP BY query per report), so a dashboard gets a few
+# dozen rows instead of downloading every sale. Every report accepts the same filters:
+#   date_from / date_to: purchase_date range (inclusive, compared as text: '2020-01-01')
+#   min_price / max_price: purchase_price range
+#   brand / dealer: brand_name / dealer_name
+REPORTS = ('revenue', 'price_histogram', 'top_customers')
+
+# Groupings of the revenue report: the id and name columns, and the joins they need (see: JOINS)
+GROUPS = {
+    'brand': {'id': 'Brands.brand_id', 'name': 'Brands.brand_name', 'joins': ['models', 'brands']},
+    'model': {'id': 'Models.model_id', 'name': 'Models.model_name', 'joins': ['models']},
+    'dealer': {'id': 'Dealers.dealer_id', 'name': 'Dealers.dealer_name', 'joins': ['dealers']},
+}
+
+# Joins from the sales to the other tables, from Customer_Ownership and from a rollup table (see: ensure_rollups)
+JOINS = {
+    'models': "JOIN Car_Vins ON Car_Vins.vin = Customer_Ownership.vin JOIN Models ON Models.model_id = Car_Vins.model_id",
+    'brands': "JOIN Brands ON Brands.brand_id = Models.brand_id",
+    'dealers': "JOIN Dealers ON Dealers.dealer_id = Customer_Ownership.dealer_id",
+}
+ROLLUP_JOINS = {
+    'models': "JOIN Models ON Models.model_id = {rollup}.model_id",
+    'brands': "JOIN Brands ON Brands.brand_id = Models.brand_id",
+    'dealers': "JOIN Dealers ON Dealers.dealer_id = {rollup}.dealer_id",
+}
+
+
+# ---------------------------- Defining a new function named 'build_filters' ----------------------------
+# Returning the WHERE conditions, their parameters and the joins needed by the given filters
+def build_filters(filters):
+    conditions, params, joins = [], {}, []
+    if filters.get('date_from'):
+        conditions.append("Customer_Ownership.purchase_date >= :date_from")
+        params['date_from'] = filters['date_from']
+    if filters.get('date_to'):
+        conditions.append("Customer_Ownership.purchase_date <= :date_to")
+        params['date_to'] = filters['date_to']
+    if filters.get('min_price') is not None:
+        conditions.append("Customer_Ownership.purchase_price >= :min_price")
+        params['min_price'] = filters['min_price']
+    if filters.get('max_price') is not None:
+        conditions.append("Customer_Ownership.purchase_price <= :max_price")
+        params['max_price'] = filters['max_price']
+    if filters.get('brand'):
+        conditions.append("Brands.brand_name = :brand")
+        params['brand'] = filters['brand']
+        joins += ['models', 'brands']
+    if filters.get('dealer'):
+        conditions.append("Dealers.dealer_name = :dealer")
+        params['dealer'] = filters['dealer']
+        joins.append('dealers')
+    return conditions, params, joins
+
+
+def join_clause(names, joins=JOINS):
+    return ' '.join(joins[name] for name in JOINS if name in names) # In the order of JOINS (models before brands)
+
+
+def where_clause(conditions):
+    return 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+
+# ---------------------------- Defining a new function named 'build_revenue_query' ----------------------------
+# Number of sales, revenue and average price per brand, model or dealer, highest revenue first. Reads one of the
+# rollup tables instead of every sale when they exist and the filters allow it (see: rollup_for)
+def build_revenue_query(group_by='brand', limit=None, use_rollup=False, **filters):
+    group = GROUPS[group_by]
+    rollup = rollup_for(group_by, filters) if use_rollup else None
+    if rollup is not None:
+        conditions, params, joins = build_filters(dict(filters, date_from=None, date_to=None))
+        months = month_range(filters.get('date_from'), filters.get('date_to'))
+        if months[0]:
+            conditions.append(f"{rollup}.month >= :month_from")
+            params['month_from'] = months[0]
+        if months[1]:
+            conditions.append(f"{rollup}.month <= :month_to")
+            params['month_to'] = months[1]
+        if any(months):
+            conditions.append(f"{rollup}.month <> ''") # Sales without a date never match a date filter
+        rollup_joins = {name: join.format(rollup=rollup) for name, join in ROLLUP_JOINS.items()}
+        query = f"""
+            SELECT {group['id']} AS id, {group['name']} AS name, SUM({rollup}.sales) AS sales,
+                   SUM({rollup}.revenue) AS revenue, SUM({rollup}.revenue) * 1.0 / SUM({rollup}.sales) AS average_price
+            FROM {rollup} {join_clause(set(joins + group['joins']), rollup_joins)}
+            {where_clause(conditions)}
+            GROUP BY {group['id']}
+            HAVING SUM({rollup}.sales) > 0
+            ORDER BY revenue DESC, id"""
+    else:
+        conditions, params, joins = build_filters(filters)
+        query = f"""
+            SELECT {group['id']} AS id, {group['name']} AS name, COUNT(*) AS sales,
+                   SUM(Customer_Ownership.purchase_price) AS revenue, AVG(Customer_Ownership.purchase_price) AS average_price
+            FROM Customer_Ownership {join_clause(set(joins + group['joins']))}
+            {where_clause(conditions)}
+            GROUP BY {group['id']}
+            ORDER BY revenue DESC, id"""
+    if limit:
+        query += " LIMIT :limit"
+        params['limit'] = limit
+    return query, params
+
+
+# ---------------------------- Defining a new function named 'build_price_histogram_query' ----------------------------
+# Number of sales per purchase price bucket: [0, bucket_size), [bucket_size, 2 * bucket_size), ...
+def build_price_histogram_query(bucket_size=5000, **filters):
+    conditions, params, joins = build_filters(filters)
+    conditions.append("Customer_Ownership.purchase_price IS NOT NULL")
+    params['bucket_size'] = bucket_size
+    query = f"""
+        SELECT CAST(Customer_Ownership.purchase_price / :bucket_size AS INTEGER) * :bucket_size AS bucket_start,
+               COUNT(*) AS sales, SUM(Customer_Ownership.purchase_price) AS revenue
+        FROM Customer_Ownership {join_clause(set(joins))}
+        {where_clause(conditions)}
+        GROUP BY bucket_start
+        ORDER BY bucket_start"""
+    return query, params
+
+
+# ---------------------------- Defining a new function named 'build_top_customers_query' ----------------------------
+# The customers who spent the most (number of cars bought and total spent)
+def build_top_customers_query(limit=10, **filters):
+    conditions, params, joins = build_filters(filters)
+    params['limit'] = limit
+    query = f"""
+        SELECT Customers.customer_id, Customers.first_name, Customers.last_name, COUNT(*) AS cars,
+               SUM(Customer_Ownership.purchase_price) AS spent
+        FROM Customer_Ownership JOIN Customers ON Customers.customer_id = Customer_Ownership.customer_id
+        {join_clause(set(joins))}
+        {where_clause(conditions)}
+        GROUP BY Customer_Ownership.customer_id
+        ORDER BY spent DESC, Customers.customer_id
+        LIMIT :limit"""
+    return query, params
+
+
+# ---------------------------- Rollup tables ----------------------------
+# Sales and revenue per month and model (_sales_by_model) and per month and dealer (_sales_by_dealer), so the revenue
+# report reads at most (months x models) or (months x dealers) rows instead of every sale. Triggers keep them up to date
+# on every change of Customer_Ownership, and when a VIN changes model. Brands are looked up through Models at query
+# time, so moving a model to another brand needs no refresh. Sales whose VIN or dealer is unknown are kept under id 0.
+# Rows whose sales drop to 0 are left in place (the queries skip them), so a trigger only touches the rows it changes.
+ROLLUPS = {
+    '_sales_by_model': {'groups': ('brand', 'model'), 'filters': ('brand',)}, # Revenue per brand or model, brand filter
+    '_sales_by_dealer': {'groups': ('dealer',), 'filters': ('dealer',)},
+}
+MONTH = "substr(IFNULL({row}.purchase_date, ''), 1, 7)" # 'YYYY-MM'
+MODEL_OF_VIN = "IFNULL((SELECT model_id FROM Car_Vins WHERE vin = {vin}), 0)"
+POPULATE = {
+    '_sales_by_model': """
+        INSERT INTO _sales_by_model (month, model_id, sales, revenue)
+            SELECT substr(IFNULL(Customer_Ownership.purchase_date, ''), 1, 7), IFNULL(Car_Vins.model_id, 0), COUNT(*),
+                   IFNULL(SUM(Customer_Ownership.purchase_price), 0)
+            FROM Customer_Ownership LEFT JOIN Car_Vins ON Car_Vins.vin = Customer_Ownership.vin
+            GROUP BY 1, 2;
+    """,
+    '_sales_by_dealer': """
+        INSERT INTO _sales_by_dealer (month, dealer_id, sales, revenue)
+            SELECT substr(IFNULL(purchase_date, ''), 1, 7), IFNULL(dealer_id, 0), COUNT(*), IFNULL(SUM(purchase_price), 0)
+            FROM Customer_Ownership
+            GROUP BY 1, 2;
+    """,
+}
+# Adding (sign '') or removing (sign '-') one sale ('row' is new or old in a trigger)
+ADD_SALE = """
+    INSERT INTO {rollup} (month, {key}, sales, revenue)
+        SELECT {month}, {key_value}, {sign}1, {sign}IFNULL({row}.purchase_price, 0) WHERE 1
+        ON CONFLICT (month, {key}) DO UPDATE SET sales = sales + excluded.sales, revenue = revenue + excluded.revenue;
+"""
+# Adding or removing every sale of a VIN under a given model
+MOVE_VIN = """
+    INSERT INTO _sales_by_model (month, model_id, sales, revenue)
+        SELECT substr(IFNULL(purchase_date, ''), 1, 7), {model_id}, {sign}COUNT(*), {sign}IFNULL(SUM(purchase_price), 0)
+        FROM Customer_Ownership WHERE vin = {vin} GROUP BY 1
+        ON CONFLICT (month, model_id) DO UPDATE SET sales = sales + excluded.sales, revenue = revenue + excluded.revenue;
+"""
+
+
+def add_sale(row, sign):
+    return ''.join([
+        ADD_SALE.format(rollup='_sales_by_model', key='model_id', key_value=MODEL_OF_VIN.format(vin=f"{row}.vin"),
+                        month=MONTH.format(row=row), sign=sign, row=row),
+        ADD_SALE.format(rollup='_sales_by_dealer', key='dealer_id', key_value=f"IFNULL({row}.dealer_id, 0)",
+                        month=MONTH.format(row=row), sign=sign, row=row),
+    ])
+
+
+def move_vin(row, from_model, to_model):
+    return MOVE_VIN.format(model_id=from_model, sign='-', vin=f"{row}.vin") + MOVE_VIN.format(model_id=to_model, sign='', vin=f"{row}.vin")
+
+
+# ---------------------------- Defining a new function named 'month_range' ----------------------------
+# Turning the date filters into whole months for the rollups: ('2020-01-01', '2020-12-31') -> ('2020-01', '2020-12').
+# Returns None if a date is not the first (date_from) or last (date_to) day of a month
+def month_range(date_from, date_to):
+    months = []
+    for date, first in ((date_from, True), (date_to, False)):
+        if not date:
+            months.append(None)
+            continue
+        match = re.fullmatch(r'(\d{4})-(\d{2})-(\d{2})', date)
+        if match is None:
+            return None
+        year, month, day = (int(part) for part in match.groups())
+        if not 1 <= month <= 12 or day != (1 if first else calendar.monthrange(year, month)[1]):
+            return None
+        months.append(f"{year:04d}-{month:02d}")
+    return tuple(months)
+
+
+# ---------------------------- Defining a new function named 'rollup_for' ----------------------------
+# The rollup table that can answer a revenue report, or None if it needs the sales themselves (price filters, dates
+# inside a month, or a filter on the other dimension, e.g. revenue per brand at one dealer)
+def rollup_for(group_by, filters):
+    if filters.get('min_price') is not None or filters.get('max_price') is not None:
+        return None
+    if month_range(filters.get('date_from'), filters.get('date_to')) is None:
+        return None
+    for rollup, spec in ROLLUPS.items():
+        other_filters = [name for name in ('brand', 'dealer') if filters.get(name) and name not in spec['filters']]
+        if group_by in spec['groups'] and not other_filters:
+            return rollup
+    return None
+
+
+# ---------------------------- Defining a new function named 'ensure_rollups' ----------------------------
+# Creating and filling the rollup tables and their triggers if they do not exist yet. Returns True if they were created.
+def ensure_rollups(conn):
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    if '_sales_by_model' in existing or not {'Customer_Ownership', 'Car_Vins'} <= existing:
+        return False
+    conn.executescript(f"""
+        BEGIN;
+        CREATE TABLE _sales_by_model (month TEXT NOT NULL, model_id INTEGER NOT NULL, sales INTEGER NOT NULL, revenue NUMERIC NOT NULL, PRIMARY KEY (month, model_id));
+        CREATE TABLE _sales_by_dealer (month TEXT NOT NULL, dealer_id INTEGER NOT NULL, sales INTEGER NOT NULL, revenue NUMERIC NOT NULL, PRIMARY KEY (month, dealer_id));
+        {POPULATE['_sales_by_model']}
+        {POPULATE['_sales_by_dealer']}
+
+        CREATE TRIGGER _sales_rollup_insert AFTER INSERT ON Customer_Ownership BEGIN
+            {add_sale('new', '')}
+        END;
+        CREATE TRIGGER _sales_rollup_delete AFTER DELETE ON Customer_Ownership BEGIN
+            {add_sale('old', '-')}
+        END;
+        CREATE TRIGGER _sales_rollup_update AFTER UPDATE OF vin, purchase_date, purchase_price, dealer_id ON Customer_Ownership BEGIN
+            {add_sale('old', '-')} {add_sale('new', '')}
+        END;
+        CREATE TRIGGER _sales_rollup_vins_insert AFTER INSERT ON Car_Vins BEGIN
+            {move_vin('new', '0', 'IFNULL(new.model_id, 0)')}
+        END;
+        CREATE TRIGGER _sales_rollup_vins_delete AFTER DELETE ON Car_Vins BEGIN
+            {move_vin('old', 'IFNULL(old.model_id, 0)', '0')}
+        END;
+        CREATE TRIGGER _sales_rollup_vins_update AFTER UPDATE OF vin, model_id ON Car_Vins BEGIN
+            {move_vin('old', 'IFNULL(old.model_id, 0)', '0')} {move_vin('new', '0', 'IFNULL(new.model_id, 0)')}
+        END;
+        COMMIT;
+    """)
+    return True
+
+
+# Rebuilding the rollup tables from scratch (e.g. after rows were changed with the triggers dropped)
+def rebuild_rollups(conn):
+    conn.executescript(f"""
+        BEGIN;
+        DELETE FROM _sales_by_model;
+        DELETE FROM _sales_by_dealer;
+        {POPULATE['_sales_by_model']}
+        {POPULATE['_sales_by_dealer']}
+        COMMIT;
+    """)
+
+
+def has_rollups(conn):
+    try:
+        conn.execute("SELECT 1 FROM _sales_by_model LIMIT 1;").fetchall()
+        return True
+    except sqlite3.OperationalError: # No such table
+        return False
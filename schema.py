@@ -0,0 +1,102 @@
+import threading
+
+
+# ---------------------------- Defining a new function named 'load_schema' ----------------------------
+# Reading the structure of every user table with PRAGMA table_info / foreign_key_list / index_list.
+# Returns a dictionary: table name -> {'columns', 'column_types', 'primary_key', 'not_null', 'foreign_keys', 'indexes'}
+def load_schema(conn):
+    tables = {}
+    virtual = load_virtual_tables(conn)
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY rowid;")]
+    for name in names:
+        if name.startswith('sqlite_'): # Skipping SQLite's internal tables (sqlite_sequence, sqlite_stat1, ...)
+            continue
+        if name.startswith('_'): # Skipping the app's own tables (materialized data, counters, ...)
+            continue
+        if name in virtual or is_shadow_table(name, virtual): # Skipping full-text search indexes (see: search.py) and their storage tables
+            continue
+        # table_info rows: (cid, name, type, notnull, dflt_value, pk) - 'pk' is the 1-based position in the primary key, 0 otherwise
+        columns = conn.execute(f'PRAGMA table_info("{name}");').fetchall()
+        # foreign_key_list rows: (id, seq, table, from, to, on_update, on_delete, match)
+        foreign_keys = conn.execute(f'PRAGMA foreign_key_list("{name}");').fetchall()
+        # index_list rows: (seq, name, unique, origin, partial)
+        indexes = []
+        for index in conn.execute(f'PRAGMA index_list("{name}");').fetchall():
+            index_columns = [row[2] for row in conn.execute(f'PRAGMA index_info("{index[1]}");').fetchall()]
+            indexes.append({'name': index[1], 'unique': bool(index[2]), 'columns': index_columns})
+        tables[name] = {
+            'columns': [column[1] for column in columns],
+            'column_types': {column[1]: column[2] for column in columns},
+            'primary_key': [column[1] for column in sorted(columns, key=lambda c: c[5]) if column[5] > 0],
+            'not_null': [column[1] for column in columns if column[3] and column[4] is None], # NOT NULL columns without a default value
+            'foreign_keys': [{'column': fk[3], 'table': fk[2], 'to': fk[4]} for fk in foreign_keys],
+            'indexes': indexes,
+        }
+    return tables
+
+
+# ---------------------------- Defining a new function named 'load_virtual_tables' ----------------------------
+# Returning the names of the virtual tables (e.g. FTS5 search indexes)
+def load_virtual_tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND sql LIKE 'CREATE VIRTUAL TABLE%';")}
+
+
+# Checking if a table is one of the 'shadow' tables a virtual table stores its data in ('<virtual table>_data', ...)
+def is_shadow_table(name, virtual_tables):
+    return any(name == f"{table}{suffix}" for table in virtual_tables for suffix in ('_data', '_idx', '_content', '_docsize', '_config'))
+
+
+# ---------------------------- Defining a new class named 'SchemaCache' ----------------------------
+# Keeping the result of load_schema() in memory. Every lookup first reads PRAGMA schema_version (a counter stored in
+# the database header that SQLite increments on every CREATE/ALTER/DROP, from any connection or process), and the
+# schema is only loaded again when that number has changed - so the cache can never go stale.
+class SchemaCache:
+    def __init__(self):
+        self._version = None
+        self._tables = {}
+        self._virtual_tables = set()
+        self._lock = threading.Lock()
+        # Functions called as listener(conn, tables) after the schema was reloaded because it changed (e.g. to recreate
+        # the triggers of a table that was dropped and created again). They run on a connection outside of a
+        # transaction: if the reload happened inside one, they run at the next get()
+        self.listeners = []
+        self._notify = False
+
+    def _refresh(self, conn):
+        version = conn.execute("PRAGMA schema_version;").fetchone()[0]
+        if version != self._version:
+            with self._lock:
+                if version != self._version: # Another thread may have reloaded it while we were waiting for the lock
+                    self._tables = load_schema(conn)
+                    self._virtual_tables = load_virtual_tables(conn)
+                    self._notify = True
+                    self._version = version
+        if self._notify and not conn.in_transaction:
+            self._notify = False
+            for listener in self.listeners:
+                listener(conn, self._tables)
+
+    def get(self, conn):
+        self._refresh(conn)
+        return self._tables
+
+    # Returning the names of the virtual tables (not part of get(), which only lists the tables users work with)
+    def virtual_tables(self, conn):
+        self._refresh(conn)
+        return self._virtual_tables
+
+    # Forgetting the cached schema (the next get() reloads it)
+    def clear(self):
+        with self._lock:
+            self._version = None
+            self._tables = {}
+            self._virtual_tables = set()
+
+
+# ---------------------------- Defining a new function named 'primary_key_column' ----------------------------
+# Returning the single column used to identify a row of the table (in the edit/delete forms and for pagination):
+# the first column of the declared primary key or, if the table declares none, its first column
+def primary_key_column(table):
+    if table['primary_key']:
+        return table['primary_key'][0]
+    return table['columns'][0] if table['columns'] else None
@@ -0,0 +1,98 @@
+import logging
+import re
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+# ---------------------------- Full-text search indexes ----------------------------
+# One FTS5 index per searchable table. They are 'external content' indexes: the text stays in the original table and
+# the index only stores the tokens, keyed by the table's integer id (used as the FTS rowid). Triggers keep them in sync
+# with every INSERT/UPDATE/DELETE, whether it comes from the app or from another program.
+SEARCH_TABLES = {
+    'customers': {'table': 'Customers', 'key': 'customer_id', 'columns': ['first_name', 'last_name']},
+    'models': {'table': 'Models', 'key': 'model_id', 'columns': ['model_name']},
+    'dealers': {'table': 'Dealers', 'key': 'dealer_id', 'columns': ['dealer_name']},
+}
+
+
+def search_table_name(table_name):
+    return f"{table_name}_search"
+
+
+# ---------------------------- Defining a new function named 'ensure_search_index' ----------------------------
+# Creating the FTS5 indexes and their triggers that are missing, and filling new indexes from the existing rows.
+# Returns the names of the indexes that were created (raises sqlite3.OperationalError if SQLite lacks FTS5).
+def ensure_search_index(conn):
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    created = []
+    for spec in SEARCH_TABLES.values():
+        table, key, columns = spec['table'], spec['key'], spec['columns']
+        fts = search_table_name(table)
+        if table not in existing or fts in existing:
+            continue
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f"new.{column}" for column in columns)
+        old_values = ', '.join(f"old.{column}" for column in columns)
+        # prefix='2 3': also indexing the first 2 and 3 characters of every token, so short prefix queries ("Fe"*) stay fast
+        conn.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({column_list}, content='{table}', content_rowid='{key}', prefix='2 3');")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {column_list}) VALUES (new.{key}, {new_values});
+        END;""")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', old.{key}, {old_values});
+        END;""")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', old.{key}, {old_values});
+            INSERT INTO {fts} (rowid, {column_list}) VALUES (new.{key}, {new_values});
+        END;""")
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild');") # Indexing the rows that are already in the table
+        created.append(fts)
+    conn.commit()
+    return created
+
+
+# ---------------------------- Defining a new function named 'to_match_query' ----------------------------
+# Turning what the user typed into an FTS5 query: every word becomes a quoted prefix term ("ferr"* matches 'Ferrari')
+# and all words have to match. 'column' limits the match to one column of the index. Returns None if there is no word.
+def to_match_query(text, column=None):
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    query = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+    return f"{column} : ({query})" if column else query
+
+
+# ---------------------------- Defining a new function named 'search' ----------------------------
+# Ranked search over customers, models and dealers. Returns a dictionary: kind -> list of matching rows (best first,
+# ordered by FTS5's bm25 'rank'), each with the table's columns, a 'rank' and a highlighted 'snippet'
+def search(conn, text, kinds=None, limit=20):
+    match = to_match_query(text)
+    results = {}
+    for kind in kinds or SEARCH_TABLES:
+        spec = SEARCH_TABLES[kind]
+        table, key, fts = spec['table'], spec['key'], search_table_name(spec['table'])
+        if match is None:
+            results[kind] = []
+            continue
+        rows = conn.execute(f"""
+            SELECT {table}.*, {fts}.rank AS rank, highlight({fts}, 0, '<b>', '</b>') AS snippet
+            FROM {fts}
+            JOIN {table} ON {table}.{key} = {fts}.rowid
+            WHERE {fts} MATCH :match
+            ORDER BY {fts}.rank
+            LIMIT :limit
+        """, {'match': match, 'limit': limit}).fetchall()
+        results[kind] = [dict(row) for row in rows]
+    return results
+
+
+# ---------------------------- Defining a new function named 'rebuild' ----------------------------
+# Rebuilding every search index from its table (e.g. after the table was changed with triggers disabled)
+def rebuild(conn):
+    for spec in SEARCH_TABLES.values():
+        fts = search_table_name(spec['table'])
+        try:
+            conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild');")
+        except sqlite3.OperationalError as e:
+            log.error("Error rebuilding search index %s: %s", fts, e)
+    conn.commit()
@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup, escape
+
+# ---------------------------- Rendering the rows of table_data.html ----------------------------
+# Going through Jinja for every cell ('{% for cell in row.values() %}<td>{{ cell }}</td>') costs more than the query
+# on big tables. Here the <tr> rows are built in Python, many rows per string, and handed to the template as
+# ready-made Markup chunks: the template only writes them out, and a streamed page is sent chunk by chunk.
+# The cells are escaped exactly as '{{ cell }}' would (None is shown as 'None').
+
+CHUNK_ROWS = 500 # Rows per chunk (one write to the client when streaming)
+
+
+def render_cell(value):
+    if isinstance(value, (int, float)): # Nothing to escape in a number (the most common cell)
+        return str(value)
+    return escape(value)
+
+
+# ---------------------------- Defining a new function named 'render_rows' ----------------------------
+# Generator: yielding the <tr> elements of 'rows' (dictionaries, or sequences of values in column order) as Markup
+# chunks of 'chunk_rows' rows. Yields nothing for no rows (so the template's '{% else %}' shows 'No data found')
+def render_rows(rows, chunk_rows=CHUNK_ROWS):
+    parts = []
+    for row in rows:
+        values = row.values() if isinstance(row, dict) else row
+        parts.append('<tr><td>' + '</td><td>'.join([render_cell(value) for value in values]) + '</td></tr>\n')
+        if len(parts) >= chunk_rows:
+            yield Markup(''.join(parts))
+            parts = []
+    if parts:
+        yield Markup(''.join(parts))
+
+
+# ---------------------------- Defining a new class named 'FragmentCache' ----------------------------
+# Keeping the rendered rows of whole tables in memory, so an unchanged table is sent again without reading or rendering
+# a single row. The key includes the data version (see: cars.data_version), so every write makes the old entries
+# unreachable (they are then evicted as the least recently used). Tables rendering to more than 'max_entry_size'
+# characters are streamed without being kept, so the memory used stays flat whatever the size of the table.
+class FragmentCache:
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=16 * 1024 * 1024):
+        self.max_size = max_size # Characters kept in total (0 disables the cache)
+        self.max_entry_size = max_entry_size
+        self._entries = OrderedDict() # key -> (chunks, size), least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stored': 0, 'too_large': 0, 'evictions': 0}
+
+    # Reading the settings from the Flask config
+    def init_app(self, app):
+        self.max_size = app.config.get('TABLE_FRAGMENT_CACHE_SIZE', self.max_size)
+        self.max_entry_size = app.config.get('TABLE_FRAGMENT_MAX_ENTRY_SIZE', self.max_entry_size)
+        app.extensions['fragment_cache'] = self
+
+    # ---------------------------- Defining a new function named 'chunks' ----------------------------
+    # Generator: yielding the cached chunks for 'key', or the chunks of make_chunks() (keeping them for the next time
+    # once they have all been sent; nothing is kept if the client went away before the end)
+    def chunks(self, key, make_chunks):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+        if entry is not None:
+            yield from entry[0]
+            return
+
+        kept, size = ([], 0) if self.max_size else (None, 0)
+        for chunk in make_chunks():
+            yield chunk
+            if kept is not None:
+                kept.append(chunk)
+                size += len(chunk)
+                if size > self.max_entry_size:
+                    kept = None
+                    with self._lock:
+                        self._stats['too_large'] += 1
+        if kept is not None:
+            self._store(key, kept, size)
+
+    def _store(self, key, chunks, size):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (chunks, size)
+            self._size += size
+            self._stats['stored'] += 1
+            while self._size > self.max_size and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    # Returning a snapshot of the cache metrics
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['size'] = self._size
+        return stats
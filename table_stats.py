@@ -0,0 +1,155 @@
+import sqlite3
+import time
+
+from query_builder import quote
+from schema import primary_key_column
+
+# ---------------------------- Table statistics ----------------------------
+# _table_stats keeps the number of rows and the largest key (see: schema.primary_key_column) of every user table, kept
+# exact by triggers on every INSERT / DELETE / UPDATE of the key, whoever writes (the app, an import, another process).
+# Reading a count is then one primary key lookup whatever the size of the table, instead of a full scan (COUNT(*)).
+# _column_stats holds the number of distinct values, NULLs, and the smallest and largest value of every column. These
+# cannot be kept up to date row by row, so they are computed by analyze(), which also runs ANALYZE (the statistics in
+# sqlite_stat1 that the query planner uses to choose indexes) and corrects the row counts if they ever drifted
+# (e.g. rows replaced by INSERT OR REPLACE, which deletes without firing the DELETE triggers).
+# (Tables starting with '_' belong to the app and are not listed with the user tables, see: schema.py)
+
+# Keeping one table's counters up to date ('{table}' and '{key}' are quoted names, '{name}' the name as an SQL string)
+INSERT_TRIGGER = """
+    CREATE TRIGGER {trigger} AFTER INSERT ON {table} BEGIN
+        UPDATE _table_stats SET row_count = row_count + 1,
+            max_key = CASE WHEN max_key IS NULL OR new.{key} > max_key THEN new.{key} ELSE max_key END
+        WHERE table_name = {name};
+    END;
+"""
+DELETE_TRIGGER = """
+    CREATE TRIGGER {trigger} AFTER DELETE ON {table} BEGIN
+        UPDATE _table_stats SET row_count = row_count - 1,
+            max_key = CASE WHEN old.{key} >= max_key THEN (SELECT MAX({key}) FROM {table}) ELSE max_key END
+        WHERE table_name = {name};
+    END;
+"""
+UPDATE_TRIGGER = """
+    CREATE TRIGGER {trigger} AFTER UPDATE OF {key} ON {table} BEGIN
+        UPDATE _table_stats SET
+            max_key = CASE WHEN max_key IS NULL OR new.{key} > max_key THEN new.{key}
+                           WHEN old.{key} >= max_key THEN (SELECT MAX({key}) FROM {table}) ELSE max_key END
+        WHERE table_name = {name};
+    END;
+"""
+
+
+# Quoting a value as an SQL string literal (for the table names inside the triggers)
+def literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+EVENTS = ('insert', 'delete', 'update')
+
+
+# Name of the trigger keeping the counters of a table up to date on one event
+def trigger_name(table_name, event):
+    return f"_table_stats_{table_name}_{event}"
+
+
+# Returning the names of the triggers in the database (a trigger is dropped with its table, without any error, so a
+# table dropped and created again has lost them)
+def existing_triggers(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger';")}
+
+
+# ---------------------------- Defining a new function named 'ensure_table_stats' ----------------------------
+# Creating the statistics tables, and the counters and triggers of every table of 'schema' (see: schema.load_schema)
+# that does not have them yet. A table that lost one of its triggers (e.g. it was dropped and created again) is counted
+# again and gets them back. Tables that no longer exist are forgotten. Returns the names of the tables (re)added.
+def ensure_table_stats(conn, schema):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS _table_stats (table_name TEXT PRIMARY KEY, key_column TEXT, row_count INTEGER NOT NULL,
+                                                 max_key, analyzed_at REAL);
+        CREATE TABLE IF NOT EXISTS _column_stats (table_name TEXT NOT NULL, column_name TEXT NOT NULL, distinct_count INTEGER,
+                                                  null_count INTEGER, min_value, max_value, PRIMARY KEY (table_name, column_name));
+    """)
+    known = {row[0] for row in conn.execute("SELECT table_name FROM _table_stats;")}
+    triggers = existing_triggers(conn)
+    added = [table_name for table_name in schema if schema[table_name]['columns'] and
+             (table_name not in known or any(trigger_name(table_name, event) not in triggers for event in EVENTS))]
+    gone = [table_name for table_name in known if table_name not in schema]
+    if not added and not gone:
+        return []
+
+    conn.execute("BEGIN IMMEDIATE;") # Counting and creating the triggers with the write lock held, so no row is missed
+    try:
+        for table_name in gone: # (their triggers were dropped with them)
+            conn.execute("DELETE FROM _table_stats WHERE table_name = ?;", (table_name,))
+            conn.execute("DELETE FROM _column_stats WHERE table_name = ?;", (table_name,))
+        for table_name in added:
+            key = primary_key_column(schema[table_name])
+            names = {'table': quote(table_name), 'key': quote(key), 'name': literal(table_name)}
+            row_count, max_key = conn.execute(f"SELECT COUNT(*), MAX({names['key']}) FROM {names['table']};").fetchone()
+            conn.execute("DELETE FROM _column_stats WHERE table_name = ?;", (table_name,)) # (of the table before it was created again)
+            conn.execute("INSERT OR REPLACE INTO _table_stats (table_name, key_column, row_count, max_key) VALUES (?, ?, ?, ?);",
+                         (table_name, key, row_count, max_key))
+            for event, template in zip(EVENTS, (INSERT_TRIGGER, DELETE_TRIGGER, UPDATE_TRIGGER)):
+                conn.execute(f"DROP TRIGGER IF EXISTS {quote(trigger_name(table_name, event))};")
+                conn.execute(template.format(trigger=quote(trigger_name(table_name, event)), **names))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return added
+
+
+# ---------------------------- Defining a new function named 'analyze' ----------------------------
+# Running ANALYZE and recomputing the column statistics and the exact row count of the given tables (all of them by
+# default). Reads every row of each table once, so it is meant for a maintenance job or an admin request, not for
+# every page. Returns the number of tables analyzed.
+def analyze(conn, schema, tables=None):
+    tables = [table_name for table_name in (tables or schema) if table_name in schema and schema[table_name]['columns']]
+    conn.execute("ANALYZE;") # Statistics of the indexes, stored in sqlite_stat1
+    conn.commit()
+    for table_name in tables:
+        columns = schema[table_name]['columns']
+        # One scan per table: COUNT(DISTINCT c), COUNT(*) - COUNT(c), MIN(c), MAX(c) for every column c
+        aggregates = ', '.join(f"COUNT(DISTINCT {quote(c)}), COUNT(*) - COUNT({quote(c)}), MIN({quote(c)}), MAX({quote(c)})" for c in columns)
+        conn.execute("BEGIN IMMEDIATE;") # The counts must match the rows seen by the scan, so no write can happen in between
+        try:
+            row = conn.execute(f"SELECT COUNT(*), {aggregates} FROM {quote(table_name)};").fetchone()
+            conn.execute("DELETE FROM _column_stats WHERE table_name = ?;", (table_name,))
+            conn.executemany("INSERT INTO _column_stats (table_name, column_name, distinct_count, null_count, min_value, max_value) VALUES (?, ?, ?, ?, ?, ?);",
+                             [(table_name, column, *row[1 + 4 * n:5 + 4 * n]) for n, column in enumerate(columns)])
+            conn.execute("UPDATE _table_stats SET row_count = ?, analyzed_at = ? WHERE table_name = ?;", (row[0], time.time(), table_name))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return len(tables)
+
+
+# ---------------------------- Reading the statistics ----------------------------
+# Returning {table name: {'key_column', 'row_count', 'max_key', 'analyzed_at'}}, or None if ensure_table_stats() was
+# not run on this database
+def read_table_stats(conn):
+    try:
+        rows = conn.execute("SELECT table_name, key_column, row_count, max_key, analyzed_at FROM _table_stats;").fetchall()
+    except sqlite3.OperationalError: # No such table
+        return None
+    return {row[0]: {'key_column': row[1], 'row_count': row[2], 'max_key': row[3], 'analyzed_at': row[4]} for row in rows}
+
+
+# Returning the counters of one table (None if it has none)
+def read_table_counts(conn, table_name):
+    try:
+        row = conn.execute("SELECT row_count, max_key FROM _table_stats WHERE table_name = ?;", (table_name,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return tuple(row) if row else None
+
+
+# Returning {column name: {'distinct_count', 'null_count', 'min_value', 'max_value'}} for one table (empty until analyze())
+def read_column_stats(conn, table_name):
+    try:
+        rows = conn.execute("SELECT column_name, distinct_count, null_count, min_value, max_value FROM _column_stats WHERE table_name = ?;",
+                            (table_name,)).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {row[0]: {'distinct_count': row[1], 'null_count': row[2], 'min_value': row[3], 'max_value': row[4]} for row in rows}
@@ -0,0 +1,47 @@
+# ---------------------------- Test fixtures ----------------------------
+# The app is imported once, on a small database made by the benchmark generator (see: benchmarks/generate_db.py).
+# cars.py reads CARS_DATABASE when it is first imported, so it is set here, before any test module imports it.
+#
+#   python -m pytest -q
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT) # Making the app modules importable
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from generate_db import generate_database
+
+WORKDIR = tempfile.mkdtemp()
+DATABASE = os.path.join(WORKDIR, 'cars.db')
+OWNERSHIPS = 2000 # Customer_Ownership rows: more than the customers, so some customer_id values repeat
+
+generate_database(DATABASE, OWNERSHIPS, seed=1)
+os.environ['CARS_DATABASE'] = DATABASE
+os.environ['CARS_WARMUP'] = '0'
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    app.template_folder = ROOT # (the templates are in the root of the repository)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# A new, empty database file for the tests that need one of their own
+@pytest.fixture
+def database(tmp_path):
+    return str(tmp_path / 'test.db')
@@ -0,0 +1,67 @@
+import asyncio
+import html
+import json
+import re
+import sqlite3
+from urllib.parse import quote
+
+import pytest
+
+from conftest import DATABASE
+
+
+@pytest.fixture(scope='module')
+def asgi_app(app):
+    import asgi
+    return asgi.application
+
+
+# Sending one GET request to the ASGI app and returning (status, headers, body)
+def asgi_get(application, url, headers=()):
+    path, _, query_string = url.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string.encode('latin-1'),
+             'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, body
+
+
+# The scroll view of /table/<table_name> reads its rows from data-url, page after page, as its script does
+def test_scroll_view_pages_through_the_asgi_app(client, asgi_app):
+    page = client.get('/table/Customer_Ownership?view=scroll').get_data(as_text=True)
+    data_url = html.unescape(re.search(r'data-url="([^"]+)"', page).group(1))
+    rows, url, columns = [], data_url, None
+    while url:
+        status, _, body = asgi_get(asgi_app, url)
+        assert status == 200
+        data = json.loads(body)
+        columns = data['columns']
+        rows.extend(data['rows'])
+        url = None
+        if data['next']:
+            url = f"{data_url}&after={quote(str(data['next']['after']))}&after_rowid={data['next']['after_rowid']}"
+
+    conn = sqlite3.connect(DATABASE)
+    try:
+        expected = conn.execute("SELECT * FROM Customer_Ownership ORDER BY customer_id, rowid;").fetchall()
+        names = [column[0] for column in conn.execute("SELECT * FROM Customer_Ownership LIMIT 0;").description]
+    finally:
+        conn.close()
+    assert columns == names
+    assert [tuple(row) for row in rows] == expected
+
+
+def test_if_none_match_is_compared_per_etag(asgi_app):
+    status, headers, _ = asgi_get(asgi_app, '/api/v1/tables')
+    etag = headers['etag']
+    assert asgi_get(asgi_app, '/api/v1/tables', [('if-none-match', f'W/"other", {etag}')])[0] == 304
+    assert asgi_get(asgi_app, '/api/v1/tables', [('if-none-match', etag[:-5] + '"')])[0] == 200
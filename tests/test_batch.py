@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+import cars
+import query_builder
+from conftest import DATABASE
+
+# Id counts on both sides of MAX_IN_KEYS: an IN list of '?' (padded to a power of two) up to it, a JSON array above it
+IN_LIST_COUNTS = [1, 3, 100, query_builder.MAX_IN_KEYS]
+JSON_COUNTS = [query_builder.MAX_IN_KEYS + 1, 1500]
+
+
+def query(sql, params=()):
+    conn = sqlite3.connect(DATABASE)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+# ---------------------------- SQL templates ----------------------------
+def test_keys_bucket():
+    assert [query_builder.keys_bucket(n) for n in (1, 2, 3, 5, 512)] == [1, 2, 4, 8, 512]
+    assert query_builder.keys_bucket(513) is None
+
+
+def test_in_list_and_json_templates():
+    assert 'IN (?, ?, ?, ?)' in query_builder.select_by_keys_sql('Customers', 'customer_id', 4)
+    assert 'json_each(?)' in query_builder.select_by_keys_sql('Customers', 'customer_id', None)
+
+
+def test_keys_params_pads_with_the_last_key():
+    assert query_builder.keys_params([1, 2, 3]) == [1, 2, 3, 3]
+    assert query_builder.keys_params([1, 2, 3], ['x']) == ['x', 1, 2, 3, 3]
+    assert len(query_builder.keys_params(list(range(600)))) == 1 # One JSON array
+
+
+# ---------------------------- Batch operations ----------------------------
+@pytest.mark.parametrize('count', IN_LIST_COUNTS + JSON_COUNTS)
+def test_get_records_by_ids(app, count):
+    ids = list(range(1, count + 1)) + [10 ** 9] # (an id without a row is left out)
+    records = cars.get_records_by_ids('Customers', 'customer_id', ids)
+    expected = query("SELECT customer_id FROM Customers WHERE customer_id <= ? ORDER BY customer_id;", (count,))
+    assert sorted(record['customer_id'] for record in records) == [row[0] for row in expected]
+
+
+@pytest.mark.parametrize('count', [3, query_builder.MAX_IN_KEYS + 88])
+def test_update_records(app, count):
+    ids = list(range(1, count + 1))
+    assert cars.update_records('Car_Parts', 'part_id', ids, {'part_recall': count}) == count
+    updated = query("SELECT part_id FROM Car_Parts WHERE part_recall = ? ORDER BY part_id;", (count,))
+    assert [row[0] for row in updated] == ids
+
+
+@pytest.mark.parametrize('count', [5, query_builder.MAX_IN_KEYS + 10])
+def test_delete_records(app, count):
+    ids = [row[0] for row in query("SELECT part_id FROM Car_Parts ORDER BY part_id DESC LIMIT ?;", (count,))]
+    before = query("SELECT COUNT(*) FROM Car_Parts;")[0][0]
+    assert cars.delete_records('Car_Parts', 'part_id', ids) == count
+    assert query("SELECT COUNT(*) FROM Car_Parts;")[0][0] == before - count
+    assert cars.get_records_by_ids('Car_Parts', 'part_id', ids) == []
+
+
+# The ids of a JSON request may be strings: both paths compare them as the column's type
+@pytest.mark.parametrize('count', [4, query_builder.MAX_IN_KEYS + 1])
+def test_batch_endpoint_with_string_ids(client, count):
+    response = client.post('/api/v1/customers/batch', json={'ids': [str(n) for n in range(1, count + 1)]})
+    assert response.status_code == 200
+    assert sorted(item['customer_id'] for item in response.get_json()['items']) == list(range(1, count + 1))
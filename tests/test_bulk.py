@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+import bulk
+import cars
+
+
+@pytest.fixture
+def customers(app):
+    return cars.get_schema()['Customers']
+
+
+def validate(table, record):
+    return bulk.validate_record(record, table, [column for column in table['columns'] if column in record])
+
+
+def test_integer_columns_take_integral_values(customers):
+    assert validate(customers, {'customer_id': 5, 'household_income': '70000'}) == (5, 70000)
+    assert validate(customers, {'customer_id': 5.0}) == (5,)
+
+
+# A fraction is not dropped (4.7 is not stored as 4), and JSON booleans are not taken as 1 and 0
+@pytest.mark.parametrize('value', [4.7, True, False])
+def test_integer_columns_reject_fractions_and_booleans(customers, value):
+    with pytest.raises(ValueError, match='customer_id'):
+        validate(customers, {'customer_id': value})
+
+
+def test_ndjson_import_reports_the_invalid_rows(app):
+    lines = b'{"customer_id": 4.7, "first_name": "Float"}\n{"customer_id": true, "first_name": "Bool"}\n'
+    report = cars.import_records('Customers', bulk.iter_ndjson(io.BytesIO(lines)))
+    assert report['inserted'] == 0 and report['failed'] == 2
+    assert [error['line'] for error in report['errors']] == [1, 2]
+    assert all('is not a' in error['error'] for error in report['errors'])
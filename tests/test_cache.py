@@ -0,0 +1,64 @@
+import sqlite3
+
+import cars
+from cache import make_key
+from conftest import DATABASE
+
+
+# ---------------------------- Cache keys ----------------------------
+# A key holds the bound values exactly: SQLite does not strip them or compare text as numbers
+def test_make_key_keeps_the_bound_values():
+    assert make_key('models', brand=' Toyota') != make_key('models', brand='Toyota')
+    assert make_key('models', model='007') != make_key('models', model='7')
+    assert make_key('models', price=20000) != make_key('models', price='20000')
+
+
+def test_make_key_ignores_unset_parameters_and_their_order():
+    assert make_key('customers', brand='Toyota', dealer=None) == make_key('customers', brand='Toyota')
+    assert make_key('customers', brand='Toyota', model='Sedan') == make_key('customers', model='Sedan', brand='Toyota')
+
+
+def test_make_key_does_not_mix_values_up():
+    assert make_key('customers', brand='a&dealer=b') != make_key('customers', brand='a', dealer='b')
+
+
+# ---------------------------- Cached results ----------------------------
+def uncached_customers(**filters):
+    cars.result_cache.invalidate()
+    return cars.get_customers(**filters)
+
+
+# A query whose result is cached must not answer another query whose bound values only differ by spaces or zeros
+def test_customers_are_cached_per_bound_values(app):
+    expected = uncached_customers(brand='Toyota')
+    assert expected
+    cars.result_cache.invalidate()
+    assert cars.get_customers(brand=' Toyota') == []
+    assert cars.get_customers(brand='Toyota') == expected
+
+
+def test_customers_cache_hit_returns_the_same_rows(app):
+    expected = uncached_customers(brand='Toyota', dealer=None)
+    assert cars.get_customers(brand='Toyota') == expected
+
+
+def test_customers_key_is_built_from_the_query_parameters(app):
+    _, params = cars.build_customers_query('Toyota', None, None, None)
+    cars.result_cache.invalidate()
+    customers = cars.get_customers(brand='Toyota')
+    assert cars.result_cache.get(make_key('customers', **params)) == (True, customers)
+
+
+
+# A write made by another process (another worker, without a shared backend) does not bump this process' counter:
+# the version also follows the database files, so the cached result is not returned after it
+def test_write_from_another_connection_invalidates(app):
+    before = uncached_customers(brand='Toyota')
+    assert cars.get_customers(brand='Toyota') == before # (cached)
+    conn = sqlite3.connect(DATABASE)
+    try:
+        conn.execute("UPDATE Customers SET first_name = 'Renamed' WHERE customer_id = ?;", (before[0]['customer_id'],))
+        conn.commit()
+    finally:
+        conn.close()
+    assert cars.get_customers(brand='Toyota')[0]['first_name'] == 'Renamed'
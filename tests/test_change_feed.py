@@ -0,0 +1,128 @@
+import sqlite3
+
+import cars
+from conftest import DATABASE
+
+
+def last_seq(client):
+    return cars.get_changes(limit=0)['last_seq'] # (since=0 is gone once the feed was compacted)
+
+
+def changes(client, since, **args):
+    query = ''.join(f"&{name}={value}" for name, value in args.items())
+    response = client.get(f"/api/v1/changes?since={since}{query}")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+# ---------------------------- Reading the changes ----------------------------
+def test_since_returns_the_changes_after_it_in_order(client):
+    since = last_seq(client)
+    dealer_id = cars.add_record('Dealers', {'dealer_name': 'Feed Motors', 'dealer_address': '1 Main St'})
+    assert cars.update_record('Dealers', 'dealer_id', dealer_id, {'dealer_address': '2 Main St'})
+    assert cars.delete_record('Dealers', 'dealer_id', dealer_id)
+
+    feed = changes(client, since)
+    assert [(item['operation'], item['table'], item['key']) for item in feed['items']] == [
+        ('insert', 'Dealers', [dealer_id]), ('update', 'Dealers', [dealer_id]), ('delete', 'Dealers', [dealer_id])]
+    assert feed['items'][1]['row']['dealer_address'] == '2 Main St'
+    assert feed['items'][2]['row'] is None
+    assert feed['next'] == feed['last_seq'] == feed['items'][-1]['seq']
+    assert changes(client, feed['next'])['items'] == []
+
+
+def test_limit_and_tables(client):
+    since = last_seq(client)
+    for n in range(3):
+        cars.add_record('Brands', {'brand_name': f"Feed brand {n}"})
+    cars.add_record('Dealers', {'dealer_name': 'Feed Dealer'})
+
+    first = changes(client, since, limit=2, tables='Brands')
+    assert len(first['items']) == 2 and first['has_more']
+    rest = changes(client, first['next'], tables='Brands')
+    assert [item['row']['brand_name'] for item in first['items'] + rest['items']] == [f"Feed brand {n}" for n in range(3)]
+    assert not rest['has_more']
+
+
+# A change of the primary key is a delete of the old key and an insert of the new one, with the whole key
+def test_primary_key_change_logs_delete_and_insert(client):
+    customer_id, vin = sqlite3.connect(DATABASE).execute("SELECT customer_id, vin FROM Customer_Ownership LIMIT 1;").fetchone()
+    since = last_seq(client)
+    cars.execute_write("UPDATE Customer_Ownership SET vin = ? WHERE customer_id = ? AND vin = ?;", (-vin, customer_id, vin))
+    cars.execute_write("UPDATE Customer_Ownership SET vin = ? WHERE customer_id = ? AND vin = ?;", (vin, customer_id, -vin))
+
+    items = changes(client, since, tables='Customer_Ownership')['items']
+    assert [(item['operation'], item['key']) for item in items] == [
+        ('delete', [customer_id, vin]), ('insert', [customer_id, -vin]), ('delete', [customer_id, -vin]), ('insert', [customer_id, vin])]
+
+
+def test_long_poll_without_changes_returns_empty(client):
+    since = last_seq(client)
+    assert changes(client, since, wait=0.2)['items'] == []
+
+
+def test_event_stream_sends_the_changes(app, client):
+    since = last_seq(client)
+    dealer_id = cars.add_record('Dealers', {'dealer_name': 'Stream Motors'})
+    duration = app.config['CHANGE_FEED_STREAM_DURATION']
+    app.config['CHANGE_FEED_STREAM_DURATION'] = 0 # Closing the stream once the waiting changes are sent
+    try:
+        body = client.get(f"/api/v1/changes/stream?since={since}").get_data(as_text=True)
+    finally:
+        app.config['CHANGE_FEED_STREAM_DURATION'] = duration
+    assert 'event: change' in body and f'"key":[{dealer_id}]' in body.replace(' ', '')
+
+
+# ---------------------------- Compaction ----------------------------
+def test_compaction_keeps_the_latest_change_of_each_row(client):
+    since = last_seq(client)
+    dealer_id = cars.add_record('Dealers', {'dealer_name': 'Compact Motors'})
+    for n in range(3):
+        cars.update_record('Dealers', 'dealer_id', dealer_id, {'dealer_address': f"{n} Side St"})
+    assert len(changes(client, since, tables='Dealers')['items']) == 4
+
+    response = client.post('/api/v1/changes/compact', json={'retention_seconds': None})
+    assert response.status_code == 200 and response.get_json()['superseded'] >= 3
+    items = changes(client, since, tables='Dealers')['items']
+    assert [(item['operation'], item['row']['dealer_address']) for item in items] == [('update', '2 Side St')]
+
+
+def test_since_before_the_horizon_is_gone(client):
+    cars.add_record('Dealers', {'dealer_name': 'Expired Motors'})
+    last = last_seq(client)
+    response = client.post('/api/v1/changes/compact', json={'retention_seconds': 0})
+    assert response.status_code == 200
+    horizon = response.get_json()['horizon']
+    assert horizon == last
+
+    gone = client.get('/api/v1/changes?since=0')
+    assert gone.status_code == 410 and gone.get_json()['horizon'] == horizon
+    assert client.get(f"/api/v1/changes?since={horizon}").status_code == 200
+    assert 'event: resync' in client.get('/api/v1/changes/stream?since=0').get_data(as_text=True)
+
+
+# ---------------------------- Triggers ----------------------------
+# A table dropped and created again loses its triggers: they are created again when the app sees the new schema
+def test_triggers_come_back_when_a_table_is_created_again(client):
+    conn = sqlite3.connect(DATABASE)
+    try:
+        conn.execute("CREATE TABLE Feed_Notes (note_id INTEGER PRIMARY KEY, text TEXT);")
+        conn.commit()
+        client.get('/api/v1/tables') # (the schema is reloaded and the triggers created)
+        conn.execute("DROP TABLE Feed_Notes;")
+        conn.execute("CREATE TABLE Feed_Notes (note_id INTEGER PRIMARY KEY, text TEXT);")
+        conn.commit()
+        client.get('/api/v1/tables')
+        triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'Feed_Notes';")}
+        assert {'_changes_Feed_Notes_insert', '_changes_Feed_Notes_update', '_changes_Feed_Notes_delete'} <= triggers
+        assert {'_table_stats_Feed_Notes_insert', '_table_stats_Feed_Notes_update', '_table_stats_Feed_Notes_delete'} <= triggers
+
+        since = last_seq(client)
+        conn.execute("INSERT INTO Feed_Notes (note_id, text) VALUES (7, 'again');")
+        conn.commit()
+        assert [item['key'] for item in changes(client, since, tables='Feed_Notes')['items']] == [[7]]
+        assert cars.get_row_count('Feed_Notes') == 1
+    finally:
+        conn.execute("DROP TABLE IF EXISTS Feed_Notes;")
+        conn.commit()
+        conn.close()
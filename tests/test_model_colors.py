@@ -0,0 +1,36 @@
+import sqlite3
+
+import cars
+import model_colors
+from conftest import DATABASE
+
+
+def triggers(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '_model_colors%';")}
+
+
+def test_all_triggers_exist(app):
+    conn = sqlite3.connect(DATABASE)
+    try:
+        assert triggers(conn) == set(model_colors.TRIGGERS)
+        assert not model_colors.ensure_model_colors(conn) # Nothing to do
+    finally:
+        conn.close()
+
+
+# A missing trigger is created again, and the changes made without it are picked up by filling the table again
+def test_missing_trigger_is_recreated(client):
+    conn = sqlite3.connect(DATABASE, isolation_level=None)
+    try:
+        conn.execute("DROP TRIGGER _model_colors_options_insert;")
+        option_id = conn.execute("INSERT INTO Car_Options (model_id, color) VALUES (1, 'Neon');").lastrowid
+        client.get('/api/v1/tables') # (the schema changed: the app checks its triggers again)
+        assert triggers(conn) == set(model_colors.TRIGGERS)
+        assert [model['model_id'] for model in cars.get_models(car_color='Neon')] == [1]
+
+        conn.execute("UPDATE Car_Options SET color = 'Chrome' WHERE option_set_id = ?;", (option_id,))
+        assert cars.get_models(car_color='Neon') == []
+        assert [model['model_id'] for model in cars.get_models(car_color='Chrome')] == [1]
+    finally:
+        conn.execute("DELETE FROM Car_Options WHERE color IN ('Neon', 'Chrome');")
+        conn.close()
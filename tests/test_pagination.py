@@ -0,0 +1,67 @@
+import math
+import sqlite3
+
+import pytest
+
+import cars
+from conftest import DATABASE
+
+
+# Every row of a table in pagination order: by the key column, then the rowid (the key of Customer_Ownership repeats)
+def all_rows(table_name, key=None):
+    conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    try:
+        order = f'"{key}", rowid' if key else 'rowid'
+        return [dict(row) for row in conn.execute(f'SELECT * FROM "{table_name}" ORDER BY {order};')]
+    finally:
+        conn.close()
+
+
+# Following the cursors of get_table_page from the first page to the last one
+def read_pages(table_name, key, page_size):
+    rows, after, after_rowid, pages = [], None, None, 0
+    while True:
+        page = cars.get_table_page(table_name, key, page_size, after, after_rowid)
+        pages += 1
+        rows.extend(page['rows'])
+        if page['next_after'] is None:
+            return rows, pages
+        after, after_rowid = page['next_after'], page['next_after_rowid']
+
+
+@pytest.mark.parametrize('table_name, key', [('Customers', 'customer_id'), ('Customer_Ownership', 'customer_id'), ('Dealer_Brand', 'dealer_id')])
+def test_pages_cover_every_row_once(app, table_name, key):
+    rows, pages = read_pages(table_name, key, 97)
+    expected = all_rows(table_name, key)
+    assert rows == expected
+    assert pages == math.ceil(len(expected) / 97) # (no empty last page)
+
+
+def test_repeated_key_values_are_not_skipped_across_pages(app):
+    # Customer_Ownership has more rows than customers: a page boundary inside a run of equal customer_id values must
+    # continue with the next rowid of that value, not the next value
+    rows, _ = read_pages('Customer_Ownership', 'customer_id', 1)
+    assert len(rows) == len({(row['customer_id'], row['vin']) for row in rows}) == len(all_rows('Customer_Ownership'))
+
+
+def test_pages_without_a_key_follow_the_rowid(app):
+    rows, _ = read_pages('Dealers', None, 3)
+    assert rows == all_rows('Dealers')
+
+
+def test_last_page_has_no_cursor(app):
+    page = cars.get_table_page('Dealers', 'dealer_id', 1000)
+    assert page['next_after'] is None and page['next_after_rowid'] is None
+    assert len(page['rows']) == len(all_rows('Dealers'))
+
+
+def test_api_pages_follow_the_next_cursor(client):
+    url, rows = '/api/v1/tables/Customer_Ownership?page_size=250', []
+    while url:
+        data = client.get(url).get_json()
+        rows.extend(data['items'])
+        url = None
+        if data['next']:
+            url = f"/api/v1/tables/Customer_Ownership?page_size=250&after={data['next']['after']}&after_rowid={data['next']['after_rowid']}"
+    assert rows == all_rows('Customer_Ownership', 'customer_id')
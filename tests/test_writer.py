@@ -0,0 +1,106 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pool import ConnectionPool
+from writer import WriteQueue
+
+
+@pytest.fixture
+def queue(database):
+    pool = ConnectionPool(database)
+    conn = pool.connect()
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);")
+    conn.commit()
+    conn.close()
+    writer = WriteQueue(pool.connect, timeout=5.0)
+    writer.enabled = True
+    yield writer
+    writer.close()
+    pool.close_all()
+
+
+def count(database):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM items;").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# Holding the writer thread inside a batch until the returned event is set, so the next writes pile up in the queue
+def hold_writer(queue):
+    release, running = threading.Event(), threading.Event()
+
+    def operation(conn):
+        running.set()
+        release.wait(5)
+    queue.submit(operation)
+    assert running.wait(5)
+    return release
+
+
+# ---------------------------- Group commit ----------------------------
+def test_queued_writes_are_committed_together(queue, database):
+    release = hold_writer(queue)
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        results = [pool.submit(queue.execute, "INSERT INTO items (name) VALUES (?);", (f"item {n}",)) for n in range(50)]
+        while queue.stats()['queued'] < 50:
+            time.sleep(0.01)
+        release.set()
+        rowids = [result.result()[0] for result in results]
+
+    assert len(set(rowids)) == 50 and count(database) == 50
+    stats = queue.stats()
+    assert stats['batches'] == 2 # The held batch, then the 50 writes in one transaction
+    assert stats['max_batch'] == 50 and stats['writes'] == 51
+
+
+def test_batches_are_limited_to_batch_size(queue, database):
+    queue.batch_size = 10
+    release = hold_writer(queue)
+    futures = [queue.submit(lambda conn, n=n: conn.execute("INSERT INTO items (name) VALUES (?);", (f"item {n}",))) for n in range(25)]
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert count(database) == 25
+    assert queue.stats()['batches'] == 4 and queue.stats()['max_batch'] == 10
+
+
+# A failing write is rolled back alone (its SAVEPOINT): the other writes of the batch are committed
+def test_failing_write_does_not_roll_back_its_batch(queue, database):
+    release = hold_writer(queue)
+    insert = "INSERT INTO items (name) VALUES (?);"
+    futures = [queue.submit(lambda conn, name=name: conn.execute(insert, (name,)).lastrowid) for name in ('a', 'a', 'b')]
+    release.set()
+    assert futures[0].result(5) and futures[2].result(5)
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result(5)
+    assert count(database) == 2
+    assert queue.stats()['failed'] == 1
+
+
+# ---------------------------- Timeouts ----------------------------
+# A write still queued when its caller gives up is cancelled: it is never committed
+def test_timed_out_write_is_cancelled(queue, database):
+    queue.timeout = 0.1
+    release = hold_writer(queue)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            queue.execute("INSERT INTO items (name) VALUES ('late');")
+    finally:
+        release.set()
+    queue.timeout = 5.0
+    queue.flush()
+    assert count(database) == 0
+    assert queue.stats()['cancelled'] == 1
+
+
+def test_flush_waits_for_the_queued_writes(queue, database):
+    for n in range(20):
+        queue.submit(lambda conn, n=n: conn.execute("INSERT INTO items (name) VALUES (?);", (f"item {n}",)))
+    queue.flush()
+    assert count(database) == 20
@@ -0,0 +1,137 @@
+import gc
+import itertools
+import logging
+import os
+import sqlite3
+import time
+
+import cars
+import query_builder
+from schema import primary_key_column
+
+log = logging.getLogger(__name__)
+
+# ---------------------------- Startup ----------------------------
+# Without this, every new worker process does on its first requests what all the others already did: reading the schema,
+# building the SQL of the queries, compiling the Jinja templates, opening its connections and compiling their statements,
+# loading the model index. warmup() does all of that when the app is loaded, so the first request is as fast as the
+# following ones.
+# With preload_app (see: gunicorn.conf.py), the app is loaded once in the master process and the workers are forked
+# from it: what warmup() loaded - the schema, the SQL templates, the compiled templates, the model index (the brands,
+# colors and prices of every model) and the cached results of WARMUP_URLS - is in memory pages the workers share with
+# the master (copy-on-write: a page is only copied by a worker that changes it), instead of one copy per worker.
+# before_fork() and after_fork() are called by the server around every fork.
+
+
+# Every combination of the filters of a query_builder.FilterQuery (2^n shapes)
+def filter_shapes(query):
+    names = [name for name, _ in query.filters]
+    return itertools.chain.from_iterable(itertools.combinations(names, n) for n in range(len(names) + 1))
+
+
+# ---------------------------- Defining a new function named 'warmup' ----------------------------
+# Loading everything the requests need, then requesting WARMUP_URLS once (filling the result caches). Returns the
+# seconds spent per step, e.g. for the startup benchmark (see: benchmarks/bench_startup.py)
+def warmup(app):
+    timings = {}
+
+    def step(name, function):
+        started = time.perf_counter()
+        try:
+            function()
+        except sqlite3.Error as e:
+            log.error("Error warming up (%s): %s", name, e)
+        timings[name] = time.perf_counter() - started
+
+    step('schema', load_schema)
+    step('sql', build_sql)
+    step('templates', lambda: compile_templates(app))
+    step('model_index', load_model_index)
+    step('connections', lambda: prepare_connections(app.config.get('WARMUP_CONNECTIONS')))
+    step('urls', lambda: request_urls(app, app.config.get('WARMUP_URLS', [])))
+    return timings
+
+
+# The schema of every table and virtual table (see: schema.SchemaCache)
+def load_schema():
+    with cars.pool.connection() as conn:
+        cars.schema_cache.get(conn)
+        cars.schema_cache.virtual_tables(conn)
+
+
+# The SQL of the queries on every table and of every combination of filters (see: query_builder.py)
+def build_sql():
+    for table_name, table in cars.get_schema().items():
+        key = primary_key_column(table)
+        query_builder.select_all_sql(table_name)
+        query_builder.count_sql(table_name)
+        query_builder.max_sql(table_name, key)
+        query_builder.select_by_key_sql(table_name, key)
+        query_builder.delete_sql(table_name, key)
+        for seek in (None, 'key', 'key_rowid'):
+            query_builder.page_sql(table_name, key, seek)
+    for query in (cars.CUSTOMERS_QUERY, cars.MODELS_QUERY):
+        for shape in filter_shapes(query):
+            query.sql(shape)
+
+
+# Compiling every template of the app (Jinja keeps the compiled templates, see: jinja2.Environment.cache)
+def compile_templates(app):
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def load_model_index():
+    with cars.pool.connection() as conn:
+        cars.model_index.refresh(conn)
+
+
+# ---------------------------- Defining a new function named 'prepare_connections' ----------------------------
+# Opening 'count' connections of the pool (all of them by default) and running the statements on the primary key of
+# every table once on each, so they are already compiled in the connection's statement cache (see: pool.py). The
+# statements read no rows (LIMIT 0, key = NULL)
+def prepare_connections(count=None):
+    schema = cars.get_schema()
+    connections = []
+    try:
+        for _ in range(min(count or cars.pool.size, cars.pool.size)):
+            conn = cars.pool.acquire()
+            connections.append(conn)
+            for table_name, table in schema.items():
+                key = primary_key_column(table)
+                conn.execute(query_builder.page_sql(table_name, key, None), {'limit': 0}).fetchall()
+                conn.execute(query_builder.select_by_key_sql(table_name, key), (None,)).fetchall()
+    finally:
+        for conn in connections:
+            cars.pool.release(conn)
+
+
+# Requesting each URL once through the test client (errors are logged, the startup goes on)
+def request_urls(app, urls):
+    with app.test_client() as client:
+        for url in urls:
+            response = client.get(url)
+            response.get_data()
+            if response.status_code >= 400:
+                log.error("Error warming up %s: status %s", url, response.status_code)
+
+
+# ---------------------------- Forking ----------------------------
+# In the master process, before a worker is forked: closing the database connections (a SQLite connection must not be
+# used on both sides of a fork), and moving every object into the garbage collector's permanent generation, so the
+# collections in the workers do not write to - and thus copy - the pages shared with the master
+def before_fork():
+    cars.pool.close_all()
+    cars.replica.close()
+    cars.writer.close()
+    gc.freeze()
+
+
+# In the new worker: opening and preparing its own connections before it takes requests
+def after_fork(app):
+    started = time.perf_counter()
+    try:
+        prepare_connections(app.config.get('WARMUP_CONNECTIONS'))
+    except sqlite3.Error as e:
+        log.error("Error preparing the connections of worker %s: %s", os.getpid(), e)
+    return time.perf_counter() - started
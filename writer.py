@@ -0,0 +1,185 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+
+# ---------------------------- Defining a new class named 'WriteQueue' ----------------------------
+# Group commit: every INSERT/UPDATE/DELETE is queued and run by a single background thread with its own connection. The
+# thread takes whatever is waiting in the queue (up to 'batch_size' writes, waiting at most 'flush_delay' seconds for
+# more) and commits it in one transaction, so N concurrent writers cost one commit (one fsync) instead of N, and never
+# fight over the write lock ('database is locked'). Readers keep using the pool and are not blocked (WAL mode).
+# Each write runs in its own SAVEPOINT: a failing write is rolled back alone and the rest of the batch is committed.
+# Some writes do not go through the queue and commit on a connection of the pool: the CSV/JSON imports (see:
+# cars.import_records, which commits every BULK_BATCH_SIZE rows itself), analyze_tables and compact_changes (long scans
+# or large deletes that would hold up every queued write behind them). They take SQLite's write lock in turn with the
+# writer thread, which waits for it up to the connection's busy_timeout (see: pool.py).
+class WriteQueue:
+    def __init__(self, connect, batch_size=100, flush_delay=0.0, timeout=30.0):
+        self.connect = connect # Function opening the writer's connection (e.g. pool.connect)
+        self.enabled = False # When False, callers write through their own connection (see: cars.execute_write)
+        self.batch_size = batch_size # Maximum number of writes per transaction
+        # Seconds the writer waits for more writes after the first one of a batch. 0 is usually best: the writes queued
+        # while the previous batch was being committed form the next batch anyway, without delaying a lone write
+        self.flush_delay = flush_delay
+        self.timeout = timeout # Seconds a caller waits for its write to be committed
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None # Process that started the thread (a forked worker has to start its own)
+        self._lock = threading.Lock()
+        self._stats = {
+            'writes': 0,          # Writes committed
+            'failed': 0,          # Writes rolled back (error in the write itself or in its batch)
+            'cancelled': 0,       # Writes cancelled before they ran, after waiting 'timeout' seconds in the queue
+            'batches': 0,         # Transactions committed
+            'max_batch': 0,       # Largest number of writes committed together
+            'commit_time_total': 0.0,
+        }
+
+    # Reading the settings from the Flask config
+    def init_app(self, app):
+        self.enabled = app.config.get('WRITE_QUEUE_ENABLED', self.enabled)
+        self.batch_size = app.config.get('WRITE_BATCH_SIZE', self.batch_size)
+        self.flush_delay = app.config.get('WRITE_FLUSH_DELAY', self.flush_delay)
+        self.timeout = app.config.get('WRITE_TIMEOUT', self.timeout)
+        app.extensions['write_queue'] = self
+
+    # ---------------------------- Defining a new function named 'submit' ----------------------------
+    # Queueing 'operation(conn)' and returning a Future with its result, set once the write is committed. The operation
+    # runs in the writer thread, inside the batch transaction, and must not commit
+    def submit(self, operation):
+        future = Future()
+        self._start()
+        self._queue.put((operation, future))
+        return future
+
+    # Running one statement through the queue and waiting for the commit. Returns (lastrowid, rowcount) like a cursor.
+    # After 'timeout' seconds, a write still waiting in the queue is cancelled (the writer thread skips it) and
+    # sqlite3.OperationalError is raised: it is never committed. A write whose batch is already running is waited for,
+    # as its outcome is then known within the busy_timeout of the writer's connection
+    def execute(self, sql, params=()):
+        def operation(conn):
+            cur = conn.execute(sql, params)
+            return cur.lastrowid, cur.rowcount
+        future = self.submit(operation)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                with self._lock:
+                    self._stats['cancelled'] += 1
+                raise sqlite3.OperationalError(f"Write not committed after {self.timeout}s (cancelled)") from None
+            return future.result()
+
+    # Waiting until everything queued so far is committed
+    def flush(self):
+        self.submit(lambda conn: None).result(self.timeout)
+
+    def _start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self.close)
+            self._queue = queue.Queue() # After a fork, the parent's queue and thread do not exist in this process
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='cars-writer', daemon=True)
+            self._thread.start()
+
+    # Committing what is queued and stopping the thread (e.g. on shutdown)
+    def close(self):
+        thread = self._thread
+        if thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        thread.join(self.timeout)
+        self._thread = None
+
+    # ---------------------------- The writer thread ----------------------------
+    def _run(self):
+        conn = None
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_delay
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = deadline - time.monotonic()
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                if conn is None:
+                    conn = self.connect()
+            except sqlite3.Error as e:
+                log.error("Error opening the writer connection: %s", e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self._write(conn, batch)
+        if conn is not None:
+            conn.close()
+
+    def _write(self, conn, batch):
+        batch = [(operation, future) for operation, future in batch if future.set_running_or_notify_cancel()]
+        results = []
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE;") # Taking the write lock for the whole batch up front
+            for operation, future in batch:
+                conn.execute("SAVEPOINT write;")
+                try:
+                    results.append((future, operation(conn), None))
+                    conn.execute("RELEASE write;")
+                except Exception as e: # Any error: the writer thread has to keep running for the other callers
+                    conn.execute("ROLLBACK TO write;")
+                    conn.execute("RELEASE write;")
+                    results.append((future, None, e))
+            conn.commit()
+        except sqlite3.Error as e: # BEGIN or COMMIT failed (e.g. locked by another process for longer than busy_timeout)
+            log.error("Error committing %d queued writes: %s", len(batch), e)
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._stats['failed'] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - started
+
+        failed = sum(1 for _, _, error in results if error is not None)
+        with self._lock:
+            self._stats['writes'] += len(results) - failed
+            self._stats['failed'] += failed
+            self._stats['batches'] += 1
+            self._stats['max_batch'] = max(self._stats['max_batch'], len(results))
+            self._stats['commit_time_total'] += elapsed
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    # Returning a snapshot of the queue metrics
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['enabled'] = self.enabled
+        stats['writes_per_batch'] = stats['writes'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
@@ -0,0 +1,30 @@
+# ---------------------------- Production (WSGI) entry point ----------------------------
+# Serving the Flask app (see: app.py) with several worker processes, without the debug mode of 'python app.py'.
+# The settings of the server are in gunicorn.conf.py (read by gunicorn from the current directory):
+#   gunicorn wsgi:application
+#   CARS_WORKERS=8 CARS_THREADS=4 CARS_BIND=0.0.0.0:8000 gunicorn wsgi:application
+# Or with uWSGI (the same preloading, see: warmup.py):
+#   uwsgi --http :8000 --module wsgi:application --master --processes 4 --threads 4
+# The app is warmed up when this module is imported: once in the master process with preload_app (the default), or
+# in each worker otherwise.
+import logging
+
+import warmup
+from app import app as application
+
+try:
+    import uwsgidecorators # Only importable when running under uWSGI
+except ImportError:
+    uwsgidecorators = None
+
+log = logging.getLogger(__name__)
+
+if application.config['WARMUP_ENABLED']:
+    timings = warmup.warmup(application)
+    log.info("Warmed up in %.3fs (%s)", sum(timings.values()), ', '.join(f"{name}: {seconds:.3f}s" for name, seconds in timings.items()))
+
+# uWSGI forks the workers right after importing this module (unless lazy-apps is set), without gunicorn's hooks (see:
+# gunicorn.conf.py)
+if uwsgidecorators is not None:
+    warmup.before_fork()
+    uwsgidecorators.postfork(lambda: warmup.after_fork(application))